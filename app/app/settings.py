@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -39,6 +41,7 @@ INSTALLED_APPS = [
     'core.apps.CoreConfig',
     'user.apps.UserConfig',
     'recipe.apps.RecipeConfig',
+    'job.apps.JobConfig',
 
     # Third-party apps
     'rest_framework',
@@ -46,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
+    'core.memory.MemoryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,6 +58,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.profiling.ProfilingMiddleware',
+    'core.slow_queries.SlowQueryMiddleware',
 ]
 
 ROOT_URLCONF = 'app.urls'
@@ -89,6 +96,53 @@ DATABASES = {
     }
 }
 
+# Read replicas, keyed by the alias of the primary they follow. To try it locally,
+# add a second entry to DATABASES pointing at the same database and list it here:
+#
+#     DATABASES['replica'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+#     DATABASE_REPLICAS = {'default': ['replica']}
+DATABASE_REPLICAS = {
+    'default': [],
+}
+
+DATABASE_ROUTERS = ['core.db_routers.ShardRouter']
+
+# Aliases holding user owned data (recipes, tags, ingredients), picked per user by
+# consistent hashing when the user is created and saved in User.shard, so added
+# shards only receive new users and those moved with the rebalance_user command.
+# Users and auth tokens always stay in the default database.
+# Give every shard a disjoint primary key range so rows can move between shards.
+DATABASE_SHARDS = ['default']
+DATABASE_SHARD_VNODES = 64
+DATABASE_SHARD_CACHE_SECONDS = 300
+# Writes of a user moving to another shard (see the rebalance_user command) get a
+# 503 with Retry-After. The fence lifts itself after this long if the move dies.
+DATABASE_MOVE_FENCE_SECONDS = 3600
+DATABASE_MOVE_RETRY_AFTER = 30
+
+# Seconds a user keeps reading from the primary after a write (replication lag budget)
+DATABASE_REPLICA_PIN_SECONDS = 5
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+#
+# Must be shared by every worker process and host: it carries the read-your-writes
+# pins, the cached shard of each user and the write fences of users moving shards.
+# With a per-process cache like LocMemCache, a write pins the user's reads on its
+# own worker only, and a moving user's writes are only refused by the mover.
+# The per-process default only suits development and tests. In production set
+#
+#     CACHE_BACKEND=django.core.cache.backends.memcached.PyMemcacheCache
+#     CACHE_LOCATION=localhost:11211
+#
+# which needs a memcached server and `pip install pymemcache`.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -128,6 +182,58 @@ STATIC_ROOT = BASE_DIR / 'static'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# How media is handed to the front-end server once access is checked: None
+# streams it from Django, 'x-accel-redirect' for nginx (an internal location
+# at MEDIA_ACCEL_REDIRECT_PREFIX aliased to MEDIA_ROOT) or 'x-sendfile' for
+# Apache mod_xsendfile and lighttpd.
+MEDIA_SENDFILE = None
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+
+# Uploads past this size are spooled to a temporary file instead of memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024
+# Recipe images are checked from their header, then decoded at most
+# RECIPE_IMAGE_MAX_DIMENSION pixels per side and re-encoded
+RECIPE_IMAGE_MAX_BYTES = 20 * 1024 * 1024
+RECIPE_IMAGE_MAX_PIXELS = 24_000_000
+RECIPE_IMAGE_MAX_DIMENSION = 2048
+# Image files younger than this are never collected as orphans
+IMAGE_GC_GRACE_SECONDS = 60 * 60
+
+# Resumable image uploads. The directory holding received bytes must be
+# shared by every web worker, and sessions expire this long after their
+# last chunk (see the purge_upload_sessions command).
+UPLOAD_SESSION_DIR = str(Path(tempfile.gettempdir()) / 'recipe_api_uploads')
+UPLOAD_SESSION_TTL_SECONDS = 24 * 60 * 60
+UPLOAD_CHUNK_MAX_BYTES = 8 * 1024 * 1024
+
+# Responses to writes sent with an Idempotency-Key are replayed to retries for
+# this long (see the purge_idempotency_keys command). A retry arriving while the
+# first request runs waits for it this long, then gets a 409 with Retry-After.
+IDEMPOTENCY_KEY_TTL_SECONDS = 24 * 60 * 60
+IDEMPOTENCY_WAIT_SECONDS = 5
+IDEMPOTENCY_RETRY_AFTER = 1
+# A request in flight longer than this died with its worker, a retry takes over
+IDEMPOTENCY_LOCK_SECONDS = 60
+
+# Change streams served by app/asgi.py. With separate processes for writes and
+# streams, use 'core.events.PostgresTransport' with OPTIONS {'alias', 'channel'}
+# to carry events between them.
+EVENTS_TRANSPORT = {
+    'BACKEND': 'core.events.LocalTransport',
+}
+# Events a stream may fall behind by before it is closed with a resync event
+EVENTS_QUEUE_SIZE = 100
+EVENTS_HEARTBEAT_SECONDS = 15
+
+# Users whose tag and ingredient names each process keeps sorted in memory for
+# autocomplete. Users with more than AUTOCOMPLETE_MAX_NAMES names are matched
+# in the database instead. Typos are only forgiven from FUZZY_MIN_LENGTH up to
+# FUZZY_MAX_LENGTH characters, since the variants tried grow with the term squared.
+AUTOCOMPLETE_CACHE_USERS = 1000
+AUTOCOMPLETE_MAX_NAMES = 100_000
+AUTOCOMPLETE_FUZZY_MIN_LENGTH = 3
+AUTOCOMPLETE_FUZZY_MAX_LENGTH = 32
+AUTOCOMPLETE_MAX_RESULTS = 50
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
@@ -136,3 +242,101 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Custom User
 AUTH_USER_MODEL = 'core.User'
+
+REST_FRAMEWORK = {
+    'DEFAULT_THROTTLE_CLASSES': (
+        'core.throttling.UserTokenBucketThrottle',
+        'core.throttling.ScopedTokenBucketThrottle',
+    ),
+    'DEFAULT_THROTTLE_RATES': {
+        'anon': '60/min',
+        'user': '600/min',
+        # Expensive endpoints get their own, smaller budget on top of the user one
+        'recipe_list': '120/min',
+        'tag_list': '120/min',
+        'ingredient_list': '120/min',
+        'recipe_export': '10/hour',
+        'recipe_bulk_delete': '30/min',
+        'recipe_trending': '120/min',
+    },
+}
+
+# Token buckets shared by the worker processes of a host. Use
+# 'core.throttling.CacheBucketStore' with OPTIONS {'alias': ...} to share
+# them between hosts through a cache backend instead.
+THROTTLE_STORE = {
+    'BACKEND': 'core.throttling.MmapBucketStore',
+    'OPTIONS': {
+        'path': str(Path(tempfile.gettempdir()) / 'recipe_api_throttle.bin'),
+        'slots': 65536,
+    },
+}
+
+# Seconds an API request may run, overridden per view with `deadline_seconds`
+# and per action with `deadlines`. Late requests get a 503 with Retry-After.
+REQUEST_DEADLINE_SECONDS = 10
+REQUEST_DEADLINE_RETRY_AFTER = 1
+
+# Opt-in request profiling, see core.profiling. When enabled, staff requests
+# sending X-Profile and a PROFILING_SAMPLE_RATE fraction of all requests are
+# profiled with cProfile ('cprofile') or a stack sampler ('sample').
+PROFILING_ENABLED = False
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_MODE = 'cprofile'
+PROFILING_SAMPLE_INTERVAL = 0.005
+PROFILING_DIR = str(Path(tempfile.gettempdir()) / 'recipe_api_profiles')
+# Profiles kept per endpoint
+PROFILING_MAX_FILES = 200
+
+# Queries of the views of these apps taking longer are logged with their plan
+# and aggregated per fingerprint at /api/slow-queries/. None turns it off.
+SLOW_QUERY_THRESHOLD_MS = 200
+SLOW_QUERY_APPS = ('recipe', 'user')
+SLOW_QUERY_MAX_FINGERPRINTS = 500
+
+# Every worker process writes its metrics here at most every
+# METRICS_WRITE_SECONDS, and /metrics merges them. Clear it on deploy.
+METRICS_DIR = str(Path(tempfile.gettempdir()) / 'recipe_api_metrics')
+METRICS_WRITE_SECONDS = 5
+# Upper bounds in seconds of the latency histogram buckets
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Bearer token scrapers must send to /metrics (bearer_token in the Prometheus
+# scrape config). The client address is not checked, behind the front-end
+# server it is the proxy's. Without a token, /metrics is not served.
+METRICS_TOKEN = None
+
+# Allocation tracing with tracemalloc, see core.memory. When enabled, workers
+# trace from startup, record the allocation peak of a MEMORY_SAMPLE_RATE
+# sample of requests, and dump a snapshot to MEMORY_SNAPSHOT_DIR on SIGUSR2.
+MEMORY_PROFILING_ENABLED = False
+MEMORY_TRACE_FRAMES = 1
+MEMORY_SAMPLE_RATE = 0.1
+MEMORY_SNAPSHOT_DIR = str(Path(tempfile.gettempdir()) / 'recipe_api_memory')
+# Upper bounds in bytes of the allocation peak histogram buckets
+MEMORY_PEAK_BUCKETS = tuple(2 ** exponent for exponent in range(16, 30, 2))
+
+# Background jobs
+JOB_RETRY_BACKOFF_SECONDS = 30
+JOB_STALE_SECONDS = 600
+
+# Recipe views and cooks are summed in process and written by a background
+# thread at this interval, or as soon as this many recipes are pending
+POPULARITY_FLUSH_SIZE = 1000
+POPULARITY_FLUSH_SECONDS = 10
+# Time after which an event counts half as much towards trending
+TRENDING_HALF_LIFE_SECONDS = 3 * 24 * 60 * 60
+
+# Recipe statistics are kept per user as running totals and bucket counts.
+# Prices are counted in buckets this many cents wide, so percentiles are off by
+# at most that much. Cooking times are counted up to each bound in minutes.
+# Run recompute_stats after changing the buckets.
+STATS_PRICE_BUCKET_CENTS = 10
+STATS_TIME_BUCKETS = (10, 20, 30, 45, 60, 90, 120, 180, 240)
+STATS_PRICE_PERCENTILES = (25, 75, 90, 99)
+# Tags and ingredients listed as the most used
+STATS_TOP = 10
+
+# Rows removed per statement by bulk and account deletion
+DELETE_BATCH_SIZE = 1000
+# Bulk recipe deletes up to this size run inline, larger ones in a background job
+BULK_DELETE_INLINE_LIMIT = 100
@@ -16,13 +16,16 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
+from core.views import BatchView, MediaView, SlowQueryView, MetricsView, MemoryView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/user/', include('user.urls', namespace='user')),
     path('api/recipe/', include('recipe.urls', namespace='recipe')),
+    path('api/job/', include('job.urls', namespace='job')),
+    path('api/batch/', BatchView.as_view(), name='batch'),
+    path('api/slow-queries/', SlowQueryView.as_view(), name='slow-queries'),
+    path('api/memory/', MemoryView.as_view(), name='memory'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
+    path(f'{settings.MEDIA_URL.lstrip("/")}<path:name>', MediaView.as_view(), name='media'),
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
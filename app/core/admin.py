@@ -1,9 +1,57 @@
+from django import forms
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, Tag, Ingredient, Recipe
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from .models import User, CanonicalName, Tag, Ingredient, Recipe
 from django.utils.translation import gettext as _
 
 
+class EstimatedCountPaginator(Paginator):
+    """Paginator using the Postgres row estimate instead of COUNT(*) for large unfiltered tables"""
+
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [queryset.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            if row and row[0] > self.estimate_threshold:
+                return row[0]
+        return super().count
+
+
+class UserOwnedAdmin(admin.ModelAdmin):
+    """Admin for large user owned tables: no full counts, no per row or full table lookups"""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+
+
+class CatalogueNamedForm(forms.ModelForm):
+    """Edit the name of a tag or ingredient, which lives in the catalogue"""
+
+    name = forms.CharField(max_length=CanonicalName._meta.get_field('name').max_length)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.initial.setdefault('name', self.instance.name)
+
+    def save(self, commit=True):
+        self.instance.name = self.cleaned_data['name']
+        return super().save(commit)
+
+
 @admin.register(User)
 class UserAdmin(BaseUserAdmin):
     ordering = ('id',)
@@ -23,6 +71,18 @@ class UserAdmin(BaseUserAdmin):
     )
 
 
-admin.site.register(Tag)
-admin.site.register(Ingredient)
-admin.site.register(Recipe)
+@admin.register(Tag, Ingredient)
+class RecipeAttrAdmin(UserOwnedAdmin):
+    form = CatalogueNamedForm
+    fields = ('user', 'name')
+    list_display = ('name', 'user')
+    list_select_related = ('user', 'canonical')
+    # Prefix search, served by the upper(name) pattern index of the catalogue
+    search_fields = ('^canonical__name',)
+
+
+@admin.register(Recipe)
+class RecipeAdmin(UserOwnedAdmin):
+    list_display = ('title', 'user', 'time_minutes', 'price')
+    search_fields = ('^title',)
+    autocomplete_fields = ('tags', 'ingredients')
@@ -0,0 +1,208 @@
+import string
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from django.conf import settings
+from django.db import connections
+from django.db.models import Max
+from core.catalogue import normalize
+from core.models import CanonicalName, Change
+
+# Characters tried when looking for names one typo away from the typed text
+TYPO_ALPHABET = string.ascii_lowercase + string.digits + ' '
+
+
+class NameIndex:
+    """One user's tag or ingredient names sorted by normalized form, with every later word sorted apart
+
+    Matching a prefix is a binary search, so lookups stay fast with tens of
+    thousands of names, and writes are kept in order with insort.
+    """
+
+    def __init__(self, rows, version):
+        self.version = version
+        # Version once the updates waiting for their commit are applied
+        self.pending = version
+        self.names = dict(rows)
+        self.entries = sorted((normalize(name), pk, name) for pk, name in self.names.items())
+        self.words = sorted(word for key, pk, name in self.entries for word in self._words(key, pk, name))
+
+    @staticmethod
+    def _words(key, pk, name):
+        return [(word, pk, name) for word in key.split()[1:]]
+
+    def add(self, pk, name):
+        self.remove(pk)
+        self.names[pk] = name
+        entry = (normalize(name), pk, name)
+        insort(self.entries, entry)
+        for word in self._words(*entry):
+            insort(self.words, word)
+
+    def remove(self, pk):
+        name = self.names.pop(pk, None)
+        if name is None:
+            return
+        entry = (normalize(name), pk, name)
+        for entries, item in [(self.entries, entry)] + [(self.words, word) for word in self._words(*entry)]:
+            i = bisect_left(entries, item)
+            if i < len(entries) and entries[i] == item:
+                del entries[i]
+
+    @staticmethod
+    def _prefixed(entries, prefix):
+        i = bisect_left(entries, (prefix,))
+        while i < len(entries) and entries[i][0].startswith(prefix):
+            yield entries[i]
+            i += 1
+
+    def search(self, term, limit):
+        """Return up to `limit` (id, name) matching `term`
+
+        Names starting with the term come first, then names with a later word
+        starting with it, then names starting with the term one typo away.
+        """
+
+        term = normalize(term)
+        found = {}
+
+        def take(matches):
+            for _, pk, name in matches:
+                if len(found) >= limit:
+                    return
+                found.setdefault(pk, name)
+
+        take(self._prefixed(self.entries, term))
+        take(self._prefixed(self.words, term))
+        fuzzy = settings.AUTOCOMPLETE_FUZZY_MIN_LENGTH <= len(term) <= settings.AUTOCOMPLETE_FUZZY_MAX_LENGTH
+        if len(found) < limit and fuzzy:
+            for variant in sorted(_typos(term)):
+                take(self._prefixed(self.entries, variant))
+        return list(found.items())
+
+
+def _typos(term):
+    """Return the strings one deletion, transposition, substitution or insertion away from `term`"""
+
+    splits = [(term[:i], term[i:]) for i in range(len(term) + 1)]
+    alphabet = set(TYPO_ALPHABET) | set(term)
+    variants = {left + right[1:] for left, right in splits if right}
+    variants |= {left + right[1] + right[0] + right[2:] for left, right in splits if len(right) > 1}
+    variants |= {left + c + right[1:] for left, right in splits if right for c in alphabet}
+    variants |= {left + c + right for left, right in splits for c in alphabet}
+    variants.discard(term)
+    # Everything starts with the empty string
+    variants.discard('')
+    return variants
+
+
+class _TooLarge:
+    """Stands in for the index of a user with more than AUTOCOMPLETE_MAX_NAMES names"""
+
+    def __init__(self, version):
+        self.version = version
+
+
+_lock = threading.Lock()
+_indexes = OrderedDict()
+
+
+def _version(model, user):
+    """Return the sequence number of the user's last tag or ingredient change, the same in every process"""
+
+    changes = Change.objects.filter(user=user, kind=model._meta.model_name)
+    return changes.aggregate(seq=Max('seq'))['seq'] or 0
+
+
+def _index(model, user):
+    """Return the user's up to date index, building it on first use or after a write in another process"""
+
+    key = (model._meta.model_name, user.pk)
+    version = _version(model, user)
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+    if index is not None and index.version == version:
+        return index
+
+    rows = model.objects.filter(user=user).values_list('id', 'canonical__name')
+    rows = list(rows[:settings.AUTOCOMPLETE_MAX_NAMES + 1])
+    index = _TooLarge(version) if len(rows) > settings.AUTOCOMPLETE_MAX_NAMES else NameIndex(rows, version)
+    with _lock:
+        _indexes[key] = index
+        while len(_indexes) > settings.AUTOCOMPLETE_CACHE_USERS:
+            _indexes.popitem(last=False)
+    return index
+
+
+def _search_database(model, user, term, limit):
+    """Match in the database, with the prefix index of catalogue names and their trigram index on PostgreSQL"""
+
+    queryset = model.objects.filter(user=user, canonical__name__istartswith=term.strip())
+    found = dict(queryset.order_by('canonical__name').values_list('id', 'canonical__name')[:limit])
+    connection = connections[queryset.db]
+    fuzzy = settings.AUTOCOMPLETE_FUZZY_MIN_LENGTH <= len(term) <= settings.AUTOCOMPLETE_FUZZY_MAX_LENGTH
+    if len(found) < limit and fuzzy and connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT item.id, entry.name FROM {model._meta.db_table} item '
+                f'JOIN {CanonicalName._meta.db_table} entry ON entry.id = item.canonical_id '
+                f'WHERE item.user_id = %s AND UPPER(entry.name::text) %% UPPER(%s) '
+                f'ORDER BY similarity(UPPER(entry.name::text), UPPER(%s)) DESC LIMIT %s',
+                [user.pk, term, term, limit],
+            )
+            for pk, name in cursor.fetchall():
+                if len(found) < limit:
+                    found.setdefault(pk, name)
+    return list(found.items())
+
+
+def search(model, user, term, limit):
+    """Return up to `limit` (id, name) of the user's tags or ingredients matching what they typed"""
+
+    index = _index(model, user)
+    if isinstance(index, _TooLarge):
+        return _search_database(model, user, term, limit)
+    return index.search(term, limit)
+
+
+def clear_cache():
+    with _lock:
+        _indexes.clear()
+
+
+def changed(model, user_id, pk, name=None, using=None):
+    """Return a callback updating this process' index in place once a tag or ingredient save commits
+
+    Call it after the change is recorded, while the write holds the user's
+    change counter. The index is only updated when this change is the one
+    write since its version and the updates still waiting for their commit,
+    otherwise it and the other processes' indexes are rebuilt when they see
+    the version in the database. `name` is None for deletions.
+    """
+
+    key = (model._meta.model_name, user_id)
+    with _lock:
+        index = _indexes.get(key)
+    if not isinstance(index, NameIndex):
+        return None
+    since = index.pending
+    changes = list(Change.objects.using(using).filter(
+        user_id=user_id, kind=model._meta.model_name, seq__gt=since
+    ).values_list('object_id', 'seq'))
+    if len(changes) != 1 or changes[0][0] != pk:
+        return None
+    version = index.pending = changes[0][1]
+
+    def update():
+        with _lock:
+            # Skipped when an earlier update was rolled back, the index is then rebuilt on its next use
+            if _indexes.get(key) is not index or index.version != since:
+                return
+            if name is None:
+                index.remove(pk)
+            else:
+                index.add(pk, name)
+            index.version = version
+    return update
@@ -0,0 +1,54 @@
+import unicodedata
+from collections import Counter
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count
+from core.models import CanonicalName
+
+MAX_LENGTH = CanonicalName._meta.get_field('name').max_length
+
+
+def normalize(name):
+    """Return the form spellings of a name share, compatibility normalized, case folded and single spaced"""
+
+    return ' '.join(unicodedata.normalize('NFKC', name).casefold().split())[:MAX_LENGTH]
+
+
+def canonical_ids(names, using=DEFAULT_DB_ALIAS):
+    """Return {name: catalogue id} for `names` in the catalogue of database `using`, adding the ones it lacks
+
+    Not cached in the process: an entry added by a transaction that rolls back
+    would leave a cached id pointing at nothing.
+    """
+
+    wanted = set(names)
+    catalogue = CanonicalName.objects.using(using)
+    found = dict(catalogue.filter(name__in=wanted).values_list('name', 'id'))
+    new = wanted - set(found)
+    if new:
+        # Other processes may add the same names meanwhile
+        catalogue.bulk_create([CanonicalName(name=name) for name in sorted(new)], ignore_conflicts=True)
+        found.update(catalogue.filter(name__in=new).values_list('name', 'id'))
+    return found
+
+
+def canonical(name, using=DEFAULT_DB_ALIAS):
+    """Return the catalogue entry of a name in database `using`"""
+
+    return CanonicalName(id=canonical_ids([name], using)[name], name=name)
+
+
+def usage(model, limit=20):
+    """Return the `limit` names most users have among their tags or ingredients, as (normalized name, users)
+
+    Every shard has its own catalogue, so spellings are merged by their normalized
+    form. A user spelling a name two ways counts twice.
+    """
+
+    users = Counter()
+    for alias in settings.DATABASE_SHARDS:
+        rows = model.objects.using(alias).order_by().values('canonical__name')
+        rows = rows.annotate(users=Count('user', distinct=True)).values_list('canonical__name', 'users')
+        for name, count in rows:
+            users[normalize(name)] += count
+    return users.most_common(limit)
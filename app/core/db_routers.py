@@ -0,0 +1,214 @@
+import bisect
+import hashlib
+import random
+from contextvars import ContextVar
+from functools import lru_cache
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from core import metrics
+
+# Models partitioned by owner, and the catalogue of names their tags and ingredients use.
+# Users, auth tokens and everything else stay in the default database.
+SHARDED_MODELS = {
+    'core.canonicalname',
+    'core.tag',
+    'core.ingredient',
+    'core.recipe',
+    'core.recipe_tags',
+    'core.recipe_ingredients',
+    'core.change',
+    'core.changecounter',
+    'core.uploadsession',
+    'core.recipepopularity',
+    'core.recipestats',
+    'core.recipestatsbucket',
+}
+
+_use_replicas = ContextVar('use_replicas', default=False)
+_current_shard = ContextVar('current_shard', default=None)
+
+
+def _pin_key(user_id):
+    return f'db-pin:{user_id}'
+
+
+def _shard_key(user_id):
+    return f'user-shard:{user_id}'
+
+
+def _fence_key(user_id):
+    return f'user-moving:{user_id}'
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to nodes through virtual nodes"""
+
+    def __init__(self, nodes, vnodes=64):
+        if not nodes:
+            raise ValueError('hash ring needs at least one node')
+        points = sorted((_hash(f'{node}#{i}'), node) for node in nodes for i in range(vnodes))
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get(self, key):
+        """Return the node owning a key"""
+
+        idx = bisect.bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._nodes[idx]
+
+
+@lru_cache(maxsize=None)
+def _ring(shards, vnodes):
+    return HashRing(shards, vnodes)
+
+
+def ring_shard(user_id):
+    """Return the shard consistent hashing over the current DATABASE_SHARDS picks for a user
+
+    Only used to place new users: it changes when shards are added, so the
+    choice is saved in `User.shard`.
+    """
+
+    return _ring(tuple(settings.DATABASE_SHARDS), settings.DATABASE_SHARD_VNODES).get(user_id)
+
+
+def shard_for_user(user):
+    """Return the shard alias holding the user's recipes, tags and ingredients"""
+
+    shards = settings.DATABASE_SHARDS
+    if len(shards) == 1:
+        return shards[0]
+    if user.shard:
+        return user.shard
+    return ring_shard(user.pk)
+
+
+def shard_for_user_id(user_id):
+    """Same as `shard_for_user` when only the user id is at hand"""
+
+    shards = settings.DATABASE_SHARDS
+    if len(shards) == 1:
+        return shards[0]
+    alias = cache.get(_shard_key(user_id))
+    metrics.inc('cache_requests_total', cache='shard', result='miss' if alias is None else 'hit')
+    if alias is None:
+        from core.models import User
+        assigned = User.objects.using(DEFAULT_DB_ALIAS).filter(pk=user_id).values_list('shard', flat=True).first()
+        alias = assigned or ring_shard(user_id)
+        cache.set(_shard_key(user_id), alias, settings.DATABASE_SHARD_CACHE_SECONDS)
+    return alias
+
+
+def forget_shard(user_id):
+    """Drop the cached shard of a user, after moving it"""
+
+    cache.delete(_shard_key(user_id))
+
+
+def fence_writes(user_id):
+    """Refuse the user's writes on every worker, through the shared cache, while its rows move"""
+
+    cache.set(_fence_key(user_id), True, settings.DATABASE_MOVE_FENCE_SECONDS)
+
+
+def lift_fence(user_id):
+    """Accept the user's writes again once the move is over"""
+
+    cache.delete(_fence_key(user_id))
+
+
+def is_fenced(user_id):
+    """Return True if the user is moving to another shard and must not write"""
+
+    if len(settings.DATABASE_SHARDS) == 1:
+        return False
+    return cache.get(_fence_key(user_id), False)
+
+
+def use_shard(alias):
+    """Route owner-less queries in the current context to a shard, return a reset token"""
+
+    return _current_shard.set(alias)
+
+
+def reset_shard(token):
+    """Restore the shard saved by `use_shard`"""
+
+    _current_shard.reset(token)
+
+
+def use_replicas():
+    """Send reads issued in the current context to a replica, return a reset token"""
+
+    return _use_replicas.set(True)
+
+
+def reset_replicas(token):
+    """Restore the routing state saved by `use_replicas`"""
+
+    _use_replicas.reset(token)
+
+
+def pin_to_primary(user):
+    """Keep the user's reads on the primary for a while after a write, on every worker through the shared cache"""
+
+    cache.set(_pin_key(user.pk), True, settings.DATABASE_REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user):
+    """Return True if the user wrote recently and must read from the primary"""
+
+    return cache.get(_pin_key(user.pk), False)
+
+
+def replicas_for(alias):
+    """Return the replica aliases configured for a primary alias"""
+
+    return settings.DATABASE_REPLICAS.get(alias, ())
+
+
+class ShardRouter:
+    """Route user owned models to their owner's shard and safe reads to that shard's replicas"""
+
+    def _primary(self, model, hints):
+        if model._meta.label_lower not in SHARDED_MODELS:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None:
+            if instance._meta.label_lower in SHARDED_MODELS and instance._state.db:
+                return instance._state.db
+            if instance._meta.label_lower == settings.AUTH_USER_MODEL.lower():
+                return shard_for_user(instance)
+            user_id = getattr(instance, 'user_id', None)
+            if user_id is not None:
+                return shard_for_user_id(user_id)
+        return _current_shard.get() or DEFAULT_DB_ALIAS
+
+    def db_for_read(self, model, **hints):
+        primary = self._primary(model, hints)
+        if _use_replicas.get():
+            replicas = replicas_for(primary)
+            if replicas:
+                return random.choice(replicas)
+        return primary
+
+    def db_for_write(self, model, **hints):
+        return self._primary(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """Owners live in the default database, their rows on any shard"""
+
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        """Replicas get their schema through replication"""
+
+        for replicas in settings.DATABASE_REPLICAS.values():
+            if db in replicas:
+                return False
+        return None
@@ -0,0 +1,153 @@
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import connections, OperationalError
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from core import metrics
+
+_deadline = ContextVar('deadline', default=None)
+# PostgreSQL error code of a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+
+class DeadlineExceeded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The request took too long, retry later.'
+    default_code = 'deadline_exceeded'
+
+    def __init__(self, stage):
+        super().__init__()
+        self.stage = stage
+        # DRF's exception handler turns `wait` into a Retry-After header
+        self.wait = settings.REQUEST_DEADLINE_RETRY_AFTER
+
+
+def _request_start(request):
+    """Return when the front-end server received the request, when it says so in X-Request-Start"""
+
+    header = request.META.get('HTTP_X_REQUEST_START', '')
+    try:
+        started = float(header[2:] if header.startswith('t=') else header)
+    except ValueError:
+        return None
+    # nginx sends seconds with a fraction, other servers milliseconds or microseconds
+    while started > time.time() * 10:
+        started /= 1000
+    return started
+
+
+def remaining():
+    """Return the seconds left before the current deadline, None without one"""
+
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check(stage):
+    """Give up on the current request when its deadline has passed"""
+
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(stage)
+
+
+class _StatementTimeout:
+    """Execute wrapper checking the deadline before each query, and bounding it with statement_timeout on PostgreSQL"""
+
+    def __init__(self):
+        self.timed_out_connections = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        check('query')
+        connection = context['connection']
+        if connection.vendor != 'postgresql':
+            return execute(sql, params, many, context)
+        if connection.alias not in self.timed_out_connections:
+            # Bypasses the wrappers, this runs inside one
+            timeout_ms = max(int(remaining() * 1000), 1)
+            context['cursor'].cursor.execute(f'SET statement_timeout = {timeout_ms}')
+            self.timed_out_connections.add(connection.alias)
+        try:
+            return execute(sql, params, many, context)
+        except OperationalError as exc:
+            if getattr(exc.__cause__, 'pgcode', None) == QUERY_CANCELED:
+                raise DeadlineExceeded('query') from exc
+            raise
+
+    def reset(self):
+        for alias in self.timed_out_connections:
+            connection = connections[alias]
+            if connection.connection is not None and not connection.needs_rollback:
+                with connection.cursor() as cursor:
+                    cursor.execute('RESET statement_timeout')
+        self.timed_out_connections.clear()
+
+
+class DeadlineMixin:
+    """Give API requests a deadline, checked between stages and enforced on every query
+
+    The deadline is `deadlines[action]`, else `deadline_seconds`, else
+    REQUEST_DEADLINE_SECONDS, counted from when the front-end server received the
+    request when it sends X-Request-Start. Past it, the request fails with a 503.
+    Actions mapped to None in `deadlines` get no deadline, for those reading a large
+    body that a slow client may take longer than any deadline to send.
+    """
+
+    deadline_seconds = None
+    deadlines = {}
+
+    def get_deadline_seconds(self):
+        action = getattr(self, 'action', None)
+        if action in self.deadlines:
+            return self.deadlines[action]
+        return self.deadline_seconds or settings.REQUEST_DEADLINE_SECONDS
+
+    def initial(self, request, *args, **kwargs):
+        seconds = self.get_deadline_seconds()
+        if seconds is None:
+            return super().initial(request, *args, **kwargs)
+        started = _request_start(request)
+        waited = max(time.time() - started, 0) if started else 0
+        deadline = time.monotonic() - waited + seconds
+        current = _deadline.get()
+        # Nested requests, like those of a batch, never outlive the outer one
+        self._deadline_token = _deadline.set(deadline if current is None else min(current, deadline))
+        self._statement_timeout = _StatementTimeout()
+        self._deadline_stack = ExitStack()
+        for connection in connections.all():
+            self._deadline_stack.enter_context(connection.execute_wrapper(self._statement_timeout))
+        check('queue')
+        super().initial(request, *args, **kwargs)
+        check('initial')
+
+    def get_serializer(self, *args, **kwargs):
+        check('serialize')
+        return super().get_serializer(*args, **kwargs)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, DeadlineExceeded):
+            metrics.inc('request_deadline_exceeded_total', view=type(self).__name__, stage=exc.stage)
+        return super().handle_exception(exc)
+
+    def _end_deadline(self):
+        token = getattr(self, '_deadline_token', None)
+        if token is not None:
+            self._deadline_token = None
+            self._deadline_stack.close()
+            try:
+                self._statement_timeout.reset()
+            finally:
+                _deadline.reset(token)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        self._end_deadline()
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # finalize_response is skipped when an exception escapes handle_exception
+            self._end_deadline()
@@ -0,0 +1,103 @@
+from django.conf import settings
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from rest_framework.authtoken.models import Token
+from core import db_routers, sync, images, stats
+from core.models import User, Tag, Ingredient, Recipe, Change, ChangeCounter, UploadSession, RecipeStats, \
+    RecipeStatsBucket
+from core.signals import recipes_deleted
+
+
+def _delete_in(cursor, table, column, ids):
+    """Run a bounded `DELETE ... WHERE column IN (...)`"""
+
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f'DELETE FROM {table} WHERE {column} IN ({placeholders})', ids)
+
+
+def _delete_recipe_batch(user, ids, using, tombstones=True):
+    """Delete one batch of the user's recipes with their m2m rows, return how many were deleted"""
+
+    with transaction.atomic(using=using):
+        rows = list(Recipe.objects.using(using).filter(user=user, id__in=ids).values_list('id', 'image'))
+        ids = [recipe_id for recipe_id, _ in rows]
+        if not ids:
+            return 0
+        stats.remove_recipes(user.pk, ids, using)
+        with connections[using].cursor() as cursor:
+            for field in (Recipe.tags.field, Recipe.ingredients.field):
+                _delete_in(cursor, field.remote_field.through._meta.db_table, field.m2m_column_name(), ids)
+            _delete_in(cursor, Recipe._meta.db_table, 'id', ids)
+        if tombstones:
+            sync.record_deletions(user.pk, 'recipe', ids, using)
+        recipes_deleted.send(sender=Recipe, user_id=user.pk, ids=ids, using=using)
+        images.release_on_commit([image for _, image in rows], using)
+    return len(ids)
+
+
+def delete_recipes(user, ids, batch_size=None, progress=None):
+    """Delete the given recipes of a user in bounded batches, without loading them as objects"""
+
+    batch_size = batch_size or settings.DELETE_BATCH_SIZE
+    using = db_routers.shard_for_user(user)
+    ids = sorted(set(ids))
+    deleted = 0
+    for i in range(0, len(ids), batch_size):
+        deleted += _delete_recipe_batch(user, ids[i:i + batch_size], using)
+        if progress:
+            progress('recipes', deleted)
+    return deleted
+
+
+def delete_user(user, batch_size=None, progress=None):
+    """Delete a user and everything they own in bounded batches instead of one cascading transaction"""
+
+    batch_size = batch_size or settings.DELETE_BATCH_SIZE
+    using = db_routers.shard_for_user(user)
+    totals = {}
+
+    def report(stage, count):
+        totals[stage] = count
+        if progress:
+            progress(stage, count)
+
+    # Stop logins and API access first, so nothing new is written while rows are removed
+    User.objects.using(DEFAULT_DB_ALIAS).filter(pk=user.pk).update(is_active=False)
+    Token.objects.using(DEFAULT_DB_ALIAS).filter(user=user).delete()
+
+    deleted = 0
+    recipes = Recipe.objects.using(using).filter(user=user).order_by('id').values_list('id', flat=True)
+    while True:
+        ids = list(recipes[:batch_size])
+        if not ids:
+            break
+        deleted += _delete_recipe_batch(user, ids, using, tombstones=False)
+        report('recipes', deleted)
+
+    for model, field in ((Tag, Recipe.tags.field), (Ingredient, Recipe.ingredients.field)):
+        deleted = 0
+        rows = model.objects.using(using).filter(user=user).order_by('id').values_list('id', flat=True)
+        while True:
+            ids = list(rows[:batch_size])
+            if not ids:
+                break
+            with transaction.atomic(using=using), connections[using].cursor() as cursor:
+                _delete_in(cursor, field.remote_field.through._meta.db_table, field.m2m_reverse_name(), ids)
+                _delete_in(cursor, model._meta.db_table, 'id', ids)
+            deleted += len(ids)
+            report(model._meta.verbose_name_plural, deleted)
+
+    # Part files of dropped upload sessions are left to purge_upload_sessions
+    for model in (Change, ChangeCounter, UploadSession, RecipeStats, RecipeStatsBucket):
+        rows = model.objects.using(using).filter(user=user).values_list('pk', flat=True)
+        while True:
+            ids = [model._meta.pk.get_db_prep_value(pk, connections[using]) for pk in rows[:batch_size]]
+            if not ids:
+                break
+            with connections[using].cursor() as cursor:
+                _delete_in(cursor, model._meta.db_table, model._meta.pk.column, ids)
+
+    # What is left is small and global, let the regular cascade handle it
+    User.objects.using(DEFAULT_DB_ALIAS).filter(pk=user.pk).delete()
+    db_routers.forget_shard(user.pk)
+    report('users', 1)
+    return totals
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import os
+import select
+import threading
+import time
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.utils.module_loading import import_string
+from rest_framework.authtoken.models import Token
+
+logger = logging.getLogger(__name__)
+
+# Put in a stream's queue when it fell too far behind, the client resyncs
+OVERFLOW = object()
+
+
+class Subscription:
+    """Queue of the events of one user for one stream, filled from any thread"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=settings.EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    def push(self, message):
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message):
+        if self.overflowed:
+            return
+        if self.queue.full():
+            self.overflowed = True
+            # Room is made for the marker, the stream ends there anyway
+            self.queue.get_nowait()
+            message = OVERFLOW
+        self.queue.put_nowait(message)
+
+
+class Broker:
+    """Fan events out to the streams of this process, by user"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user_id, None)
+
+    def deliver(self, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(message['user'], ()))
+        for subscription in subscriptions:
+            subscription.push(message)
+
+    def streams(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+
+broker = Broker()
+
+
+class LocalTransport:
+    """Deliver events to the streams of the publishing process only
+
+    Enough when the process serving the streams also serves the writes, as in
+    development. Otherwise use PostgresTransport.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, message):
+        self.broker.deliver(message)
+
+    def listen(self):
+        pass
+
+
+class PostgresTransport:
+    """Carry events between processes with PostgreSQL LISTEN/NOTIFY on `channel`
+
+    Publishing is a NOTIFY on the `alias` connection. Processes serving streams
+    listen on a connection of their own, in a thread started by their first stream.
+    """
+
+    def __init__(self, broker, alias='default', channel='recipe_events', reconnect_seconds=5):
+        self.broker = broker
+        self.alias = alias
+        self.channel = channel
+        self.reconnect_seconds = reconnect_seconds
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def publish(self, message):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, json.dumps(message)])
+
+    def listen(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._run, name='events-listener', daemon=True)
+                self._listener.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen_once()
+            except Exception:
+                logger.exception('Event listener lost its connection, reconnecting')
+            time.sleep(self.reconnect_seconds)
+
+    def _listen_once(self):
+        import psycopg2
+
+        wrapper = connections[self.alias]
+        connection = psycopg2.connect(**wrapper.get_connection_params())
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN "{self.channel}"')
+            while True:
+                # Wakes up now and then to notice a dead connection
+                if select.select([connection], [], [], 30) == ([], [], []):
+                    connection.cursor().execute('SELECT 1')
+                connection.poll()
+                while connection.notifies:
+                    self.broker.deliver(json.loads(connection.notifies.pop(0).payload))
+        finally:
+            connection.close()
+
+
+_transports = {}
+
+
+def get_transport():
+    """Return this process' event transport, created after any fork"""
+
+    pid = os.getpid()
+    transport = _transports.get(pid)
+    if transport is None:
+        config = settings.EVENTS_TRANSPORT
+        transport = import_string(config['BACKEND'])(broker, **config.get('OPTIONS', {}))
+        _transports.clear()
+        _transports[pid] = transport
+    return transport
+
+
+def publish(user_id, kind, action, object_id, seq, using):
+    """Send a change of a user's recipe, tag or ingredient to their streams, once committed"""
+
+    message = {'user': user_id, 'kind': kind, 'action': action, 'id': object_id, 'seq': seq}
+    transaction.on_commit(lambda: get_transport().publish(message), using=using)
+
+
+def _format(message):
+    data = json.dumps({key: value for key, value in message.items() if key != 'user'})
+    event_id = f'id: {message["seq"]}\n' if message.get('seq') is not None else ''
+    return f'{event_id}event: change\ndata: {data}\n\n'.encode()
+
+
+def _user_for_token(key):
+    close_old_connections()
+    try:
+        return Token.objects.filter(key=key, user__is_active=True).values_list('user_id', flat=True).first()
+    finally:
+        close_old_connections()
+
+
+async def _authenticate(scope):
+    """Return the user id of the token in the Authorization header, or in `token` for EventSource clients"""
+
+    headers = dict(scope.get('headers', ()))
+    keyword, _, key = headers.get(b'authorization', b'').decode('latin-1').partition(' ')
+    if keyword != 'Token':
+        key = parse_qs(scope.get('query_string', b'').decode()).get('token', [''])[0]
+    if not key:
+        return None
+    return await sync_to_async(_user_for_token)(key)
+
+
+async def _respond(send, status, body):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': json.dumps({'detail': body}).encode()})
+
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream(scope, receive, send):
+    """ASGI app streaming the changes of the authenticated user as Server-Sent Events
+
+    Each event carries the sync token of its change as its id, so a client that
+    reconnects catches up with the sync endpoint. An idle stream is one coroutine
+    and one queue, woken only to send a heartbeat comment every EVENTS_HEARTBEAT_SECONDS.
+    """
+
+    if scope['method'] != 'GET':
+        await _respond(send, 405, 'Method not allowed.')
+        return
+    user_id = await _authenticate(scope)
+    if user_id is None:
+        await _respond(send, 401, 'Invalid token.')
+        return
+
+    get_transport().listen()
+    subscription = broker.subscribe(user_id)
+    disconnected = asyncio.ensure_future(_disconnected(receive))
+    received = None
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            # Keeps nginx from buffering the stream
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+        while True:
+            received = received or asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait(
+                {received, disconnected}, timeout=settings.EVENTS_HEARTBEAT_SECONDS,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if disconnected in done:
+                break
+            if received not in done:
+                await send({'type': 'http.response.body', 'body': b': heartbeat\n\n', 'more_body': True})
+                continue
+            message, received = received.result(), None
+            if message is OVERFLOW:
+                await send({'type': 'http.response.body', 'body': b'event: resync\ndata: {}\n\n'})
+                break
+            await send({'type': 'http.response.body', 'body': _format(message), 'more_body': True})
+    finally:
+        broker.unsubscribe(subscription)
+        disconnected.cancel()
+        if received is not None:
+            received.cancel()
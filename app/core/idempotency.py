@@ -0,0 +1,213 @@
+import hashlib
+import json
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import BaseThrottle
+from core import deadlines
+from core.models import IdempotencyKey
+
+KEY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+MAX_KEY_LENGTH = IdempotencyKey._meta.get_field('key').max_length
+# Stored with the response and sent again to retries
+REPLAYED_HEADERS = ('Location',)
+# Answers a retry should not get again, it re-runs the request instead
+RETRYABLE_STATUSES = (status.HTTP_409_CONFLICT, status.HTTP_429_TOO_MANY_REQUESTS)
+POLL_SECONDS = 0.05
+
+
+class KeyInUse(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'A request with this Idempotency-Key is still in progress, retry later.'
+    default_code = 'idempotency_key_in_use'
+
+    def __init__(self):
+        super().__init__()
+        # DRF's exception handler turns `wait` into a Retry-After header
+        self.wait = settings.IDEMPOTENCY_RETRY_AFTER
+
+
+class KeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'This Idempotency-Key was sent with a different request.'
+    default_code = 'idempotency_key_reused'
+
+
+class _Replay(Exception):
+    """Raised from `initial` to answer with a stored response instead of running the view"""
+
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+
+
+def _canonical(value):
+    if isinstance(value, File):
+        digest = hashlib.sha256()
+        for chunk in value.chunks():
+            digest.update(chunk)
+        value.seek(0)
+        return f'sha256:{digest.hexdigest()}'
+    return value
+
+
+def request_hash(request):
+    """Return a hash of the request's method, url and parsed data, hashing uploaded files by their content"""
+
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = sorted((name, [_canonical(value) for value in values]) for name, values in data.lists())
+    payload = json.dumps([request.method, request.get_full_path(), data], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def client_hash(request):
+    """Return a hash of the address of an anonymous request, as throttling identifies it, or '' for users"""
+
+    if request.user and request.user.is_authenticated:
+        return ''
+    return hashlib.sha256(BaseThrottle().get_ident(request).encode()).hexdigest()
+
+
+def _replay(record):
+    response = HttpResponse(bytes(record.content), status=record.status_code, content_type=record.content_type)
+    for name, value in record.headers.items():
+        response[name] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def claim(user, key, digest, client=''):
+    """Reserve `key` for a request, return (record, None) to run it or (None, response) to replay an earlier one
+
+    Keys are the user's own, or for anonymous requests those of the `client` hash.
+
+    A request in flight with the same key is waited for, up to IDEMPOTENCY_WAIT_SECONDS
+    and the current deadline. One in flight for longer than IDEMPOTENCY_LOCK_SECONDS
+    is taken to have died with its worker, and taken over.
+    """
+
+    user_id = user.pk if user.is_authenticated else None
+    give_up = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    user_id=user_id, client=client, key=key, request_hash=digest, locked_at=now,
+                    expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL_SECONDS),
+                )
+            return record, None
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(user_id=user_id, client=client, key=key).first()
+        if record is None:
+            # Swept since the insert failed
+            continue
+        if record.expires_at <= now:
+            IdempotencyKey.objects.filter(pk=record.pk, expires_at__lte=now).delete()
+            continue
+        if record.request_hash != digest:
+            raise KeyReused()
+        if record.status_code is not None:
+            return None, _replay(record)
+        if record.locked_at <= now - timedelta(seconds=settings.IDEMPOTENCY_LOCK_SECONDS):
+            # Compare and set, only one retry takes over
+            if IdempotencyKey.objects.filter(pk=record.pk, status_code=None, locked_at=record.locked_at).update(
+                locked_at=now
+            ):
+                return record, None
+            continue
+
+        left = deadlines.remaining()
+        if time.monotonic() + POLL_SECONDS > give_up or (left is not None and left <= POLL_SECONDS):
+            raise KeyInUse()
+        time.sleep(POLL_SECONDS)
+
+
+def release(record):
+    """Free the key of a request that failed, so a retry runs it again"""
+
+    IdempotencyKey.objects.filter(pk=record.pk, status_code=None).delete()
+
+
+def complete(record, response):
+    """Store the response of the request holding the key, or release the key when a retry should run again"""
+
+    if response.streaming or response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES:
+        release(record)
+        return
+    if hasattr(response, 'render') and not response.is_rendered:
+        response.render()
+    IdempotencyKey.objects.filter(pk=record.pk).update(
+        status_code=response.status_code,
+        content_type=response.get('Content-Type', ''),
+        headers={name: response[name] for name in REPLAYED_HEADERS if response.has_header(name)},
+        content=response.content,
+    )
+
+
+def purge_expired(batch_size=1000):
+    """Delete expired keys in batches, return how many were deleted"""
+
+    deleted = 0
+    expired = IdempotencyKey.objects.filter(expires_at__lt=timezone.now()).values_list('id', flat=True)
+    while True:
+        ids = list(expired[:batch_size])
+        if not ids:
+            return deleted
+        IdempotencyKey.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+
+
+class IdempotencyMixin:
+    """Answer retries of a write sending the same Idempotency-Key with the first response, without running it again
+
+    Applies to the unsafe requests of `idempotent_actions`, or to all unsafe requests
+    when it is None. Responses are kept for IDEMPOTENCY_KEY_TTL_SECONDS, except for
+    server errors, conflicts and throttled requests, which free the key instead.
+    """
+
+    idempotent_actions = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        key = request.META.get(KEY_HEADER)
+        if not key or request.method in SAFE_METHODS:
+            return
+        if self.idempotent_actions is not None and getattr(self, 'action', None) not in self.idempotent_actions:
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            raise ValidationError({'Idempotency-Key': f'At most {MAX_KEY_LENGTH} characters'})
+        record, response = claim(request.user, key, request_hash(request), client_hash(request))
+        if response is not None:
+            raise _Replay(response)
+        self._idempotency_record = record
+
+    def handle_exception(self, exc):
+        if isinstance(exc, _Replay):
+            return exc.response
+        try:
+            return super().handle_exception(exc)
+        except Exception:
+            record = getattr(self, '_idempotency_record', None)
+            if record is not None:
+                self._idempotency_record = None
+                release(record)
+            raise
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        record = getattr(self, '_idempotency_record', None)
+        if record is not None:
+            self._idempotency_record = None
+            complete(record, response)
+        return response
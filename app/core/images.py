@@ -0,0 +1,186 @@
+import logging
+import os
+import tempfile
+import time
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F
+from core.models import Recipe, StoredImage
+from core.storage import CONTENT_ADDRESSED_NAME, IMAGE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Pillow format name -> stored extension
+INGEST_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+
+def image_storage():
+    return Recipe._meta.get_field('image').storage
+
+
+def retain(name, content=None):
+    """Count a new reference to a stored image, writing `content` back when the file was collected meanwhile
+
+    Takes the row lock `release` deletes files under, so the file is either
+    still there or its deletion is over.
+    """
+
+    storage = image_storage()
+    with transaction.atomic():
+        row, created = StoredImage.objects.select_for_update().get_or_create(name=name)
+        if not storage.exists(name):
+            if content is None:
+                logger.warning('Image %s was collected while being referenced again', name)
+            else:
+                logger.info('Image %s was collected while being referenced again, storing it again', name)
+                storage.save(name, content)
+                created = True
+        if created and storage.exists(name):
+            row.size = storage.size(name)
+        row.refs += 1
+        row.save(update_fields=['refs', 'size'])
+
+
+def release(names):
+    """Drop references to stored images and delete the files nobody references any more
+
+    Call it once the change dropping the references is committed.
+    """
+
+    storage = image_storage()
+    for name in names:
+        if not CONTENT_ADDRESSED_NAME.match(name):
+            # Legacy uuid names were never shared
+            storage.delete(name)
+            continue
+        StoredImage.objects.filter(name=name, refs__gt=0).update(refs=F('refs') - 1)
+        with transaction.atomic():
+            # The row lock makes a concurrent retain wait, then recreate the row
+            row = StoredImage.objects.select_for_update().filter(name=name, refs=0).first()
+            if row is not None:
+                storage.delete(name)
+                row.delete()
+                logger.info('Deleted unreferenced image %s, reclaimed %d bytes', name, row.size)
+
+
+def release_on_commit(names, using):
+    """Release images once the transaction on `using` commits"""
+
+    names = [name for name in names if name]
+    if names:
+        transaction.on_commit(lambda: release(names), using=using)
+
+
+def _walk(storage, directory):
+    """Yield the name, size and mtime of every file below a storage directory, one directory at a time"""
+
+    stack = [storage.path(directory)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    name = os.path.relpath(entry.path, storage.location).replace(os.sep, '/')
+                    yield name, stat.st_size, stat.st_mtime
+
+
+def _collect_file(storage, name, cutoff):
+    """Delete an unreferenced file unless it was referenced or saved again since the scan, return whether it was"""
+
+    with transaction.atomic():
+        # The row lock makes a concurrent retain wait, the same as in release
+        row = StoredImage.objects.select_for_update().filter(name=name).first()
+        if row is not None and row.refs > 0:
+            return False
+        try:
+            if os.stat(storage.path(name)).st_mtime >= cutoff:
+                return False
+        except FileNotFoundError:
+            return False
+        storage.delete(name)
+        if row is not None:
+            row.delete()
+    return True
+
+
+def _collect_batch(storage, files, cutoff, stats, dry_run):
+    names = [name for name, _ in files]
+    referenced = set()
+    for alias in settings.DATABASE_SHARDS:
+        referenced.update(Recipe.objects.using(alias).filter(image__in=names).values_list('image', flat=True))
+    for name, size in files:
+        if name in referenced:
+            continue
+        if not dry_run and not _collect_file(storage, name, cutoff):
+            continue
+        stats['deleted'] += 1
+        stats['reclaimed'] += size
+
+
+def collect_orphans(grace_seconds, batch_size=1000, dry_run=False):
+    """Delete image files no recipe on any shard references, return scan statistics
+
+    Files modified within `grace_seconds` are kept, since the recipe referencing a
+    freshly saved file may not be committed yet. Each file is checked again under
+    its StoredImage row lock right before it is deleted.
+    """
+
+    storage = image_storage()
+    stats = {'scanned': 0, 'deleted': 0, 'reclaimed': 0}
+    if not os.path.isdir(storage.path(IMAGE_DIR)):
+        return stats
+    cutoff = time.time() - grace_seconds
+    batch = []
+    for name, size, mtime in _walk(storage, IMAGE_DIR):
+        stats['scanned'] += 1
+        if mtime < cutoff:
+            batch.append((name, size))
+        if len(batch) >= batch_size:
+            _collect_batch(storage, batch, cutoff, stats, dry_run)
+            batch = []
+    if batch:
+        _collect_batch(storage, batch, cutoff, stats, dry_run)
+    return stats
+
+
+def ingest(upload):
+    """Return a re-encoded copy of an uploaded image, upright and without metadata
+
+    Only the header is read before the size checks. JPEGs are decoded straight at a
+    reduced scale, so the pixels held in memory are bounded by RECIPE_IMAGE_MAX_DIMENSION,
+    or by RECIPE_IMAGE_MAX_PIXELS for formats that cannot be drafted.
+    """
+
+    if upload.size > settings.RECIPE_IMAGE_MAX_BYTES:
+        raise ValidationError(f'Images are limited to {settings.RECIPE_IMAGE_MAX_BYTES} bytes.')
+    max_side = settings.RECIPE_IMAGE_MAX_DIMENSION
+    upload.seek(0)
+    try:
+        with Image.open(upload) as image:
+            if image.format not in INGEST_FORMATS:
+                raise ValidationError('Upload a JPEG, PNG or WebP image.')
+            width, height = image.size
+            if width * height > settings.RECIPE_IMAGE_MAX_PIXELS:
+                raise ValidationError(f'Images are limited to {settings.RECIPE_IMAGE_MAX_PIXELS} pixels.')
+            image_format = image.format
+            icc_profile = image.info.get('icc_profile')
+            image.draft(image.mode, (max_side, max_side))
+            image.thumbnail((max_side, max_side))
+            # Rotating drops the orientation tag, and saving without `exif` drops the rest
+            image = ImageOps.exif_transpose(image)
+            out = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+            options = {'quality': 90} if image_format in ('JPEG', 'WEBP') else {}
+            image.save(out, format=image_format, icc_profile=icc_profile, **options)
+    except (OSError, SyntaxError, Image.DecompressionBombError):
+        raise ValidationError(
+            'Upload a valid image. The file you uploaded was either not an image or a corrupted image.'
+        )
+
+    out.seek(0)
+    name = f'{os.path.splitext(os.path.basename(upload.name or "image"))[0]}.{INGEST_FORMATS[image_format]}'
+    return File(out, name=name)
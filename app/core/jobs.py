@@ -0,0 +1,94 @@
+import logging
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from core import db_routers
+from core.models import Job
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+def job(name):
+    """Register a function as the handler of a job name, it gets the Job and returns its result"""
+
+    def decorator(func):
+        _handlers[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, user=None, max_attempts=3, **payload):
+    """Queue a job, in the caller's transaction so it only runs if the caller commits"""
+
+    if name not in _handlers:
+        raise ValueError(f'Unknown job "{name}"')
+    return Job.objects.create(name=name, user=user, payload=payload, max_attempts=max_attempts)
+
+
+def claim(limit):
+    """Mark up to `limit` due jobs as running for this worker and return them"""
+
+    now = timezone.now()
+    candidates = Job.objects.filter(status=Job.PENDING, run_at__lte=now).order_by('run_at')
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('id', flat=True)[:limit])
+        claimed = []
+        for pk in ids:
+            # Compare and set, so two workers never run the same job even without row locks
+            updated = Job.objects.filter(pk=pk, status=Job.PENDING).update(
+                status=Job.RUNNING, locked_at=now, attempts=F('attempts') + 1
+            )
+            if updated:
+                claimed.append(pk)
+    return claimed
+
+
+def requeue_stale():
+    """Put back jobs whose worker died while running them"""
+
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_STALE_SECONDS)
+    return Job.objects.filter(status=Job.RUNNING, locked_at__lt=cutoff).update(status=Job.PENDING, locked_at=None)
+
+
+def run(job_id):
+    """Run a claimed job, rescheduling it with exponential backoff when it fails"""
+
+    job = Job.objects.select_related('user').get(pk=job_id)
+    if job.user_id and db_routers.is_fenced(job.user_id):
+        # The user's rows are moving to another shard, run the job once they arrived
+        job.status = Job.PENDING
+        job.attempts -= 1
+        job.run_at = timezone.now() + timedelta(seconds=settings.DATABASE_MOVE_RETRY_AFTER)
+        job.locked_at = None
+        job.save(update_fields=['status', 'attempts', 'run_at', 'locked_at', 'updated_at'])
+        return job
+    shard_token = db_routers.use_shard(db_routers.shard_for_user(job.user)) if job.user else None
+    try:
+        result = _handlers[job.name](job)
+    except Exception:
+        job.error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = Job.FAILED
+            logger.exception('Job %s failed for good', job)
+        else:
+            job.status = Job.PENDING
+            backoff = settings.JOB_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+            job.run_at = timezone.now() + timedelta(seconds=backoff)
+            logger.warning('Job %s failed, retrying at %s', job, job.run_at)
+    else:
+        job.status = Job.SUCCEEDED
+        job.result = result
+        job.error = ''
+    finally:
+        if shard_token is not None:
+            db_routers.reset_shard(shard_token)
+    job.locked_at = None
+    job.save(update_fields=['status', 'result', 'error', 'run_at', 'locked_at', 'updated_at'])
+    return job
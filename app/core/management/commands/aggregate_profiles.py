@@ -0,0 +1,108 @@
+import glob
+import io
+import os
+import pstats
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+from core.profiling import endpoint_dir
+
+
+def _profile_dir(source):
+    directory = source if os.path.isdir(source) else endpoint_dir(source)
+    if not os.path.isdir(directory):
+        raise CommandError(f'No profiles for "{source}"')
+    return directory
+
+
+def _pstats_per_request(files):
+    """Return the cumulative milliseconds per request of every function in a set of pstats files"""
+
+    stats = pstats.Stats(*files, stream=io.StringIO())
+    return {
+        pstats.func_std_string(func): ct * 1000 / len(files)
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items()
+    }
+
+
+def _collapsed(files):
+    """Return the summed sample counts of every stack in a set of collapsed stack files"""
+
+    stacks = Counter()
+    for path in files:
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                stacks[stack] += int(count)
+    return stacks
+
+
+def _collapsed_share(stacks):
+    """Return the percentage of samples in which each frame is on the stack"""
+
+    total = sum(stacks.values()) or 1
+    frames = Counter()
+    for stack, count in stacks.items():
+        for frame in set(stack.split(';')):
+            frames[frame] += count
+    return {frame: count * 100 / total for frame, count in frames.items()}
+
+
+class Command(BaseCommand):
+    """Django command to aggregate and compare the request profiles of an endpoint"""
+
+    help = 'Aggregate the stored profiles of an endpoint, or compare them with a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('endpoint', help='url name like recipe:recipe-list, or a profile directory')
+        parser.add_argument('--baseline', help='endpoint or directory to compare against')
+        parser.add_argument('--top', type=int, default=25)
+        parser.add_argument('--sort', choices=('cumulative', 'tottime', 'ncalls'), default='cumulative')
+        parser.add_argument('--collapsed', metavar='FILE', help='write the merged collapsed stacks to FILE')
+
+    def handle(self, *args, **options):
+        directory = _profile_dir(options['endpoint'])
+        pstats_files = sorted(glob.glob(os.path.join(directory, '*.pstats')))
+        collapsed_files = sorted(glob.glob(os.path.join(directory, '*.collapsed')))
+        if not pstats_files and not collapsed_files:
+            raise CommandError(f'No profiles in {directory}')
+
+        if options['baseline']:
+            baseline = _profile_dir(options['baseline'])
+            if pstats_files:
+                self._diff(
+                    _pstats_per_request(glob.glob(os.path.join(baseline, '*.pstats'))),
+                    _pstats_per_request(pstats_files), 'ms per request', options['top'],
+                )
+            if collapsed_files:
+                self._diff(
+                    _collapsed_share(_collapsed(glob.glob(os.path.join(baseline, '*.collapsed')))),
+                    _collapsed_share(_collapsed(collapsed_files)), '% of samples', options['top'],
+                )
+            return
+
+        if pstats_files:
+            out = io.StringIO()
+            stats = pstats.Stats(*pstats_files, stream=out)
+            stats.sort_stats(options['sort']).print_stats(options['top'])
+            self.stdout.write(f'{len(pstats_files)} cProfile profiles')
+            self.stdout.write(out.getvalue())
+        if collapsed_files:
+            stacks = _collapsed(collapsed_files)
+            self.stdout.write(f'{len(collapsed_files)} sampled profiles, {sum(stacks.values())} samples')
+            for frame, share in sorted(_collapsed_share(stacks).items(), key=lambda item: -item[1])[:options['top']]:
+                self.stdout.write(f'{share:6.1f}%  {frame}')
+            if options['collapsed']:
+                with open(options['collapsed'], 'w') as f:
+                    for stack, count in stacks.items():
+                        f.write(f'{stack} {count}\n')
+
+    def _diff(self, baseline, current, unit, top):
+        if not baseline:
+            raise CommandError('The baseline has no profiles of the same kind')
+        deltas = [
+            (current.get(name, 0) - baseline.get(name, 0), name)
+            for name in set(baseline) | set(current)
+        ]
+        self.stdout.write(f'{"change":>10} {"baseline":>10} {"current":>10}  ({unit})')
+        for delta, name in sorted(deltas, key=lambda item: -abs(item[0]))[:top]:
+            self.stdout.write(f'{delta:+10.2f} {baseline.get(name, 0):10.2f} {current.get(name, 0):10.2f}  {name}')
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core import images
+
+
+class Command(BaseCommand):
+    """Django command to delete recipe image files no recipe references"""
+
+    help = 'Scan stored recipe images against every shard and delete unreferenced files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-seconds', type=int, default=settings.IMAGE_GC_GRACE_SECONDS)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        stats = images.collect_orphans(options['grace_seconds'], options['batch_size'], options['dry_run'])
+        action = 'would delete' if options['dry_run'] else 'deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'Scanned {stats["scanned"]} files, {action} {stats["deleted"]} orphans '
+            f'reclaiming {stats["reclaimed"]} bytes'
+        ))
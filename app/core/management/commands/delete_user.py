@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from core import deletion
+from core.models import User
+
+
+class Command(BaseCommand):
+    """Django command to delete a user and their data in bounded batches"""
+
+    help = 'Delete a user in chunks, reporting progress'
+
+    def add_arguments(self, parser):
+        parser.add_argument('email')
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        user = User.objects.using(DEFAULT_DB_ALIAS).filter(email=options['email']).first()
+        if user is None:
+            raise CommandError(f'No user with email "{options["email"]}"')
+
+        def progress(stage, count):
+            self.stdout.write(f'{stage}: {count} deleted')
+
+        deletion.delete_user(user, batch_size=options['batch_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {options["email"]}'))
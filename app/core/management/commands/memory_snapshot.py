@@ -0,0 +1,52 @@
+import os
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand, CommandError
+from core import memory
+
+
+class Command(BaseCommand):
+    """Django command to snapshot the allocations of a running worker and compare them with a baseline"""
+
+    help = 'Make a worker dump a tracemalloc snapshot, and report the allocation sites that grew per module'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pid', type=int, help='worker process, run with MEMORY_PROFILING_ENABLED')
+        parser.add_argument(
+            '--baseline', choices=('first', 'previous'), default='first',
+            help="compare with the worker's first snapshot or the one before this",
+        )
+        parser.add_argument('--top', type=int, default=20)
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def handle(self, *args, **options):
+        pid = options['pid']
+        known = set(memory.snapshot_files(pid))
+        try:
+            os.kill(pid, memory.SNAPSHOT_SIGNAL)
+        except ProcessLookupError:
+            raise CommandError(f'No process {pid}')
+
+        deadline = time.monotonic() + options['timeout']
+        while not set(memory.snapshot_files(pid)) - known:
+            if time.monotonic() > deadline:
+                raise CommandError(f'Process {pid} wrote no snapshot, is MEMORY_PROFILING_ENABLED set?')
+            time.sleep(0.1)
+
+        files = memory.snapshot_files(pid)
+        current = tracemalloc.Snapshot.load(files[-1])
+        baseline = None
+        if len(files) > 1:
+            baseline_path = files[0] if options['baseline'] == 'first' else files[-2]
+            baseline = tracemalloc.Snapshot.load(baseline_path)
+            self.stdout.write(f'Comparing {files[-1]} with {baseline_path}')
+        else:
+            self.stdout.write(f'First snapshot {files[-1]}, showing everything allocated')
+
+        report = memory.compare(current, baseline, options['top'])
+        self.stdout.write(f'{"change":>12} {"size":>12} {"blocks":>9}  module')
+        for row in report['modules']:
+            self.stdout.write(f'{row["size_diff"]:+12,} {row["size"]:12,} {row["count"]:9,}  {row["module"]}')
+        self.stdout.write(f'\n{"change":>12} {"size":>12}  line')
+        for row in report['lines']:
+            self.stdout.write(f'{row["size_diff"]:+12,} {row["size"]:12,}  {row["line"]}')
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from core.images import image_storage
+from core.models import Recipe
+from core.storage import CONTENT_ADDRESSED_NAME, content_addressed_name, file_sha256
+
+
+class Command(BaseCommand):
+    """Django command to move recipe images from uuid names to content addressed names"""
+
+    help = 'Rename recipe images to their content hash, deduplicating identical files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        storage = image_storage()
+        stats = {'moved': 0, 'deduplicated': 0, 'missing': 0}
+        for alias in settings.DATABASE_SHARDS:
+            recipes = Recipe.objects.using(alias).exclude(image='').exclude(image__isnull=True).order_by('id')
+            last_id = 0
+            while True:
+                batch = list(recipes.filter(id__gt=last_id).values_list('id', 'image')[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+                for recipe_id, name in batch:
+                    if CONTENT_ADDRESSED_NAME.match(name):
+                        continue
+                    if not storage.exists(name):
+                        self.stderr.write(f'recipe {recipe_id}: {name} is missing')
+                        stats['missing'] += 1
+                        continue
+                    with storage.open(name) as file:
+                        new_name = content_addressed_name(file_sha256(file), name.split('.')[-1])
+                        stats['deduplicated' if storage.exists(new_name) else 'moved'] += 1
+                        if options['dry_run']:
+                            continue
+                        storage.save(new_name, file)
+                    self._swap(alias, recipe_id, name, new_name)
+
+        prefix = 'Would have ' if options['dry_run'] else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}moved {stats["moved"]}, deduplicated {stats["deduplicated"]}, {stats["missing"]} missing'
+        ))
+
+    def _swap(self, alias, recipe_id, old_name, new_name):
+        """Point the recipe at the new name, the save signals count it and drop the old file"""
+
+        with transaction.atomic(using=alias):
+            recipe = Recipe.objects.using(alias).select_for_update().filter(pk=recipe_id).first()
+            if recipe is None or recipe.image.name != old_name:
+                return
+            recipe.image = new_name
+            recipe.save(update_fields=['image', 'updated_at'])
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from core import idempotency
+
+
+class Command(BaseCommand):
+    """Django command to delete expired idempotency keys"""
+
+    help = 'Delete idempotency keys and their stored responses once expired'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        deleted = idempotency.purge_expired(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency keys'))
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core import uploads
+
+
+class Command(BaseCommand):
+    """Django command to delete expired resumable upload sessions"""
+
+    help = 'Delete expired upload sessions and abandoned partial uploads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        sessions = sum(uploads.purge_expired(alias, options['batch_size']) for alias in settings.DATABASE_SHARDS)
+        reclaimed = uploads.purge_stale_parts()
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {sessions} expired sessions, reclaimed {reclaimed} bytes of abandoned parts'
+        ))
@@ -0,0 +1,104 @@
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from core import db_routers, catalogue
+from core.models import User, Tag, Ingredient, Recipe, Change, ChangeCounter, RecipePopularity, RecipeStats, \
+    RecipeStatsBucket, Job
+
+# Models copied to the new shard, in insertion order, with the lookup to their owner
+MOVED = (
+    (Tag, 'user'),
+    (Ingredient, 'user'),
+    (Recipe, 'user'),
+    (Recipe.tags.through, 'recipe__user'),
+    (Recipe.ingredients.through, 'recipe__user'),
+    (Change, 'user'),
+    (ChangeCounter, 'user'),
+    (RecipePopularity, 'user'),
+    (RecipeStats, 'user'),
+    (RecipeStatsBucket, 'user'),
+)
+
+
+def _batches(rows, size):
+    """Stream a queryset in lists of at most `size` objects"""
+
+    batch = []
+    for obj in rows.iterator(chunk_size=size):
+        batch.append(obj)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    """Django command to move a user's recipes, tags and ingredients to another shard"""
+
+    help = 'Move a user to another shard, keeping primary keys'
+
+    def add_arguments(self, parser):
+        parser.add_argument('email')
+        parser.add_argument('shard')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--drain-seconds', type=float, default=settings.REQUEST_DEADLINE_SECONDS,
+                            help='Time given to requests already writing when the fence goes up')
+
+    def handle(self, *args, **options):
+        target = options['shard']
+        batch_size = options['batch_size']
+        if target not in settings.DATABASE_SHARDS:
+            raise CommandError(f'Unknown shard "{target}"')
+        user = User.objects.using(DEFAULT_DB_ALIAS).filter(email=options['email']).first()
+        if user is None:
+            raise CommandError(f'No user with email "{options["email"]}"')
+
+        source = db_routers.shard_for_user(user)
+        if source == target:
+            self.stdout.write(f'{user} is already on {target}')
+            return
+
+        db_routers.fence_writes(user.pk)
+        try:
+            # Requests that passed the fence before it was set end within their deadline
+            time.sleep(options['drain_seconds'])
+            if Job.objects.filter(user=user, status=Job.RUNNING).exists():
+                raise CommandError(f'{user} has jobs running, retry once they finished')
+
+            copied = Counter()
+            with transaction.atomic(using=target):
+                for model, owner in MOVED:
+                    rows = model.objects.using(source).filter(**{owner: user}).order_by('pk')
+                    for batch in _batches(rows, batch_size):
+                        if model.objects.using(target).filter(pk__in=[obj.pk for obj in batch]).exists():
+                            raise CommandError(f'{model._meta.label} primary keys already used on {target}')
+                        if model in (Tag, Ingredient):
+                            # Names move to the catalogue of the target shard, under its ids
+                            ids = catalogue.canonical_ids({obj.name for obj in batch}, target)
+                            for obj in batch:
+                                obj.canonical_id = ids[obj.name]
+                        model.objects.using(target).bulk_create(batch)
+                        copied[model] += len(batch)
+
+            user.shard = target
+            user.save(using=DEFAULT_DB_ALIAS, update_fields=['shard'])
+            db_routers.forget_shard(user.pk)
+
+            # Raw deletes: the rows still exist on the target, so no delete signals must fire.
+            # Upload sessions are not moved, their clients start over.
+            with transaction.atomic(using=source), connections[source].cursor() as cursor:
+                recipe_ids = 'SELECT id FROM core_recipe WHERE user_id = %s'
+                cursor.execute(f'DELETE FROM core_recipe_tags WHERE recipe_id IN ({recipe_ids})', [user.pk])
+                cursor.execute(f'DELETE FROM core_recipe_ingredients WHERE recipe_id IN ({recipe_ids})', [user.pk])
+                tables = ('core_recipe', 'core_tag', 'core_ingredient', 'core_change', 'core_changecounter',
+                          'core_uploadsession', 'core_recipepopularity', 'core_recipestats', 'core_recipestatsbucket')
+                for table in tables:
+                    cursor.execute(f'DELETE FROM {table} WHERE user_id = %s', [user.pk])
+        finally:
+            db_routers.lift_fence(user.pk)
+
+        moved = ', '.join(f'{copied[model]} {model._meta.verbose_name_plural}' for model, _ in MOVED[:3])
+        self.stdout.write(self.style.SUCCESS(f'Moved {user} from {source} to {target} ({moved})'))
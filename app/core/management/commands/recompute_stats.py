@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from core import db_routers, stats
+from core.models import User, Recipe, RecipeStats
+
+
+class Command(BaseCommand):
+    """Django command to rebuild recipe statistics from the recipes"""
+
+    help = 'Recompute the recipe statistics of one user, or of every user with recipes or statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--email', default=None)
+
+    def handle(self, *args, **options):
+        if options['email']:
+            user = User.objects.using(DEFAULT_DB_ALIAS).filter(email=options['email']).first()
+            if user is None:
+                raise CommandError(f'No user with email "{options["email"]}"')
+            users = [(user.pk, db_routers.shard_for_user(user))]
+        else:
+            users = []
+            for alias in settings.DATABASE_SHARDS:
+                user_ids = set(Recipe.objects.using(alias).values_list('user_id', flat=True).distinct())
+                user_ids.update(RecipeStats.objects.using(alias).values_list('user_id', flat=True))
+                users.extend((user_id, alias) for user_id in sorted(user_ids))
+
+        recipes = sum(stats.recompute(user_id, alias) for user_id, alias in users)
+        self.stdout.write(self.style.SUCCESS(f'Recomputed statistics of {len(users)} users ({recipes} recipes)'))
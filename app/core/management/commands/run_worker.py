@@ -0,0 +1,65 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from django.core.management.base import BaseCommand
+from django.db import connections
+from core import jobs
+
+
+def _run_job(job_id):
+    """Run one job in a pool worker, releasing the worker's database connections afterwards"""
+
+    try:
+        return jobs.run(job_id).status
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    """Django command to run queued background jobs"""
+
+    help = 'Run queued background jobs with a pool of threads or processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--pool', choices=('thread', 'process'), default='thread')
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--burst', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency']
+        if options['pool'] == 'process':
+            # Children must not inherit the parent's sockets to the databases
+            connections.close_all()
+            pool = ProcessPoolExecutor(concurrency)
+        else:
+            pool = ThreadPoolExecutor(concurrency)
+
+        self.stdout.write(f'worker started with {concurrency} {options["pool"]}s')
+        running = set()
+        done_count = 0
+        requeued_at = 0
+        with pool:
+            while True:
+                if time.monotonic() - requeued_at > 60:
+                    jobs.requeue_stale()
+                    requeued_at = time.monotonic()
+                claimed = jobs.claim(concurrency - len(running)) if len(running) < concurrency else []
+                if options['pool'] == 'process':
+                    # Submitting may fork new children, close what claiming opened before it does
+                    connections.close_all()
+                running.update(pool.submit(_run_job, job_id) for job_id in claimed)
+
+                if not running:
+                    if options['burst']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                done, running = wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    done_count += 1
+                    try:
+                        self.stdout.write(f'job finished: {future.result()}')
+                    except Exception as exc:
+                        self.stderr.write(f'job crashed the pool worker: {exc!r}')
+
+        self.stdout.write(self.style.SUCCESS(f'worker stopped after {done_count} jobs'))
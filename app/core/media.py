@@ -0,0 +1,131 @@
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.http import http_date
+from core import db_routers
+from core.models import Recipe
+from core.storage import CONTENT_ADDRESSED_NAME
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Access is checked per user, so shared caches must not keep a copy
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class FileRange:
+    """Read at most `length` bytes of a file from its current position
+
+    Keeps `fileno` so the WSGI server's file wrapper can still sendfile the range,
+    bounded by the response Content-Length.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def can_access(user, name):
+    """Return whether the user may download the media file `name`"""
+
+    if name != posixpath.normpath(name) or name.startswith(('/', '../')):
+        return False
+    if user.is_staff:
+        return True
+    if name.startswith(f'exports/{user.pk}/'):
+        return True
+    using = db_routers.shard_for_user(user)
+    return Recipe.objects.using(using).filter(user=user, image=name).exists()
+
+
+def parse_range(header, size):
+    """Return the (start, end) byte positions of a single range request, None to send the whole file"""
+
+    match = RANGE_RE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        # Absent, malformed or multiple ranges: a full response is always allowed
+        return None
+    first, last = match.groups()
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise RangeNotSatisfiable
+    return start, end
+
+
+def serve(request, storage, name):
+    """Respond with a stored file, letting the front-end server send it when configured"""
+
+    path = storage.path(name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    match = CONTENT_ADDRESSED_NAME.match(name)
+    etag = f'"{match["digest"]}"' if match else f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponse(status=304)
+    elif settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(name)
+    elif settings.MEDIA_SENDFILE == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    else:
+        response = _file_response(request, path, stat.st_size, etag, content_type)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if match else REVALIDATE_CACHE_CONTROL
+    return response
+
+
+def _file_response(request, path, size, etag, content_type):
+    """Stream a file, or the requested byte range of it, without reading it into memory"""
+
+    header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        header = None
+    try:
+        byte_range = parse_range(header, size)
+    except RangeNotSatisfiable:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    file = open(path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        file.seek(start)
+        response = FileResponse(FileRange(file, end - start + 1), status=206, content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,160 @@
+import glob
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from functools import lru_cache
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from core import metrics
+
+# Sent by the memory_snapshot command, the worker answers with a snapshot file
+SNAPSHOT_SIGNAL = signal.SIGUSR2
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+_baseline = None
+
+
+def start():
+    """Trace allocations in this process from now on, with MEMORY_TRACE_FRAMES frames each"""
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(settings.MEMORY_TRACE_FRAMES)
+
+
+def stop():
+    global _baseline
+    tracemalloc.stop()
+    _baseline = None
+
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(_IGNORED)
+
+
+def set_baseline():
+    """Start tracing if needed and remember the current allocations as the baseline"""
+
+    global _baseline
+    start()
+    _baseline = take_snapshot()
+    return _baseline
+
+
+def get_baseline():
+    return _baseline
+
+
+@lru_cache(maxsize=4096)
+def module_name(filename):
+    """Return the dotted module name of a source file, or its path when it is outside sys.path"""
+
+    roots = [path for path in sys.path if path and filename.startswith(os.path.join(path, ''))]
+    if not roots:
+        return filename
+    relative = os.path.relpath(os.path.splitext(filename)[0], max(roots, key=len))
+    parts = relative.split(os.sep)
+    if parts[-1] == '__init__':
+        parts.pop()
+    return '.'.join(parts)
+
+
+def _by_module(snapshot):
+    totals = {}
+    for stat in snapshot.statistics('filename'):
+        module = module_name(stat.traceback[0].filename)
+        size, count = totals.get(module, (0, 0))
+        totals[module] = (size + stat.size, count + stat.count)
+    return totals
+
+
+def compare(current, baseline=None, limit=20):
+    """Return the modules and lines whose allocations grew the most since the baseline
+
+    Without a baseline, everything still allocated counts as growth.
+    """
+
+    now = _by_module(current)
+    before = _by_module(baseline) if baseline is not None else {}
+    modules = []
+    for module in set(now) | set(before):
+        size, count = now.get(module, (0, 0))
+        old_size, old_count = before.get(module, (0, 0))
+        modules.append({
+            'module': module, 'size': size, 'size_diff': size - old_size,
+            'count': count, 'count_diff': count - old_count,
+        })
+    modules.sort(key=lambda row: abs(row['size_diff']), reverse=True)
+
+    stats = current.compare_to(baseline, 'lineno') if baseline is not None else current.statistics('lineno')
+    lines = [
+        {
+            'module': module_name(stat.traceback[0].filename),
+            'line': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+            'size': stat.size,
+            'size_diff': getattr(stat, 'size_diff', stat.size),
+            'count': stat.count,
+        }
+        for stat in stats[:limit]
+    ]
+    return {'modules': modules[:limit], 'lines': lines}
+
+
+def snapshot_files(pid):
+    """Return the snapshot files dumped by process `pid`, oldest first"""
+
+    return sorted(glob.glob(os.path.join(settings.MEMORY_SNAPSHOT_DIR, f'{pid}-*.tracemalloc')))
+
+
+def dump_snapshot(*args):
+    """Dump a snapshot of this process to MEMORY_SNAPSHOT_DIR, as a signal handler or directly"""
+
+    if not tracemalloc.is_tracing():
+        return None
+    os.makedirs(settings.MEMORY_SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(settings.MEMORY_SNAPSHOT_DIR, f'{os.getpid()}-{time.time():.6f}.tracemalloc')
+    take_snapshot().dump(f'{path}.tmp')
+    # Readers never see a partly written snapshot
+    os.replace(f'{path}.tmp', path)
+    return path
+
+
+class MemoryMiddleware:
+    """Trace allocations and record the peak of a MEMORY_SAMPLE_RATE sample of requests per route
+
+    Tracing starts with the worker and costs memory and time on every allocation,
+    so it is off unless MEMORY_PROFILING_ENABLED. The peak is per process, so in a
+    threaded worker it includes the allocations of concurrent requests.
+    """
+
+    def __init__(self, get_response):
+        if not settings.MEMORY_PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        start()
+        # Handlers can only be installed from the main thread
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(SNAPSHOT_SIGNAL, dump_snapshot)
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not tracemalloc.is_tracing() or random.random() >= settings.MEMORY_SAMPLE_RATE:
+            return self.get_response(request)
+
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        response = self.get_response(request)
+        _, peak = tracemalloc.get_traced_memory()
+        match = getattr(request, 'resolver_match', None)
+        metrics.observe(
+            'http_request_peak_alloc_bytes', max(peak - before, 0), buckets=settings.MEMORY_PEAK_BUCKETS,
+            route=match.view_name if match else 'unresolved',
+        )
+        return response
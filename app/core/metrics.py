@@ -0,0 +1,299 @@
+import atexit
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+ARCHIVE = 'archive.json'
+
+_lock = threading.Lock()
+# Each thread counts into its own store, so counting takes no lock
+_local = threading.local()
+_stores = []
+_written_at = 0.0
+
+
+class _Store:
+    __slots__ = ('counters', 'gauges', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+
+def _store():
+    try:
+        return _local.store
+    except AttributeError:
+        store = _local.store = _Store()
+        with _lock:
+            _stores.append(store)
+        return store
+
+
+def _after_fork():
+    """Start a forked worker from zero, the parent's counts are its own"""
+
+    global _local, _written_at
+    _local = threading.local()
+    _stores.clear()
+    _written_at = 0.0
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """Add to the counter `name` with the given labels"""
+
+    counters = _store().counters
+    key = _key(name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+
+def add(name, amount, **labels):
+    """Add to the gauge `name`, which may go down"""
+
+    gauges = _store().gauges
+    key = _key(name, labels)
+    gauges[key] = gauges.get(key, 0) + amount
+
+
+def observe(name, value, buckets=None, **labels):
+    """Count `value` in the histogram `name`, with the `buckets` upper bounds or METRICS_BUCKETS"""
+
+    histograms = _store().histograms
+    key = _key(name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+        bounds = tuple(buckets or settings.METRICS_BUCKETS)
+        histogram = histograms[key] = [bounds, [0] * (len(bounds) + 1), 0.0, 0]
+    histogram[1][bisect_left(histogram[0], value)] += 1
+    histogram[2] += value
+    histogram[3] += 1
+
+
+def snapshot():
+    """Return the counters of this process as {(name, ((label, value), ...)): value}"""
+
+    return _local_state()['counters']
+
+
+def _merge(into, state, gauges=True):
+    for kind in ('counters', 'gauges') if gauges else ('counters',):
+        for key, value in state[kind].items():
+            into[kind][key] = into[kind].get(key, 0) + value
+    for key, (bounds, counts, total, count) in state['histograms'].items():
+        merged = into['histograms'].get(key)
+        if merged is None or merged[0] != bounds:
+            into['histograms'][key] = [bounds, list(counts), total, count]
+        else:
+            merged[1] = [a + b for a, b in zip(merged[1], counts)]
+            merged[2] += total
+            merged[3] += count
+
+
+def _empty():
+    return {'counters': {}, 'gauges': {}, 'histograms': {}}
+
+
+def _local_state():
+    with _lock:
+        stores = list(_stores)
+    state = _empty()
+    for store in stores:
+        # Copies are atomic under the GIL, the owning thread may be counting meanwhile
+        _merge(state, {
+            'counters': store.counters.copy(),
+            'gauges': store.gauges.copy(),
+            'histograms': {
+                key: (bounds, list(counts), total, count)
+                for key, (bounds, counts, total, count) in store.histograms.copy().items()
+            },
+        })
+    return state
+
+
+def _dump(state, path):
+    data = {
+        'counters': [[name, labels, value] for (name, labels), value in state['counters'].items()],
+        'gauges': [[name, labels, value] for (name, labels), value in state['gauges'].items()],
+        'histograms': [
+            [name, labels, bounds, counts, total, count]
+            for (name, labels), (bounds, counts, total, count) in state['histograms'].items()
+        ],
+    }
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _load(path):
+    with open(path) as f:
+        data = json.load(f)
+
+    def key(name, labels):
+        return name, tuple(tuple(label) for label in labels)
+
+    return {
+        'counters': {key(name, labels): value for name, labels, value in data['counters']},
+        'gauges': {key(name, labels): value for name, labels, value in data['gauges']},
+        'histograms': {
+            key(name, labels): (tuple(bounds), counts, total, count)
+            for name, labels, bounds, counts, total, count in data['histograms']
+        },
+    }
+
+
+def write():
+    """Write this process' metrics to METRICS_DIR, for the process answering the next scrape"""
+
+    global _written_at
+    directory = settings.METRICS_DIR
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    _dump(_local_state(), os.path.join(directory, f'{os.getpid()}.json'))
+    _written_at = time.monotonic()
+
+
+def maybe_write():
+    if time.monotonic() - _written_at >= settings.METRICS_WRITE_SECONDS:
+        write()
+
+
+atexit.register(write)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect():
+    """Return the metrics of every worker process on the host, merged
+
+    Processes write their metrics at most every METRICS_WRITE_SECONDS, the one
+    answering the scrape just before reading. Counters and histograms of exited
+    processes are folded into an archive file, their gauges are dropped.
+    """
+
+    directory = settings.METRICS_DIR
+    if not directory:
+        return _local_state()
+    write()
+    state = _empty()
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        # Serializes archiving between processes answering scrapes at once
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(directory, ARCHIVE)
+        archive = _load(archive_path) if os.path.exists(archive_path) else _empty()
+        archived = []
+        for path in glob.glob(os.path.join(directory, '[0-9]*.json')):
+            try:
+                process = _load(path)
+            except FileNotFoundError:
+                continue
+            if _alive(int(os.path.basename(path).split('.')[0])):
+                _merge(state, process)
+            else:
+                _merge(archive, process, gauges=False)
+                archived.append(path)
+        if archived:
+            _dump(archive, archive_path)
+            for path in archived:
+                os.remove(path)
+    _merge(state, archive)
+    return state
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')) for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(state):
+    """Return metrics in the Prometheus text exposition format"""
+
+    series = {}
+    for kind, type_name in (('counters', 'counter'), ('gauges', 'gauge')):
+        for (name, labels), value in sorted(state[kind].items()):
+            series.setdefault((name, type_name), []).append(f'{name}{_labels(labels)} {_number(value)}')
+    for (name, labels), (bounds, counts, total, count) in sorted(state['histograms'].items()):
+        lines = series.setdefault((name, 'histogram'), [])
+        cumulative = 0
+        for bound, bucket in zip(list(bounds) + ['+Inf'], counts):
+            cumulative += bucket
+            lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {_number(total)}')
+        lines.append(f'{name}_count{_labels(labels)} {count}')
+
+    out = []
+    for (name, type_name), lines in sorted(series.items()):
+        out.append(f'# TYPE {name} {type_name}')
+        out.extend(lines)
+    return '\n'.join(out) + '\n'
+
+
+def _time_query(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        alias = context['connection'].alias
+        inc('db_queries_total', alias=alias)
+        inc('db_query_seconds_total', time.perf_counter() - start, alias=alias)
+
+
+class MetricsMiddleware:
+    """Count requests in flight, their latency per route name and the queries they run"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        add('http_requests_in_flight', 1)
+        start = time.perf_counter()
+        status = 500
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(_time_query))
+                response = self.get_response(request)
+            status = response.status_code
+            return response
+        finally:
+            add('http_requests_in_flight', -1)
+            match = getattr(request, 'resolver_match', None)
+            # Unresolved paths share one series, so scanners cannot add series at will
+            route = match.view_name if match else 'unresolved'
+            observe('http_request_duration_seconds', time.perf_counter() - start, route=route, method=request.method)
+            inc('http_requests_total', route=route, method=request.method, status=str(status))
+            maybe_write()
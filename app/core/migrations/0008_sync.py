@@ -0,0 +1,87 @@
+# Generated by Django 3.2.25 on 2026-10-19 08:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def record_existing_objects(apps, schema_editor):
+    """Give every existing object a change, so a sync from scratch returns it"""
+
+    alias = schema_editor.connection.alias
+    Change = apps.get_model('core', 'Change')
+    ChangeCounter = apps.get_model('core', 'ChangeCounter')
+    counters = {}
+    for model_name in ('tag', 'ingredient', 'recipe'):
+        model = apps.get_model('core', model_name)
+        rows = model.objects.using(alias).order_by('pk').values_list('pk', 'user_id')
+        last_pk = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk)[:1000])
+            if not batch:
+                break
+            changes = []
+            for pk, user_id in batch:
+                counters[user_id] = counters.get(user_id, 0) + 1
+                changes.append(Change(user_id=user_id, seq=counters[user_id], kind=model_name, object_id=pk))
+            Change.objects.using(alias).bulk_create(changes)
+            last_pk = batch[-1][0]
+    ChangeCounter.objects.using(alias).bulk_create(
+        [ChangeCounter(user_id=user_id, seq=seq) for user_id, seq in counters.items()], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeCounter',
+            fields=[
+                ('user', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='core.user')),
+                ('seq', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ingredient',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.BigIntegerField()),
+                ('kind', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['user', 'seq'], name='core_change_user_id_b07c4f_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='change',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='unique_change_per_object'),
+        ),
+        migrations.RunPython(record_existing_objects, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-19 08:12
+
+from django.db import migrations, models
+
+# Admin prefix search runs UPPER(column) LIKE 'X%', which needs a pattern_ops expression index
+PREFIX_INDEXES = (
+    ('core_tag_name_prefix_idx', 'core_tag', 'name'),
+    ('core_ingredient_name_prefix_idx', 'core_ingredient', 'name'),
+    ('core_recipe_title_prefix_idx', 'core_recipe', 'title'),
+)
+
+
+def create_prefix_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table, column in PREFIX_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} ((UPPER({column}::text)) text_pattern_ops)'
+        )
+
+
+def drop_prefix_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _, _ in PREFIX_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_sync'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ingredient',
+            index=models.Index(fields=['user', 'name'], name='core_ingred_user_id_b96ee8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['user', 'name'], name='core_tag_user_id_74e398_idx'),
+        ),
+        migrations.RunPython(create_prefix_indexes, drop_prefix_indexes),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-19 08:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_upload_session'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipePopularity',
+            fields=[
+                ('recipe', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='popularity', serialize=False, to='core.recipe')),
+                ('views', models.BigIntegerField(default=0)),
+                ('cooks', models.BigIntegerField(default=0)),
+                ('score', models.FloatField(default=-1000000.0)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='recipepopularity',
+            index=models.Index(fields=['user', '-score'], name='core_recipe_user_id_435fa2_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:40
+
+from django.db import migrations
+
+# Autocomplete falls back to the database for users with too many names to keep in
+# memory. Prefixes use the indexes of 0009, names one typo away need trigrams.
+TRIGRAM_INDEXES = (
+    ('core_tag_name_trgm_idx', 'core_tag'),
+    ('core_ingredient_name_trgm_idx', 'core_ingredient'),
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ((UPPER(name::text)) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _ in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_canonical_names'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations, DEFAULT_DB_ALIAS
+
+
+def assign_shards(apps, schema_editor):
+    """Save the shard consistent hashing placed each user on, before any shard is added"""
+
+    if schema_editor.connection.alias != DEFAULT_DB_ALIAS:
+        return
+    from core.db_routers import ring_shard
+    User = apps.get_model('core', 'User')
+    users = User.objects.using(DEFAULT_DB_ALIAS).filter(shard='').order_by('pk').values_list('pk', flat=True)
+    last_pk = 0
+    while True:
+        batch = list(users.filter(pk__gt=last_pk)[:1000])
+        if not batch:
+            return
+        last_pk = batch[-1]
+        by_shard = {}
+        for pk in batch:
+            by_shard.setdefault(ring_shard(pk), []).append(pk)
+        for shard, pks in by_shard.items():
+            User.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=pks).update(shard=shard)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_recipe_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(assign_shards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+BATCH_SIZE = 1000
+
+
+def link_spellings(apps, schema_editor):
+    """Point every tag and ingredient at the catalogue entry of its exact name, in the catalogue of its own shard"""
+
+    alias = schema_editor.connection.alias
+    CanonicalName = apps.get_model('core', 'CanonicalName')
+    catalogue = CanonicalName.objects.using(alias)
+    for model_name in ('Tag', 'Ingredient'):
+        model = apps.get_model('core', model_name)
+        rows = model.objects.using(alias).order_by('id').values_list('id', 'name')
+        last_id = 0
+        while True:
+            batch = list(rows.filter(id__gt=last_id)[:BATCH_SIZE])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            names = {name for _, name in batch}
+            catalogue.bulk_create([CanonicalName(name=name) for name in sorted(names)], ignore_conflicts=True)
+            ids = dict(catalogue.filter(name__in=names).values_list('name', 'id'))
+            by_canonical = {}
+            for pk, name in batch:
+                by_canonical.setdefault(ids[name], []).append(pk)
+            # updated_at is left alone so clients do not resync
+            for canonical_id, pks in by_canonical.items():
+                model.objects.using(alias).filter(id__in=pks).update(canonical_id=canonical_id)
+
+    # Case folded entries of the default database nothing points at any more
+    Tag = apps.get_model('core', 'Tag')
+    Ingredient = apps.get_model('core', 'Ingredient')
+    catalogue.exclude(id__in=Tag.objects.using(alias).values('canonical_id')).exclude(
+        id__in=Ingredient.objects.using(alias).values('canonical_id')
+    ).delete()
+
+
+def copy_names_back(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    CanonicalName = apps.get_model('core', 'CanonicalName')
+    name = CanonicalName.objects.using(alias).filter(id=OuterRef('canonical_id')).values('name')[:1]
+    for model_name in ('Tag', 'Ingredient'):
+        apps.get_model('core', model_name).objects.using(alias).update(name=Subquery(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_user_shard_backfill'),
+    ]
+
+    operations = [
+        migrations.RunPython(link_spellings, copy_names_back),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Names are now only in the catalogue, which gets the prefix and trigram indexes 0009 and 0015
+# put on the name columns of tags and ingredients. Those went away with the columns.
+CATALOGUE_PREFIX_INDEX = 'core_canonicalname_name_prefix_idx'
+CATALOGUE_TRIGRAM_INDEX = 'core_canonicalname_name_trgm_idx'
+
+
+def create_catalogue_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {CATALOGUE_PREFIX_INDEX} ON core_canonicalname '
+        f'((UPPER(name::text)) text_pattern_ops)'
+    )
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {CATALOGUE_TRIGRAM_INDEX} ON core_canonicalname '
+        f'USING gin ((UPPER(name::text)) gin_trgm_ops)'
+    )
+
+
+def drop_catalogue_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name in (CATALOGUE_PREFIX_INDEX, CATALOGUE_TRIGRAM_INDEX):
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_catalogue_spellings'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='ingredient',
+            name='core_ingred_user_id_b96ee8_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='tag',
+            name='core_tag_user_id_74e398_idx',
+        ),
+        # Gives the columns a default to be added back with when reversed
+        migrations.AlterField(
+            model_name='ingredient',
+            name='name',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='name',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.RemoveField(
+            model_name='ingredient',
+            name='name',
+        ),
+        migrations.RemoveField(
+            model_name='tag',
+            name='name',
+        ),
+        migrations.AlterField(
+            model_name='ingredient',
+            name='canonical',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.canonicalname'),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='canonical',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.canonicalname'),
+        ),
+        migrations.AddIndex(
+            model_name='ingredient',
+            index=models.Index(fields=['user', 'canonical'], name='core_ingred_user_id_38b4ec_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['user', 'canonical'], name='core_tag_user_id_c27f93_idx'),
+        ),
+        migrations.RunPython(create_catalogue_indexes, drop_catalogue_indexes),
+    ]
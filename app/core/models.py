@@ -1,17 +1,18 @@
-import uuid
-import os
-from django.db import models
+from django.db import models, router, transaction
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.core.exceptions import ValidationError
 from django.conf import settings
+from django.utils import timezone
+import os
+import uuid
+from .storage import ContentAddressedStorage
 
 
 def recipe_image_file_path(instance, file_name):
-    """Generate file path for new recipe image"""
+    """Generate file path for new recipe image, the storage renames it to the hash of its content"""
 
-    ext = file_name.split('.')[-1]
-    file_name = f'{uuid.uuid4()}.{ext}'
-    return os.path.join('uploads/recipe/', file_name)
+    ext = file_name.split('.')[-1].lower()
+    return os.path.join('uploads/recipe/', f'upload.{ext}')
 
 
 class UserManager(BaseUserManager):
@@ -22,7 +23,13 @@ class UserManager(BaseUserManager):
             raise ValidationError('user must be have email address')
         user = self.model(email=self.normalize_email(email), **extra_fields)
         user.set_password(password)
-        user.save(using=self._db)
+        with transaction.atomic(using=self._db):
+            user.save(using=self._db)
+            if not user.shard:
+                # The ring picks from the user id, and changes when shards are added, so the choice is kept
+                from core.db_routers import ring_shard
+                user.shard = ring_shard(user.pk)
+                user.save(using=self._db, update_fields=['shard'])
 
         return user
 
@@ -41,6 +48,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     name = models.CharField(max_length=200)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
+    shard = models.CharField(max_length=64, blank=True)
     objects = UserManager()
 
     USERNAME_FIELD = 'email'
@@ -49,19 +57,63 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.email
 
 
-class Tag(models.Model):
+class CanonicalName(models.Model):
+    """Tag or ingredient name stored once per shard, shared by every row spelling it, see core.catalogue"""
+    name = models.CharField(max_length=255, unique=True)
+
+    def __str__(self):
+        return self.name
+
+
+class CatalogueNamedManager(models.Manager):
+    """Join the catalogue entry, so reading names costs no query per row"""
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('canonical')
+
+
+class CatalogueNamed:
+    """Tag or ingredient whose name lives in the catalogue of its shard, query it as `canonical__name`
+
+    A name set on the object is linked to its catalogue entry when saved.
+    """
+
+    new_name = None
+
+    @property
+    def name(self):
+        if self.new_name is not None:
+            return self.new_name
+        return self.canonical.name if self.canonical_id else ''
+
+    @name.setter
+    def name(self, value):
+        self.new_name = value
+
+
+class Tag(CatalogueNamed, models.Model):
     """Tag to be used for a recipe"""
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    name = models.CharField(max_length=255)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_constraint=False)
+    canonical = models.ForeignKey(CanonicalName, on_delete=models.PROTECT, related_name='+')
+    updated_at = models.DateTimeField(auto_now=True)
+    objects = CatalogueNamedManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'canonical'])]
 
     def __str__(self):
         return self.name
 
 
-class Ingredient(models.Model):
+class Ingredient(CatalogueNamed, models.Model):
     """Ingredient to be used in recipe"""
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    name = models.CharField(max_length=255)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_constraint=False)
+    canonical = models.ForeignKey(CanonicalName, on_delete=models.PROTECT, related_name='+')
+    updated_at = models.DateTimeField(auto_now=True)
+    objects = CatalogueNamedManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'canonical'])]
 
     def __str__(self):
         return self.name
@@ -69,14 +121,209 @@ class Ingredient(models.Model):
 
 class Recipe(models.Model):
     """Recipe object"""
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_constraint=False)
     title = models.CharField(max_length=255)
     time_minutes = models.IntegerField()
     price = models.DecimalField(max_digits=5, decimal_places=2)
     link = models.CharField(max_length=255, blank=True)
     ingredients = models.ManyToManyField('Ingredient')
     tags = models.ManyToManyField('Tag')
-    image = models.ImageField(null=True, upload_to=recipe_image_file_path)
+    image = models.ImageField(null=True, upload_to=recipe_image_file_path, storage=ContentAddressedStorage())
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.title
+
+    def save(self, *args, **kwargs):
+        """Save in a transaction, in which the statistics signals lock the row to read what the save replaces"""
+
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the stored image name, so a save can release the replaced file"""
+
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_image = instance.stored_image_name()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        if fields is None or 'image' in fields:
+            self._loaded_image = self.stored_image_name()
+
+    def stored_image_name(self):
+        """Return the image name without opening the file, None when there is none"""
+
+        value = self.__dict__.get('image')
+        return getattr(value, 'name', value) or None
+
+
+class RecipePopularity(models.Model):
+    """View and cook counts of a recipe, with a time decayed trending score
+
+    `score` is the log of the sum of the recipe's event weights, each scaled up by
+    its age, so ordering by it ranks recipes by their decayed popularity at any time.
+    """
+    recipe = models.OneToOneField(
+        Recipe, on_delete=models.CASCADE, primary_key=True, related_name='popularity', db_constraint=False
+    )
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_constraint=False)
+    views = models.BigIntegerField(default=0)
+    cooks = models.BigIntegerField(default=0)
+    # Far below any event, so adding the first one yields that event's score
+    score = models.FloatField(default=-1e6)
+
+    class Meta:
+        indexes = [models.Index(fields=['user', '-score'])]
+
+
+class RecipeStats(models.Model):
+    """Running totals of a user's recipes, updated with every write
+
+    Its row also serializes the updates of a user's statistics, as the first
+    thing they touch.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, db_constraint=False
+    )
+    count = models.BigIntegerField(default=0)
+    price_total = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    time_total = models.BigIntegerField(default=0)
+
+
+class RecipeStatsBucket(models.Model):
+    """Number of a user's recipes in a price or cooking time bucket, or with a tag or ingredient"""
+    PRICE = 'price'
+    TIME = 'time'
+    TAG = 'tag'
+    INGREDIENT = 'ingredient'
+    KIND_CHOICES = (
+        (PRICE, 'Price'),
+        (TIME, 'Cooking time'),
+        (TAG, 'Tag'),
+        (INGREDIENT, 'Ingredient'),
+    )
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_constraint=False)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # Bucket number for prices and times, tag or ingredient id otherwise
+    key = models.BigIntegerField()
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'kind', 'key'], name='unique_recipe_stats_bucket'),
+        ]
+
+
+class UploadSession(models.Model):
+    """Resumable upload of a recipe image, received in byte ranges"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_constraint=False)
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, db_constraint=False)
+    size = models.PositiveBigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    offset = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class StoredImage(models.Model):
+    """Reference count of a content addressed image file shared by recipes"""
+    name = models.CharField(max_length=255, primary_key=True)
+    refs = models.PositiveIntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ChangeCounter(models.Model):
+    """Per user sequence numbering the user's changes"""
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, db_constraint=False
+    )
+    seq = models.BigIntegerField(default=0)
+
+
+class Change(models.Model):
+    """Latest change of a user owned object, read by the sync endpoint"""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_constraint=False)
+    seq = models.BigIntegerField()
+    kind = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    deleted = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'seq'])]
+        constraints = [models.UniqueConstraint(fields=['kind', 'object_id'], name='unique_change_per_object')]
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id} @{self.seq}'
+
+
+class IdempotencyKey(models.Model):
+    """Response of a write request, replayed to retries sending the same Idempotency-Key"""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True)
+    # Hash of the address of an anonymous client, whose keys are only its own
+    client = models.CharField(max_length=64, blank=True)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    # Null while the first request is in flight
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    content_type = models.CharField(max_length=255, blank=True)
+    headers = models.JSONField(default=dict, blank=True)
+    content = models.BinaryField(default=bytes)
+    locked_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key_per_user'),
+            models.UniqueConstraint(
+                fields=['client', 'key'], condition=models.Q(user__isnull=True),
+                name='unique_idempotency_key_per_client',
+            ),
+        ]
+
+    def __str__(self):
+        return self.key
+
+
+class Job(models.Model):
+    """Background job run by the `run_worker` command"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True)
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at'])]
+
+    def __str__(self):
+        return f'{self.name} #{self.pk}'
@@ -0,0 +1,157 @@
+import atexit
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Abs, Exp, Greatest, Ln
+from core.models import Recipe, RecipePopularity
+
+logger = logging.getLogger(__name__)
+
+VIEW_WEIGHT = 1
+COOK_WEIGHT = 5
+# Scores count time from here, which keeps them small
+EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc).timestamp()
+# exp() of anything lower underflows, which PostgreSQL reports as an error
+MIN_EXPONENT = -700.0
+
+
+def event_score(weight, at=None):
+    """Return the log space score of an event of `weight` happening at timestamp `at`"""
+
+    at = time.time() if at is None else at
+    return math.log(weight) + (at - EPOCH) * math.log(2) / settings.TRENDING_HALF_LIFE_SECONDS
+
+
+def logaddexp(a, b):
+    """Return log(exp(a) + exp(b)) without overflowing"""
+
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(max(low - high, MIN_EXPONENT)))
+
+
+def _add_score(score):
+    """Return an update expression adding an event score to the `score` column, in log space"""
+
+    value = Value(score, output_field=FloatField())
+    exponent = Greatest(-Abs(F('score') - value), Value(MIN_EXPONENT, output_field=FloatField()))
+    return Greatest(F('score'), value) + Ln(Value(1.0, output_field=FloatField()) + Exp(exponent))
+
+
+class PopularityCounter:
+    """Coalesce recipe view and cook events in process, and write them in batches
+
+    Events for the same recipe are summed in memory. A background thread writes
+    them every POPULARITY_FLUSH_SECONDS, as soon as POPULARITY_FLUSH_SIZE recipes
+    are pending, and when the process exits. No request waits for the writes or
+    runs them inside its deadline.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._wake = threading.Event()
+        self._flusher_pid = None
+
+    def record(self, using, recipe_id, views=0, cooks=0, at=None):
+        """Count views and cooks of a recipe stored on database `using`"""
+
+        weight = views * VIEW_WEIGHT + cooks * COOK_WEIGHT
+        if weight <= 0:
+            return
+        score = event_score(weight, at)
+        with self._lock:
+            key = (using, recipe_id)
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = [views, cooks, score]
+            else:
+                pending[0] += views
+                pending[1] += cooks
+                pending[2] = logaddexp(pending[2], score)
+            full = len(self._pending) >= settings.POPULARITY_FLUSH_SIZE
+        self._start_flusher()
+        if full:
+            self._wake.set()
+
+    def _start_flusher(self):
+        """Start the flushing thread, again in a worker forked from a process that had one"""
+
+        pid = os.getpid()
+        if self._flusher_pid == pid:
+            return
+        with self._lock:
+            if self._flusher_pid == pid:
+                return
+            self._flusher_pid = pid
+        threading.Thread(target=self._run_flusher, name='popularity-flusher', daemon=True).start()
+
+    def _run_flusher(self):
+        while True:
+            self._wake.wait(settings.POPULARITY_FLUSH_SECONDS)
+            self._wake.clear()
+            try:
+                self.flush()
+            finally:
+                # The thread has its own connections, which would otherwise stay open while it sleeps
+                connections.close_all()
+
+    def flush(self, exc_info=True):
+        """Write the pending counts, return how many recipes were updated"""
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        by_alias = {}
+        for (using, recipe_id), counts in pending.items():
+            by_alias.setdefault(using, {})[recipe_id] = counts
+        updated = 0
+        for using, counts in by_alias.items():
+            try:
+                updated += self._write(using, counts)
+            except Exception:
+                # Counts are approximate, losing a batch must not fail the request cycle that flushed it
+                logger.error('Dropped popularity counts of %d recipes on %s', len(counts), using, exc_info=exc_info)
+        return updated
+
+    def _write(self, using, counts):
+        with transaction.atomic(using=using):
+            # Recipes may have been deleted since they were counted
+            owners = dict(Recipe.objects.using(using).filter(id__in=counts).values_list('id', 'user_id'))
+            # A fixed order keeps concurrent flushes from deadlocking
+            recipe_ids = sorted(owners)
+            RecipePopularity.objects.using(using).bulk_create(
+                [RecipePopularity(recipe_id=recipe_id, user_id=owners[recipe_id]) for recipe_id in recipe_ids],
+                ignore_conflicts=True,
+            )
+            for recipe_id in recipe_ids:
+                views, cooks, score = counts[recipe_id]
+                RecipePopularity.objects.using(using).filter(recipe_id=recipe_id).update(
+                    views=F('views') + views, cooks=F('cooks') + cooks, score=_add_score(score)
+                )
+        return len(owners)
+
+
+counter = PopularityCounter()
+# At exit the database may be gone already, a failure is not worth a traceback
+atexit.register(counter.flush, exc_info=False)
+
+
+def record_view(using, recipe_id):
+    counter.record(using, recipe_id, views=1)
+
+
+def record_cook(using, recipe_id):
+    counter.record(using, recipe_id, cooks=1)
+
+
+def trending(user, limit):
+    """Return the ids of the user's most popular recipes, read in order from the score index"""
+
+    return list(
+        RecipePopularity.objects.filter(user=user).order_by('-score').values_list('recipe_id', flat=True)[:limit]
+    )
@@ -0,0 +1,123 @@
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from rest_framework.authtoken.models import Token
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+
+def endpoint_dir(endpoint):
+    """Return the directory holding the profiles of an endpoint, named by its url name"""
+
+    return os.path.join(settings.PROFILING_DIR, endpoint.replace(':', '.'))
+
+
+def _frame_name(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    """Sample the stack of one thread from a background thread, counting collapsed stacks"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def write(self, path):
+        """Write the stacks in the collapsed format flamegraph.pl and speedscope read"""
+
+        with open(path, 'w') as f:
+            for stack, count in self.counts.items():
+                f.write(f'{stack} {count}\n')
+
+
+def _prune(directory, keep):
+    """Delete the oldest profiles of a directory past `keep`"""
+
+    entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+    for entry in entries[:max(len(entries) - keep, 0)]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            # Pruned by another process
+            pass
+
+
+class ProfilingMiddleware:
+    """Profile requests from staff sending X-Profile, and a PROFILING_SAMPLE_RATE sample of all requests
+
+    Profiles are stored per endpoint under PROFILING_DIR, as pstats with cProfile or
+    collapsed stacks with the stack sampler (PROFILING_MODE), and read with the
+    aggregate_profiles command. Without PROFILING_ENABLED the middleware is left out
+    of the chain altogether.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def _requested_by_staff(self, request):
+        if not request.META.get(PROFILE_HEADER):
+            return False
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return user.is_staff
+        # API clients authenticate with tokens, which DRF only checks in the view
+        keyword, _, key = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if keyword != 'Token' or not key:
+            return False
+        return Token.objects.filter(key=key, user__is_staff=True, user__is_active=True).exists()
+
+    def __call__(self, request):
+        if not (random.random() < settings.PROFILING_SAMPLE_RATE or self._requested_by_staff(request)):
+            return self.get_response(request)
+
+        if settings.PROFILING_MODE == 'sample':
+            profiler = StackSampler(settings.PROFILING_SAMPLE_INTERVAL)
+            profiler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.stop()
+        else:
+            profiler = cProfile.Profile()
+            response = profiler.runcall(self.get_response, request)
+
+        match = getattr(request, 'resolver_match', None)
+        directory = endpoint_dir(match.view_name if match else 'unresolved')
+        os.makedirs(directory, exist_ok=True)
+        profile_id = f'{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-{random.getrandbits(32):08x}'
+        if isinstance(profiler, StackSampler):
+            profiler.write(os.path.join(directory, f'{profile_id}.collapsed'))
+        else:
+            profiler.dump_stats(os.path.join(directory, f'{profile_id}.pstats'))
+        _prune(directory, settings.PROFILING_MAX_FILES)
+        response['X-Profile-Id'] = profile_id
+        return response
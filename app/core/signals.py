@@ -0,0 +1,196 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver, Signal
+from core.models import Tag, Ingredient, Recipe, RecipePopularity
+from core import sync, images, events, catalogue, autocomplete, stats
+
+# Sent after recipes are removed with raw deletes, which bypass post_delete. Arguments: user_id, ids, using
+recipes_deleted = Signal()
+
+
+@receiver(pre_save, sender=Tag)
+@receiver(pre_save, sender=Ingredient)
+def object_named(sender, instance, raw=False, using=None, **kwargs):
+    """Point renamed tags and ingredients at the catalogue entry of their name, on the shard they are saved to"""
+
+    if not raw and instance.new_name is not None:
+        instance.canonical = catalogue.canonical(instance.new_name, using)
+        instance.new_name = None
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Recipe)
+def object_saved(sender, instance, created=False, raw=False, **kwargs):
+    """Record created and updated objects for sync, and stream them"""
+
+    if not raw:
+        seq = sync.record_change(instance)
+        events.publish(
+            instance.user_id, sender._meta.model_name, 'created' if created else 'updated', instance.pk, seq,
+            instance._state.db,
+        )
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=Recipe)
+def object_deleted(sender, instance, **kwargs):
+    """Leave a tombstone for deleted objects, and stream their deletion"""
+
+    seq = sync.record_change(instance, deleted=True)
+    events.publish(instance.user_id, sender._meta.model_name, 'deleted', instance.pk, seq, instance._state.db)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+def name_saved(sender, instance, raw=False, **kwargs):
+    """Put the name in the autocomplete index once committed"""
+
+    if not raw:
+        update = autocomplete.changed(sender, instance.user_id, instance.pk, instance.name, instance._state.db)
+        if update is not None:
+            transaction.on_commit(update, using=instance._state.db)
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+def name_deleted(sender, instance, **kwargs):
+    """Take the name out of the autocomplete index once committed"""
+
+    update = autocomplete.changed(sender, instance.user_id, instance.pk, using=instance._state.db)
+    if update is not None:
+        transaction.on_commit(update, using=instance._state.db)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def recipe_relations_changed(sender, instance, action, reverse, **kwargs):
+    """Record recipes whose tags or ingredients changed"""
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        recipes = Recipe.objects.using(instance._state.db).filter(pk__in=kwargs['pk_set'] or ())
+    else:
+        recipes = [instance]
+    for recipe in recipes:
+        seq = sync.record_change(recipe)
+        events.publish(recipe.user_id, 'recipe', 'updated', recipe.pk, seq, recipe._state.db)
+
+
+@receiver(pre_save, sender=Recipe)
+def recipe_image_saving(sender, instance, raw=False, **kwargs):
+    """Keep the content of a newly assigned image, in case its file is collected before it is counted"""
+
+    image = instance.image
+    if not raw and image and not image._committed:
+        instance._image_content = image.file
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_image_saved(sender, instance, raw=False, **kwargs):
+    """Count the new image and release the replaced one"""
+
+    old = getattr(instance, '_loaded_image', None)
+    new = instance.stored_image_name()
+    content = getattr(instance, '_image_content', None)
+    instance._image_content = None
+    if raw or old == new:
+        return
+    if new:
+        images.retain(new, content)
+    images.release_on_commit([old], instance._state.db)
+    instance._loaded_image = new
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_image_deleted(sender, instance, **kwargs):
+    """Release the image of a deleted recipe"""
+
+    images.release_on_commit([instance.stored_image_name()], instance._state.db)
+
+
+@receiver(pre_save, sender=Recipe)
+def recipe_stats_loading(sender, instance, raw=False, using=None, **kwargs):
+    """Read the stored price and time the save replaces, under the row lock held until the statistics are applied
+
+    A concurrent save of the recipe waits for the lock, then reads what this one stored.
+    """
+
+    instance._loaded_stats = None
+    if not raw and instance.pk is not None:
+        instance._loaded_stats = Recipe.objects.using(using).select_for_update().filter(pk=instance.pk).values_list(
+            'price', 'time_minutes'
+        ).first()
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_stats_saved(sender, instance, created=False, raw=False, **kwargs):
+    """Count the recipe's price and time in its owner's statistics, instead of the stored ones"""
+
+    if raw:
+        return
+    delta = stats.Delta()
+    old = getattr(instance, '_loaded_stats', None)
+    if old is not None and not created:
+        delta.recipe(*old, sign=-1)
+    delta.recipe(instance.price, instance.time_minutes)
+    stats.apply(instance.user_id, delta, instance._state.db)
+
+
+@receiver(pre_delete, sender=Recipe)
+def recipe_stats_deleting(sender, instance, **kwargs):
+    """Read what a recipe counts for before the cascade removes its links"""
+
+    instance._stats_removal = stats.removal([instance.pk], instance._state.db)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_stats_deleted(sender, instance, **kwargs):
+    """Take a deleted recipe out of its owner's statistics"""
+
+    removal = getattr(instance, '_stats_removal', None)
+    if removal is not None:
+        stats.apply(instance.user_id, removal, instance._state.db)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def recipe_relations_stats(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """Count the recipes of each tag and ingredient"""
+
+    if action in ('pre_remove', 'pre_clear'):
+        # Removing links that do not exist sends their ids all the same
+        instance._unlinked = stats.linked(sender, instance, reverse, pk_set, using)
+        return
+    delta = stats.Delta()
+    if action == 'post_add':
+        delta.links(sender, {instance.pk: len(pk_set)} if reverse else dict.fromkeys(pk_set, 1))
+    elif action in ('post_remove', 'post_clear'):
+        delta.links(sender, getattr(instance, '_unlinked', {}), sign=-1)
+        instance._unlinked = {}
+    stats.apply(instance.user_id, delta, using)
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+def name_stats_deleted(sender, instance, **kwargs):
+    """Drop the recipe count of a deleted tag or ingredient"""
+
+    stats.forget(instance)
+
+
+@receiver(recipes_deleted, sender=Recipe)
+def recipes_deleted_events(sender, user_id, ids, using, **kwargs):
+    """Stream the deletion of recipes removed with raw deletes, their tombstones are in one sequence range"""
+
+    for recipe_id in ids:
+        events.publish(user_id, 'recipe', 'deleted', recipe_id, None, using)
+
+
+@receiver(recipes_deleted, sender=Recipe)
+def recipes_deleted_popularity(sender, ids, using, **kwargs):
+    """Drop the popularity of recipes removed with raw deletes"""
+
+    RecipePopularity.objects.using(using).filter(recipe_id__in=ids).delete()
@@ -0,0 +1,169 @@
+import logging
+import queue
+import re
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+_view = ContextVar('slow_query_view', default=None)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|\?')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_LISTS = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_SPACE = re.compile(r'\s+')
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def fingerprint(sql):
+    """Return `sql` with its literals and parameters replaced, so queries differing only by values match"""
+
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDER.sub('?', sql)
+    # IN lists and multi row VALUES vary in length with the data
+    sql = _LIST.sub('(...)', sql)
+    sql = _LISTS.sub('(...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def _explain_sql(vendor, sql):
+    if vendor == 'postgresql':
+        return f'EXPLAIN (ANALYZE off) {sql}'
+    if vendor == 'sqlite':
+        return f'EXPLAIN QUERY PLAN {sql}'
+    return f'EXPLAIN {sql}'
+
+
+class SlowQueryLog:
+    """Aggregate slow queries per fingerprint, and capture the plan of each in a background thread
+
+    Aggregates are per process. Past SLOW_QUERY_MAX_FINGERPRINTS, the fingerprint
+    with the least total time is dropped to make room.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._explains = queue.Queue()
+        self._worker = None
+
+    def record(self, alias, sql, params, many, view, elapsed_ms):
+        key = fingerprint(sql)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= settings.SLOW_QUERY_MAX_FINGERPRINTS:
+                    del self._entries[min(self._entries, key=lambda k: self._entries[k]['total_ms'])]
+                entry = self._entries[key] = {
+                    'fingerprint': key, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'views': {}, 'plan': None,
+                }
+                explain = not many and sql.lstrip().upper().startswith(EXPLAINABLE)
+            else:
+                explain = False
+            entry['count'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            entry['views'][view] = entry['views'].get(view, 0) + 1
+            entry['sql'] = sql
+        logger.warning('Slow query (%.1fms) from %s: %s', elapsed_ms, view, key)
+        metrics.inc('slow_queries_total', view=view)
+        if explain:
+            self._explain_later(alias, sql, params, key)
+
+    def _explain_later(self, alias, sql, params, key):
+        self._explains.put((alias, sql, params, key))
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='slow-query-explain', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            alias, sql, params, key = self._explains.get()
+            try:
+                plan = self._explain(alias, sql, params)
+            except Exception as exc:
+                plan = f'EXPLAIN failed: {exc}'
+            finally:
+                # The worker's own connections, the request's are not shared between threads
+                connections.close_all()
+            with self._lock:
+                if key in self._entries:
+                    self._entries[key]['plan'] = plan
+            logger.info('Plan of %s:\n%s', key, plan)
+            self._explains.task_done()
+
+    def _explain(self, alias, sql, params):
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            cursor.execute(_explain_sql(connection.vendor, sql), params)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+
+    def wait(self):
+        """Block until the queued plans have been captured"""
+
+        self._explains.join()
+
+    def entries(self):
+        """Return the aggregated slow queries, most total time first"""
+
+        with self._lock:
+            entries = [{**entry, 'views': dict(entry['views'])} for entry in self._entries.values()]
+        for entry in entries:
+            entry['mean_ms'] = entry['total_ms'] / entry['count']
+        return sorted(entries, key=lambda entry: entry['total_ms'], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_query_log = SlowQueryLog()
+
+
+def _observe(execute, sql, params, many, context):
+    """Execute wrapper timing queries run by the views of SLOW_QUERY_APPS"""
+
+    view = _view.get()
+    if view is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms >= settings.SLOW_QUERY_THRESHOLD_MS:
+            slow_query_log.record(context['connection'].alias, sql, params, many, view, elapsed_ms)
+
+
+class SlowQueryMiddleware:
+    """Log queries over SLOW_QUERY_THRESHOLD_MS run by the views of SLOW_QUERY_APPS, see SlowQueryLog"""
+
+    def __init__(self, get_response):
+        if settings.SLOW_QUERY_THRESHOLD_MS is None:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _view.set(None)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(_observe))
+                return self.get_response(request)
+        finally:
+            _view.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if match.namespaces and match.namespaces[0] in settings.SLOW_QUERY_APPS:
+            _view.set(match.view_name)
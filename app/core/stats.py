@@ -0,0 +1,221 @@
+import math
+from bisect import bisect_left
+from collections import Counter
+from decimal import Decimal
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from core.models import Recipe, RecipeStats, RecipeStatsBucket, Tag, Ingredient
+
+CENT = Decimal('0.01')
+PRICE_FIELD = Recipe._meta.get_field('price')
+# through model -> (bucket kind, m2m field)
+RELATIONS = {
+    Recipe.tags.through: (RecipeStatsBucket.TAG, Recipe.tags.field),
+    Recipe.ingredients.through: (RecipeStatsBucket.INGREDIENT, Recipe.ingredients.field),
+}
+
+
+def _price(value):
+    return PRICE_FIELD.to_python(value).quantize(CENT)
+
+
+def price_bucket(price):
+    return int(_price(price) * 100) // settings.STATS_PRICE_BUCKET_CENTS
+
+
+def time_bucket(minutes):
+    """Return the index of the first of STATS_TIME_BUCKETS at least `minutes`, their count above the last"""
+
+    return bisect_left(settings.STATS_TIME_BUCKETS, minutes)
+
+
+class Delta:
+    """Change to one user's statistics, written by `apply`"""
+
+    def __init__(self):
+        self.count = 0
+        self.price_total = Decimal(0)
+        self.time_total = 0
+        self.buckets = Counter()
+
+    def __bool__(self):
+        return bool(self.count or self.price_total or self.time_total or any(self.buckets.values()))
+
+    def recipe(self, price, minutes, sign=1):
+        """Count a recipe in, or out with a `sign` of -1"""
+
+        self.count += sign
+        self.price_total += sign * _price(price)
+        self.time_total += sign * minutes
+        self.buckets[(RecipeStatsBucket.PRICE, price_bucket(price))] += sign
+        self.buckets[(RecipeStatsBucket.TIME, time_bucket(minutes))] += sign
+
+    def links(self, through, counts, sign=1):
+        """Count recipes in or out of tags or ingredients, given as {id: recipes}"""
+
+        kind = RELATIONS[through][0]
+        for key, recipes in counts.items():
+            self.buckets[(kind, key)] += sign * recipes
+
+
+def _increment(model, using, keys, values):
+    """Add `values` to the row of `model` matching `keys`, creating it when missing"""
+
+    rows = model.objects.using(using).filter(**keys)
+    changes = {field: F(field) + value for field, value in values.items()}
+    if rows.update(**changes):
+        return
+    try:
+        with transaction.atomic(using=using):
+            model.objects.using(using).create(**keys, **values)
+    except IntegrityError:
+        rows.update(**changes)
+
+
+def apply(user_id, delta, using):
+    """Add `delta` to the user's statistics on database `using`"""
+
+    if not delta:
+        return
+    with transaction.atomic(using=using):
+        # Locks the user's statistics until commit, and goes first so a recompute is waited for
+        _increment(RecipeStats, using, {'user_id': user_id}, {
+            'count': delta.count, 'price_total': delta.price_total, 'time_total': delta.time_total,
+        })
+        # A fixed order keeps concurrent writers from deadlocking
+        for (kind, key), recipes in sorted(delta.buckets.items()):
+            if recipes:
+                _increment(RecipeStatsBucket, using, {'user_id': user_id, 'kind': kind, 'key': key},
+                           {'count': recipes})
+
+
+def linked(through, instance, reverse, pk_set, using):
+    """Return {tag or ingredient id: recipes} of the links of `instance` through `through`, only to `pk_set` if set"""
+
+    field = RELATIONS[through][1]
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    links = through.objects.using(using).filter(**{target if reverse else source: instance.pk})
+    if pk_set is not None:
+        links = links.filter(**{f'{source if reverse else target}__in': pk_set})
+    return Counter(links.values_list(f'{target}_id', flat=True))
+
+
+def _recipes_per_target(through, lookup, value, using):
+    """Return {tag or ingredient id: recipes} of the recipes matching `lookup`"""
+
+    field = RELATIONS[through][1]
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    links = through.objects.using(using).filter(**{f'{source}__{lookup}': value})
+    return dict(links.values(target).annotate(recipes=Count('pk')).values_list(target, 'recipes'))
+
+
+def removal(recipe_ids, using):
+    """Return a delta taking the given recipes out, read before they are deleted"""
+
+    delta = Delta()
+    for price, minutes in Recipe.objects.using(using).filter(id__in=recipe_ids).values_list('price', 'time_minutes'):
+        delta.recipe(price, minutes, sign=-1)
+    for through in RELATIONS:
+        delta.links(through, _recipes_per_target(through, 'in', recipe_ids, using), sign=-1)
+    return delta
+
+
+def remove_recipes(user_id, ids, using):
+    """Take recipes about to be removed with raw deletes out of the user's statistics"""
+
+    apply(user_id, removal(ids, using), using)
+
+
+def forget(instance):
+    """Drop the recipe count of a deleted tag or ingredient"""
+
+    kind = RecipeStatsBucket.TAG if isinstance(instance, Tag) else RecipeStatsBucket.INGREDIENT
+    RecipeStatsBucket.objects.using(instance._state.db).filter(
+        user_id=instance.user_id, kind=kind, key=instance.pk
+    ).delete()
+
+
+def recompute(user_id, using):
+    """Rebuild the user's statistics from their recipes, return how many recipes were counted"""
+
+    delta = Delta()
+    with transaction.atomic(using=using):
+        # Writers wait for the rebuild on the statistics row, and the rebuild for writers holding it
+        _increment(RecipeStats, using, {'user_id': user_id}, {'count': 0})
+        recipes = Recipe.objects.using(using).filter(user_id=user_id).values_list('price', 'time_minutes')
+        for price, minutes in recipes.iterator():
+            delta.recipe(price, minutes)
+        for through in RELATIONS:
+            delta.links(through, _recipes_per_target(through, 'user_id', user_id, using))
+
+        RecipeStats.objects.using(using).filter(user_id=user_id).update(
+            count=delta.count, price_total=delta.price_total, time_total=delta.time_total
+        )
+        RecipeStatsBucket.objects.using(using).filter(user_id=user_id).delete()
+        RecipeStatsBucket.objects.using(using).bulk_create([
+            RecipeStatsBucket(user_id=user_id, kind=kind, key=key, count=recipes)
+            for (kind, key), recipes in sorted(delta.buckets.items()) if recipes
+        ], batch_size=1000)
+    return delta.count
+
+
+def _percentile(buckets, percent):
+    """Return the nearest rank percentile price of (bucket, recipes) in price order
+
+    Prices are taken to be spread evenly over the cents of their bucket, so
+    they are exact with a STATS_PRICE_BUCKET_CENTS of 1.
+    """
+
+    total = sum(recipes for _, recipes in buckets)
+    if not total:
+        return None
+    rank = max(math.ceil(percent / 100 * total), 1)
+    width = settings.STATS_PRICE_BUCKET_CENTS
+    seen = 0
+    for key, recipes in buckets:
+        if seen + recipes >= rank:
+            cents = key * width + (width - 1) * (rank - seen - 0.5) / recipes
+            return str((Decimal(round(cents)) * CENT).quantize(CENT))
+        seen += recipes
+
+
+def _top(user, kind, model):
+    name = model.objects.filter(pk=OuterRef('key')).values('canonical__name')[:1]
+    rows = RecipeStatsBucket.objects.filter(user=user, kind=kind, count__gt=0).annotate(name=Subquery(name))
+    rows = rows.order_by('-count', 'key').values_list('key', 'name', 'count')[:settings.STATS_TOP]
+    return [{'id': key, 'name': name, 'recipes': recipes} for key, name, recipes in rows]
+
+
+def summary(user):
+    """Return the user's recipe count, price and cooking time distribution, and most used tags and ingredients"""
+
+    stats = RecipeStats.objects.filter(user=user).first()
+    count = stats.count if stats else 0
+    buckets = RecipeStatsBucket.objects.filter(
+        user=user, kind__in=(RecipeStatsBucket.PRICE, RecipeStatsBucket.TIME), count__gt=0
+    ).order_by('kind', 'key').values_list('kind', 'key', 'count')
+    prices, times = [], {}
+    for kind, key, recipes in buckets:
+        if kind == RecipeStatsBucket.PRICE:
+            prices.append((key, recipes))
+        else:
+            times[key] = recipes
+
+    bounds = list(settings.STATS_TIME_BUCKETS) + [None]
+    return {
+        'count': count,
+        'price': {
+            'average': str((stats.price_total / count).quantize(CENT)) if count else None,
+            'median': _percentile(prices, 50),
+            'percentiles': {
+                f'p{percent}': _percentile(prices, percent) for percent in settings.STATS_PRICE_PERCENTILES
+            },
+        },
+        'time_minutes': {
+            'average': round(stats.time_total / count, 1) if count else None,
+            'histogram': [{'le': bound, 'count': times.get(i, 0)} for i, bound in enumerate(bounds)],
+        },
+        'top_tags': _top(user, RecipeStatsBucket.TAG, Tag),
+        'top_ingredients': _top(user, RecipeStatsBucket.INGREDIENT, Ingredient),
+    }
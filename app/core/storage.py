@@ -0,0 +1,57 @@
+import hashlib
+import os
+import re
+import uuid
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+IMAGE_DIR = 'uploads/recipe'
+CONTENT_ADDRESSED_NAME = re.compile(r'^uploads/recipe/[0-9a-f]{2}/[0-9a-f]{2}/(?P<digest>[0-9a-f]{64})\.\w+$')
+
+
+def file_sha256(file):
+    """Return the hex sha256 of a file's content, reading it in chunks"""
+
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def content_addressed_name(digest, ext):
+    """Return the fanned out storage name of content with the given digest"""
+
+    return os.path.join(IMAGE_DIR, digest[:2], digest[2:4], f'{digest}.{ext.lower()}')
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """File storage naming files by the hash of their content, so saving known content is a no-op"""
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        name = content_addressed_name(file_sha256(content), os.path.splitext(name)[1].lstrip('.') or 'bin')
+        full_path = self.path(name)
+        try:
+            # Known content: refresh the mtime, so the orphan collector's grace period covers the new reference
+            os.utime(full_path)
+            return name
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # Write aside and rename, so concurrent uploads of the same content never expose a partial file
+        tmp_path = f'{full_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'wb') as tmp:
+                for chunk in content.chunks():
+                    tmp.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            os.replace(tmp_path, full_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return name
@@ -0,0 +1,62 @@
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from core.models import Change, ChangeCounter
+
+
+def _next_seq(user_id, using, count=1):
+    """Reserve `count` numbers of the user's change sequence and return the last one
+
+    The counter row stays locked until commit.
+    """
+
+    counters = ChangeCounter.objects.using(using).filter(user_id=user_id)
+    if not counters.update(seq=F('seq') + count):
+        try:
+            with transaction.atomic(using=using):
+                ChangeCounter.objects.using(using).create(user_id=user_id, seq=count)
+            return count
+        except IntegrityError:
+            counters.update(seq=F('seq') + count)
+    return counters.values_list('seq', flat=True).get()
+
+
+def record_change(obj, deleted=False):
+    """Record that a recipe, tag or ingredient was saved or deleted, return the change's sequence number
+
+    The counter lock orders concurrent writers of a user, so changes commit in sequence
+    order and a client never skips one that commits late.
+    """
+
+    using = obj._state.db
+    kind = obj._meta.model_name
+    with transaction.atomic(using=using):
+        seq = _next_seq(obj.user_id, using)
+        updated = Change.objects.using(using).filter(kind=kind, object_id=obj.pk).update(
+            seq=seq, deleted=deleted
+        )
+        if not updated:
+            Change.objects.using(using).create(
+                user_id=obj.user_id, seq=seq, kind=kind, object_id=obj.pk, deleted=deleted
+            )
+    return seq
+
+
+def record_deletions(user_id, kind, object_ids, using):
+    """Leave tombstones for objects removed without delete signals, in one sequence range"""
+
+    if not object_ids:
+        return
+    with transaction.atomic(using=using):
+        last = _next_seq(user_id, using, len(object_ids))
+        first = last - len(object_ids) + 1
+        Change.objects.using(using).filter(kind=kind, object_id__in=object_ids).delete()
+        Change.objects.using(using).bulk_create([
+            Change(user_id=user_id, seq=first + i, kind=kind, object_id=object_id, deleted=True)
+            for i, object_id in enumerate(object_ids)
+        ])
+
+
+def changes_since(user, since, limit):
+    """Return the user's changes after `since` in sequence order, at most `limit` of them"""
+
+    return list(Change.objects.filter(user=user, seq__gt=since).order_by('seq')[:limit])
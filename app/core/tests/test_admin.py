@@ -1,6 +1,8 @@
 from django.test import TestCase, Client
 from django.contrib.auth import get_user_model
 from django.urls import reverse
+from core.admin import EstimatedCountPaginator
+from core.models import Tag, Recipe
 
 
 class AdminSiteTests(TestCase):
@@ -38,3 +40,58 @@ class AdminSiteTests(TestCase):
         res = self.client.get(url)
 
         self.assertEqual(res.status_code, 200)
+
+    def test_recipe_changelist(self):
+        """Test the recipe changelist lists recipes with their user"""
+
+        for i in range(3):
+            Recipe.objects.create(user=self.user, title=f'Recipe {i}', time_minutes=5, price=1)
+        url = reverse('admin:core_recipe_changelist')
+
+        res = self.client.get(url)
+
+        self.assertContains(res, 'Recipe 2')
+        self.assertContains(res, self.user.email)
+
+    def test_tag_search_by_prefix(self):
+        """Test searching tags matches name prefixes"""
+
+        Tag.objects.create(user=self.user, name='Vegan')
+        Tag.objects.create(user=self.user, name='Dessert')
+        url = reverse('admin:core_tag_changelist')
+
+        res = self.client.get(url, {'q': 'veg'})
+
+        self.assertContains(res, 'Vegan')
+        self.assertNotContains(res, 'Dessert')
+
+    def test_tag_renamed(self):
+        """Test renaming a tag from the admin points it at the catalogue entry of its new name"""
+
+        tag = Tag.objects.create(user=self.user, name='Vegan')
+        url = reverse('admin:core_tag_change', args=[tag.id])
+
+        self.assertContains(self.client.get(url), 'value="Vegan"')
+        res = self.client.post(url, {'user': self.user.id, 'name': 'Vegetarian'})
+
+        self.assertEqual(res.status_code, 302)
+        tag.refresh_from_db()
+        self.assertEqual(tag.name, 'Vegetarian')
+
+    def test_recipe_change_page(self):
+        """Test the recipe edit page uses autocomplete widgets"""
+
+        recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=1)
+        url = reverse('admin:core_recipe_change', args=[recipe.id])
+
+        res = self.client.get(url)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, 'admin-autocomplete')
+
+    def test_estimated_count_falls_back_to_count(self):
+        """Test the paginator counts exactly where no estimate is available"""
+
+        Tag.objects.create(user=self.user, name='Vegan')
+
+        self.assertEqual(EstimatedCountPaginator(Tag.objects.all(), 10).count, 1)
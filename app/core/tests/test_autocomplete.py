@@ -0,0 +1,163 @@
+import statistics
+import time
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core import autocomplete
+from core.models import Tag, Ingredient
+
+TAG_AUTOCOMPLETE_URL = reverse('recipe:tag-autocomplete')
+INGREDIENT_AUTOCOMPLETE_URL = reverse('recipe:ingredient-autocomplete')
+
+
+class NameIndexTests(TestCase):
+
+    def test_prefix_then_words_then_typos(self):
+        """Test names starting with the term come before later words and typos"""
+
+        index = autocomplete.NameIndex(
+            [(1, 'Tomato'), (2, 'Cherry tomatoes'), (3, 'Tomatillo'), (4, 'Potato'), (5, 'Basil')], version=0
+        )
+
+        self.assertEqual(index.search('tom', 10), [(3, 'Tomatillo'), (1, 'Tomato'), (2, 'Cherry tomatoes')])
+        self.assertEqual(index.search('TOMATOE', 10), [(2, 'Cherry tomatoes'), (1, 'Tomato')])
+        self.assertEqual(index.search('tmato', 10), [(1, 'Tomato')])
+        self.assertEqual(index.search('tom', 1), [(3, 'Tomatillo')])
+
+    def test_short_terms_not_fuzzy(self):
+        """Test terms under AUTOCOMPLETE_FUZZY_MIN_LENGTH only match prefixes"""
+
+        index = autocomplete.NameIndex([(1, 'Basil')], version=0)
+
+        self.assertEqual(index.search('bs', 10), [])
+        self.assertEqual(index.search('bsa', 10), [(1, 'Basil')])
+
+    @override_settings(AUTOCOMPLETE_FUZZY_MAX_LENGTH=5)
+    def test_long_terms_not_fuzzy(self):
+        """Test terms over AUTOCOMPLETE_FUZZY_MAX_LENGTH only match prefixes, without building typo variants"""
+
+        index = autocomplete.NameIndex([(1, 'Tomatoes')], version=0)
+
+        with mock.patch('core.autocomplete._typos') as typos:
+            self.assertEqual(index.search('tomatos', 10), [])
+            self.assertEqual(index.search('tomatoe', 10), [(1, 'Tomatoes')])
+        typos.assert_not_called()
+
+    def test_add_and_remove(self):
+        """Test renamed and removed names are found under their new name only"""
+
+        index = autocomplete.NameIndex([(1, 'Sea salt'), (2, 'Pepper')], version=0)
+        index.add(1, 'Rock salt')
+        index.remove(2)
+
+        self.assertEqual(index.search('sea', 10), [])
+        self.assertEqual(index.search('salt', 10), [(1, 'Rock salt')])
+        self.assertEqual(index.search('pepper', 10), [])
+
+    def test_search_fast_with_many_names(self):
+        """Test a lookup among 50k names takes under 5ms, typos included"""
+
+        words = ['salt', 'pepper', 'tomato', 'basil', 'garlic', 'onion', 'lemon', 'thyme', 'cumin', 'paprika']
+        rows = [(i, f'{words[i % 10]} {words[i // 10 % 10]} {i}') for i in range(50_000)]
+        index = autocomplete.NameIndex(rows, version=0)
+
+        timings = []
+        for term in ('gar', 'lemon thy', 'papirka', 'cumni 12', 'zzz'):
+            start = time.perf_counter()
+            index.search(term, 10)
+            timings.append(time.perf_counter() - start)
+        self.assertLess(statistics.median(timings), 0.005)
+
+
+class AutocompleteApiTests(TestCase):
+
+    def setUp(self):
+        autocomplete.clear_cache()
+        self.addCleanup(autocomplete.clear_cache)
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.other = get_user_model().objects.create_user('other@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_own_names_only(self):
+        """Test only the user's own tags are suggested"""
+
+        vegan = Tag.objects.create(user=self.user, name='Vegan')
+        Tag.objects.create(user=self.other, name='Vegetarian')
+        Ingredient.objects.create(user=self.user, name='Vegetable stock')
+
+        res = self.client.get(TAG_AUTOCOMPLETE_URL, {'q': 've'})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data, [{'id': vegan.id, 'name': 'Vegan'}])
+
+    def test_index_follows_writes(self):
+        """Test names created, renamed and deleted after the index was built are reflected"""
+
+        salt = Ingredient.objects.create(user=self.user, name='Salt')
+        self.client.get(INGREDIENT_AUTOCOMPLETE_URL, {'q': 's'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            pepper = Ingredient.objects.create(user=self.user, name='Sichuan pepper')
+            salt.name = 'Rock salt'
+            salt.save()
+
+        # Only the version is read
+        with self.assertNumQueries(1):
+            res = self.client.get(INGREDIENT_AUTOCOMPLETE_URL, {'q': 's'})
+        self.assertEqual(res.data, [{'id': pepper.id, 'name': 'Sichuan pepper'}, {'id': salt.id, 'name': 'Rock salt'}])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            pepper.delete()
+        res = self.client.get(INGREDIENT_AUTOCOMPLETE_URL, {'q': 's'})
+        self.assertEqual(res.data, [{'id': salt.id, 'name': 'Rock salt'}])
+
+    def test_rebuilt_after_write_elsewhere(self):
+        """Test an index is rebuilt when another process changed the names"""
+
+        Tag.objects.create(user=self.user, name='Vegan')
+        self.client.get(TAG_AUTOCOMPLETE_URL, {'q': 'v'})
+        # Without its commit callbacks the write only reaches the database, like one of another process
+        Tag.objects.create(user=self.user, name='Vegetarian')
+
+        res = self.client.get(TAG_AUTOCOMPLETE_URL, {'q': 'veget'})
+
+        self.assertEqual([match['name'] for match in res.data], ['Vegetarian'])
+
+    def test_not_updated_in_place_over_write_elsewhere(self):
+        """Test a local write does not hide a write of another process made since the index was built"""
+
+        Tag.objects.create(user=self.user, name='Vegan')
+        self.client.get(TAG_AUTOCOMPLETE_URL, {'q': 'v'})
+        Tag.objects.create(user=self.user, name='Vegetarian')
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(user=self.user, name='Veggie')
+
+        res = self.client.get(TAG_AUTOCOMPLETE_URL, {'q': 'veg'})
+
+        self.assertEqual([match['name'] for match in res.data], ['Vegan', 'Vegetarian', 'Veggie'])
+
+    @override_settings(AUTOCOMPLETE_MAX_NAMES=1)
+    def test_database_fallback(self):
+        """Test users with more names than AUTOCOMPLETE_MAX_NAMES are matched in the database"""
+
+        Tag.objects.create(user=self.user, name='Vegan')
+        vegetarian = Tag.objects.create(user=self.user, name='Vegetarian')
+
+        res = self.client.get(TAG_AUTOCOMPLETE_URL, {'q': 'VEGE'})
+
+        self.assertEqual(res.data, [{'id': vegetarian.id, 'name': 'Vegetarian'}])
+
+    def test_invalid_parameters(self):
+        """Test a missing term and out of range limits are rejected"""
+
+        invalid = (
+            {}, {'q': ' '}, {'q': 'a' * 256}, {'q': 'a', 'limit': 0}, {'q': 'a', 'limit': 'x'}, {'q': 'a', 'limit': 51},
+        )
+        for params in invalid:
+            res = self.client.get(TAG_AUTOCOMPLETE_URL, params)
+
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
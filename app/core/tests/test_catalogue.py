@@ -0,0 +1,64 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from core import catalogue
+from core.models import CanonicalName, Tag, Ingredient
+
+
+class CatalogueTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.other = get_user_model().objects.create_user('other@email.com', 'testpass')
+
+    def test_normalize(self):
+        """Test spellings differing in case, spacing and compatibility forms share a name"""
+
+        self.assertEqual(catalogue.normalize('  Sea   SALT '), 'sea salt')
+        self.assertEqual(catalogue.normalize('ﬁsh'), 'fish')
+        self.assertEqual(catalogue.normalize('   '), '')
+
+    def test_rows_share_catalogue_entry(self):
+        """Test every row spelling a name points at one catalogue entry, and reads its name through it"""
+
+        salt = Ingredient.objects.create(user=self.user, name='Salt')
+        other_salt = Ingredient.objects.create(user=self.other, name='Salt')
+        tag = Tag.objects.create(user=self.user, name='Salt')
+        lower = Ingredient.objects.create(user=self.user, name='salt')
+
+        self.assertEqual(CanonicalName.objects.count(), 2)
+        self.assertEqual(salt.canonical_id, other_salt.canonical_id)
+        self.assertEqual(salt.canonical_id, tag.canonical_id)
+        self.assertNotEqual(salt.canonical_id, lower.canonical_id)
+        with self.assertNumQueries(1):
+            names = [ingredient.name for ingredient in Ingredient.objects.order_by('id')]
+        self.assertEqual(names, ['Salt', 'Salt', 'salt'])
+
+    def test_rename_moves_to_other_entry(self):
+        """Test a renamed row follows its new name"""
+
+        tag = Tag.objects.create(user=self.user, name='Vegan')
+        tag.name = 'Vegetarian'
+        tag.save()
+        tag.refresh_from_db()
+
+        self.assertEqual(tag.name, 'Vegetarian')
+        self.assertEqual(tag.canonical.name, 'Vegetarian')
+
+    def test_ids_of_new_names_only_added_once(self):
+        """Test known names are looked up with one query, and new ones added"""
+
+        catalogue.canonical_ids(['Salt'])
+
+        with self.assertNumQueries(1):
+            ids = catalogue.canonical_ids(['Salt'])
+        self.assertEqual(catalogue.canonical_ids(['Salt', 'Pepper'])['Salt'], ids['Salt'])
+        self.assertEqual(CanonicalName.objects.count(), 2)
+
+    def test_usage_merges_spellings(self):
+        """Test usage counts the users of each name across spellings"""
+
+        Tag.objects.create(user=self.user, name='Vegan')
+        Tag.objects.create(user=self.other, name='vegan ')
+        Tag.objects.create(user=self.user, name='Dessert')
+
+        self.assertEqual(catalogue.usage(Tag), [('vegan', 2), ('dessert', 1)])
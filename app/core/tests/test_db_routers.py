@@ -0,0 +1,213 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from unittest.mock import patch
+from core import db_routers
+from core.models import Recipe, Job
+
+TAGS_URL = reverse('recipe:tag-list')
+
+
+class HashRingTests(TestCase):
+
+    def test_ring_is_deterministic(self):
+        """Test the same key always maps to the same node"""
+
+        ring = db_routers.HashRing(['a', 'b', 'c'])
+        other = db_routers.HashRing(['c', 'b', 'a'])
+
+        self.assertEqual([ring.get(i) for i in range(100)], [other.get(i) for i in range(100)])
+
+    def test_adding_node_moves_few_keys(self):
+        """Test adding a shard only remaps keys onto the new shard"""
+
+        before = db_routers.HashRing(['a', 'b', 'c'])
+        after = db_routers.HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in range(1000) if before.get(key) != after.get(key)]
+
+        self.assertLess(len(moved), 400)
+        self.assertTrue(all(after.get(key) == 'd' for key in moved))
+
+
+class ShardRouterTests(TestCase):
+
+    def setUp(self):
+        self.router = db_routers.ShardRouter()
+        cache.clear()
+
+    @override_settings(DATABASE_SHARDS=['default', 'shard1'])
+    def test_sharded_models_follow_owner(self):
+        """Test user owned rows are routed to the owner's shard"""
+
+        user = get_user_model().objects.create_user('test@email.com', 'testpass', shard='shard1')
+        recipe = Recipe(user=user, title='Soup', time_minutes=5, price=1)
+
+        self.assertEqual(db_routers.shard_for_user(user), 'shard1')
+        self.assertEqual(self.router.db_for_write(Recipe, instance=recipe), 'shard1')
+        self.assertEqual(self.router.db_for_read(Recipe, instance=user), 'shard1')
+        self.assertEqual(self.router.db_for_write(get_user_model(), instance=user), 'default')
+
+    @override_settings(DATABASE_SHARDS=['default', 'shard1'])
+    def test_current_shard_routes_owner_less_queries(self):
+        """Test queries without hints use the shard of the request"""
+
+        token = db_routers.use_shard('shard1')
+        try:
+            self.assertEqual(self.router.db_for_read(Recipe), 'shard1')
+        finally:
+            db_routers.reset_shard(token)
+
+        self.assertEqual(self.router.db_for_read(Recipe), 'default')
+
+    def test_new_users_keep_their_shard_when_shards_are_added(self):
+        """Test the shard picked when a user is created is saved, so adding a shard does not move them"""
+
+        users = []
+        with override_settings(DATABASE_SHARDS=['default', 'shard1']):
+            for i in range(20):
+                users.append(get_user_model().objects.create_user(f'user{i}@email.com', 'testpass'))
+            placed = {user.pk: db_routers.ring_shard(user.pk) for user in users}
+
+        with override_settings(DATABASE_SHARDS=['default', 'shard1', 'shard2']):
+            for user in users:
+                user.refresh_from_db()
+                self.assertEqual(db_routers.shard_for_user(user), placed[user.pk])
+                self.assertEqual(db_routers.shard_for_user_id(user.pk), placed[user.pk])
+
+    def test_single_shard_needs_no_lookup(self):
+        """Test the shard lookup is free with a single shard"""
+
+        with self.assertNumQueries(0):
+            self.assertEqual(db_routers.shard_for_user_id(1), 'default')
+
+    def test_reads_use_primary_by_default(self):
+        """Test reads go to the primary outside a replica context"""
+
+        self.assertEqual(self.router.db_for_read(Recipe), 'default')
+
+    @override_settings(DATABASE_REPLICAS={'default': ['replica']})
+    def test_reads_use_replica_when_enabled(self):
+        """Test reads go to a replica inside a replica context"""
+
+        token = db_routers.use_replicas()
+        try:
+            self.assertEqual(self.router.db_for_read(Recipe), 'replica')
+            self.assertEqual(self.router.db_for_write(Recipe), 'default')
+        finally:
+            db_routers.reset_replicas(token)
+
+        self.assertEqual(self.router.db_for_read(Recipe), 'default')
+
+    @override_settings(DATABASE_REPLICAS={'default': ['replica']})
+    def test_replicas_are_not_migrated(self):
+        """Test migrations never run against a replica"""
+
+        self.assertFalse(self.router.allow_migrate('replica', 'core'))
+        self.assertIsNone(self.router.allow_migrate('default', 'core'))
+
+
+class ReplicaPinningTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_write_pins_user_to_primary(self):
+        """Test a successful write pins the user to the primary"""
+
+        self.assertFalse(db_routers.is_pinned(self.user))
+        self.client.post(TAGS_URL, {'name': 'Vegan'})
+
+        self.assertTrue(db_routers.is_pinned(self.user))
+
+    def test_failed_write_does_not_pin(self):
+        """Test an invalid write leaves the user on the replicas"""
+
+        self.client.post(TAGS_URL, {'name': ''})
+
+        self.assertFalse(db_routers.is_pinned(self.user))
+
+    def test_safe_request_reads_from_replicas(self):
+        """Test a read by an unpinned user is routed to the replicas"""
+
+        with patch('core.db_routers.use_replicas', wraps=db_routers.use_replicas) as use_replicas:
+            self.client.get(TAGS_URL)
+
+        use_replicas.assert_called_once()
+
+    def test_pinned_user_reads_from_primary(self):
+        """Test a read right after a write stays on the primary"""
+
+        db_routers.pin_to_primary(self.user)
+        with patch('core.db_routers.use_replicas') as use_replicas:
+            self.client.get(TAGS_URL)
+
+        use_replicas.assert_not_called()
+
+    def test_routing_reset_after_unhandled_exception(self):
+        """Test a request failing with an unhandled exception leaves no replica or shard routing behind"""
+
+        with patch('recipe.views.TagViewSet.list', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.get(TAGS_URL)
+
+        self.assertFalse(db_routers._use_replicas.get())
+        self.assertIsNone(db_routers._current_shard.get())
+
+
+class RebalanceUserCommandTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+
+    def test_unknown_shard(self):
+        """Test moving a user to an unknown shard fails"""
+
+        with self.assertRaises(CommandError):
+            call_command('rebalance_user', self.user.email, 'missing')
+
+    def test_user_already_on_shard(self):
+        """Test moving a user to its own shard is a no-op"""
+
+        Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=1)
+        call_command('rebalance_user', self.user.email, 'default')
+
+        self.assertEqual(Recipe.objects.filter(user=self.user).count(), 1)
+
+    @override_settings(DATABASE_SHARDS=['default', 'shard1'])
+    def test_moving_user_writes_fenced(self):
+        """Test a user moving to another shard gets a 503 on writes while reads still work"""
+
+        self.user.shard = 'default'
+        self.user.save()
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        db_routers.fence_writes(self.user.pk)
+        self.addCleanup(db_routers.lift_fence, self.user.pk)
+
+        res = client.post(TAGS_URL, {'name': 'Vegan'})
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res['Retry-After'], '30')
+        self.assertEqual(client.get(TAGS_URL).status_code, 200)
+
+    @override_settings(DATABASE_SHARDS=['default', 'shard1'])
+    def test_running_jobs_abort_move(self):
+        """Test a user with running jobs is not moved, and its writes are accepted again"""
+
+        self.user.shard = 'default'
+        self.user.save()
+        Job.objects.create(name='user.delete', user=self.user, status=Job.RUNNING)
+
+        with self.assertRaises(CommandError):
+            call_command('rebalance_user', self.user.email, 'shard1', '--drain-seconds', '0')
+
+        self.assertFalse(db_routers.is_fenced(self.user.pk))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.shard, 'default')
@@ -0,0 +1,87 @@
+import time
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core import deadlines, metrics
+from core.models import Tag
+
+SYNC_URL = reverse('recipe:sync')
+RECIPES_URL = reverse('recipe:recipe-list')
+
+
+def deadline_exceeded_count(view, stage):
+    key = ('request_deadline_exceeded_total', (('stage', stage), ('view', view)))
+    return metrics.snapshot().get(key, 0)
+
+
+class DeadlineTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_request_within_deadline(self):
+        """Test a request finishing in time is answered normally"""
+
+        res = self.client.get(RECIPES_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIsNone(deadlines.remaining())
+
+    def test_request_queued_too_long(self):
+        """Test a request the front-end server held past its deadline fails right away"""
+
+        before = deadline_exceeded_count('RecipeViewSet', 'queue')
+
+        res = self.client.get(RECIPES_URL, HTTP_X_REQUEST_START=f't={time.time() - 60:.3f}')
+
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(res['Retry-After'], '1')
+        self.assertEqual(deadline_exceeded_count('RecipeViewSet', 'queue'), before + 1)
+
+    @override_settings(REQUEST_DEADLINE_SECONDS=0.5)
+    def test_deadline_from_settings(self):
+        """Test views without their own deadline use the settings one"""
+
+        started_ms = int((time.time() - 1) * 1000)
+
+        res = self.client.get(SYNC_URL, HTTP_X_REQUEST_START=str(started_ms))
+
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_queries_checked_against_deadline(self):
+        """Test no query starts once the deadline passed"""
+
+        token = deadlines._deadline.set(time.monotonic() - 1)
+        try:
+            with connection.execute_wrapper(deadlines._StatementTimeout()):
+                with self.assertRaises(deadlines.DeadlineExceeded) as cm:
+                    Tag.objects.count()
+        finally:
+            deadlines._deadline.reset(token)
+        self.assertEqual(cm.exception.stage, 'query')
+
+    def test_deadline_reset_after_unhandled_exception(self):
+        """Test a request failing with an unhandled exception leaves no deadline behind"""
+
+        with mock.patch('recipe.views.RecipeViewSet.list', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.get(RECIPES_URL)
+
+        self.assertIsNone(deadlines.remaining())
+        self.assertEqual(connection.execute_wrappers, [])
+
+    def test_request_start_formats(self):
+        """Test X-Request-Start is read in seconds, milliseconds and microseconds"""
+
+        now = time.time()
+        factory = RequestFactory()
+        for header in (f't={now:.3f}', str(int(now * 1000)), f't={int(now * 1000000)}'):
+            request = factory.get('/', HTTP_X_REQUEST_START=header)
+            self.assertAlmostEqual(deadlines._request_start(request), now, delta=0.01)
+        self.assertIsNone(deadlines._request_start(factory.get('/')))
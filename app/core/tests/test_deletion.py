@@ -0,0 +1,98 @@
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import TestCase
+from rest_framework.authtoken.models import Token
+from core import deletion
+from django.utils import timezone
+from core.models import Tag, Ingredient, Recipe, Change, ChangeCounter, UploadSession
+
+
+def sample_recipe(user, **params):
+    """Create sample recipe"""
+
+    defaults = {
+        'title': 'sample recipe',
+        'time_minutes': 10,
+        'price': 34.00
+    }
+    defaults.update(params)
+    return Recipe.objects.create(user=user, **defaults)
+
+
+class DeletionTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.tag = Tag.objects.create(user=self.user, name='Vegan')
+        self.ingredient = Ingredient.objects.create(user=self.user, name='Salt')
+
+    def test_delete_recipes_in_batches(self):
+        """Test recipes and their m2m rows go, tags and ingredients stay"""
+
+        recipes = [sample_recipe(user=self.user) for _ in range(5)]
+        for recipe in recipes:
+            recipe.tags.add(self.tag)
+            recipe.ingredients.add(self.ingredient)
+        stages = []
+
+        deleted = deletion.delete_recipes(
+            self.user, [recipe.id for recipe in recipes[:4]], batch_size=2,
+            progress=lambda stage, count: stages.append(count)
+        )
+
+        self.assertEqual(deleted, 4)
+        self.assertEqual(stages, [2, 4])
+        self.assertEqual(list(Recipe.objects.values_list('id', flat=True)), [recipes[4].id])
+        self.assertEqual(Recipe.tags.through.objects.count(), 1)
+        self.assertTrue(Tag.objects.filter(pk=self.tag.pk).exists())
+        tombstones = Change.objects.filter(kind='recipe', deleted=True)
+        self.assertEqual(tombstones.count(), 4)
+        self.assertEqual(len(set(tombstones.values_list('seq', flat=True))), 4)
+
+    def test_delete_recipes_removes_images(self):
+        """Test image files of deleted recipes are removed on commit"""
+
+        recipe = sample_recipe(user=self.user)
+        recipe.image = default_storage.save('uploads/recipe/deletion-test.jpg', ContentFile(b'img'))
+        recipe.save()
+        self.addCleanup(default_storage.delete, recipe.image.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deletion.delete_recipes(self.user, [recipe.id])
+
+        self.assertFalse(default_storage.exists(recipe.image.name))
+
+    def test_delete_user_in_batches(self):
+        """Test a user and everything they own is removed"""
+
+        for _ in range(3):
+            sample_recipe(user=self.user).tags.add(self.tag)
+        UploadSession.objects.create(
+            user=self.user, recipe=Recipe.objects.first(), size=1, sha256='0' * 64, expires_at=timezone.now()
+        )
+        Token.objects.create(user=self.user)
+        other = get_user_model().objects.create_user('other@email.com', 'testpass')
+        kept = sample_recipe(user=other)
+
+        totals = deletion.delete_user(self.user, batch_size=2)
+
+        self.assertEqual(totals['recipes'], 3)
+        self.assertFalse(get_user_model().objects.filter(pk=self.user.pk).exists())
+        for model in (Recipe, Tag, Ingredient, Change, ChangeCounter, UploadSession, Token):
+            self.assertFalse(model.objects.filter(user_id=self.user.pk).exists())
+        self.assertEqual(Recipe.tags.through.objects.count(), 0)
+        self.assertTrue(Recipe.objects.filter(pk=kept.pk).exists())
+
+    def test_delete_user_command(self):
+        """Test the command deletes the user and reports progress"""
+
+        sample_recipe(user=self.user)
+        out = StringIO()
+
+        call_command('delete_user', self.user.email, stdout=out)
+
+        self.assertIn('recipes: 1 deleted', out.getvalue())
+        self.assertFalse(get_user_model().objects.filter(pk=self.user.pk).exists())
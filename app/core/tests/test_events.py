@@ -0,0 +1,124 @@
+import asyncio
+import json
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework.authtoken.models import Token
+from app.asgi import application, EVENTS_PATH
+from core import deletion, events
+from core.models import Tag, Recipe
+
+
+class StreamClient:
+    """Drive the ASGI app like a server would, collecting what it sends"""
+
+    def __init__(self, query_string=b'', headers=()):
+        self.scope = {
+            'type': 'http', 'method': 'GET', 'path': EVENTS_PATH,
+            'query_string': query_string, 'headers': list(headers),
+        }
+        self.sent = []
+        self._disconnect = asyncio.Event()
+        self._new = asyncio.Event()
+
+    async def _receive(self):
+        await self._disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def _send(self, message):
+        self.sent.append(message)
+        self._new.set()
+
+    def start(self):
+        self.task = asyncio.ensure_future(application(self.scope, self._receive, self._send))
+
+    async def wait_for(self, predicate):
+        while not predicate(self):
+            self._new.clear()
+            await asyncio.wait_for(self._new.wait(), 5)
+
+    @property
+    def body(self):
+        return b''.join(message.get('body', b'') for message in self.sent).decode()
+
+    def events(self):
+        return [
+            json.loads(line[len('data: '):]) for line in self.body.splitlines()
+            if line.startswith('data: ') and line != 'data: {}'
+        ]
+
+    async def close(self):
+        self._disconnect.set()
+        await asyncio.wait_for(self.task, 5)
+
+
+class EventStreamTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.token = Token.objects.create(user=self.user)
+
+    def write(self, func, *args, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return func(*args, **kwargs)
+
+    async def test_stream_pushes_changes(self):
+        """Test the user's streams get their created, updated and deleted objects with sync tokens"""
+
+        client = StreamClient(headers=[(b'authorization', f'Token {self.token.key}'.encode())])
+        client.start()
+        await client.wait_for(lambda c: c.body.startswith('retry:'))
+        self.assertEqual(dict(client.sent[0]['headers'])[b'content-type'], b'text/event-stream')
+
+        tag = await sync_to_async(self.write)(Tag.objects.create, user=self.user, name='Vegan')
+        await sync_to_async(self.write)(lambda: Tag.objects.filter(pk=tag.pk).first().delete())
+        await client.wait_for(lambda c: len(c.events()) == 2)
+        await client.close()
+
+        created, deleted = client.events()
+        self.assertEqual((created['kind'], created['action'], created['id']), ('tag', 'created', tag.pk))
+        self.assertEqual((deleted['action'], deleted['id']), ('deleted', tag.pk))
+        self.assertIn(f'id: {deleted["seq"]}\n', client.body)
+        self.assertEqual(events.broker.streams(), 0)
+
+    async def test_streams_are_per_user(self):
+        """Test changes of other users are not streamed, and raw deletes are"""
+
+        other = await sync_to_async(get_user_model().objects.create_user)('other@email.com', 'testpass')
+        client = StreamClient(query_string=f'token={self.token.key}'.encode())
+        client.start()
+        await client.wait_for(lambda c: c.sent)
+
+        await sync_to_async(self.write)(Tag.objects.create, user=other, name='Vegan')
+        recipe = await sync_to_async(self.write)(
+            lambda: Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=1)
+        )
+        await sync_to_async(self.write)(deletion.delete_recipes, self.user, [recipe.pk])
+        await client.wait_for(lambda c: len(c.events()) == 2)
+        await client.close()
+
+        streamed = [(event['kind'], event['action']) for event in client.events()]
+        self.assertEqual(streamed, [('recipe', 'created'), ('recipe', 'deleted')])
+
+    async def test_invalid_token_refused(self):
+        """Test streams need a valid token"""
+
+        client = StreamClient(query_string=b'token=nope')
+        client.start()
+        await asyncio.wait_for(client.task, 5)
+
+        self.assertEqual(client.sent[0]['status'], 401)
+
+    @override_settings(EVENTS_QUEUE_SIZE=2)
+    async def test_slow_stream_told_to_resync(self):
+        """Test a stream falling behind is closed with a resync event instead of buffering without bound"""
+
+        subscription = events.broker.subscribe(self.user.pk)
+        for seq in range(5):
+            subscription.push({'user': self.user.pk, 'kind': 'tag', 'action': 'created', 'id': seq, 'seq': seq})
+        await asyncio.sleep(0)
+        events.broker.unsubscribe(subscription)
+
+        self.assertEqual(subscription.queue.qsize(), 2)
+        self.assertEqual(subscription.queue.get_nowait()['seq'], 1)
+        self.assertIs(subscription.queue.get_nowait(), events.OVERFLOW)
@@ -0,0 +1,136 @@
+from datetime import timedelta
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient
+from core.models import IdempotencyKey, Recipe
+
+RECIPES_URL = reverse('recipe:recipe-list')
+CREATE_USER_URL = reverse('user:create')
+PAYLOAD = {'title': 'Soup', 'time_minutes': 10, 'price': '2.00'}
+
+
+class IdempotencyTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_retry_replays_response(self):
+        """Test a retry gets the first response without creating the recipe again"""
+
+        res = self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+        retry = self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.json(), res.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Recipe.objects.filter(user=self.user).count(), 1)
+
+    def test_requests_without_key_run_again(self):
+        """Test requests without a key, or with another one, are not deduplicated"""
+
+        self.client.post(RECIPES_URL, PAYLOAD)
+        self.client.post(RECIPES_URL, PAYLOAD)
+        self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+        self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k2')
+
+        self.assertEqual(Recipe.objects.filter(user=self.user).count(), 4)
+
+    def test_key_reused_for_other_request(self):
+        """Test a key sent again with a different body is refused"""
+
+        self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+        res = self.client.post(RECIPES_URL, {**PAYLOAD, 'title': 'Stew'}, HTTP_IDEMPOTENCY_KEY='k1')
+
+        self.assertEqual(res.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Recipe.objects.filter(user=self.user).count(), 1)
+
+    def test_keys_are_per_user(self):
+        """Test another user's key does not replay to this user"""
+
+        other = get_user_model().objects.create_user('other@email.com', 'testpass')
+        client = APIClient()
+        client.force_authenticate(user=other)
+
+        client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+        res = self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+
+        self.assertFalse(res.has_header('Idempotent-Replayed'))
+        self.assertEqual(Recipe.objects.count(), 2)
+
+    def test_anonymous_signup_replayed(self):
+        """Test signing up twice with the same key creates one user"""
+
+        payload = {'email': 'new@email.com', 'password': 'testpass', 'name': 'New'}
+        res = APIClient().post(CREATE_USER_URL, payload, HTTP_IDEMPOTENCY_KEY='signup')
+        retry = APIClient().post(CREATE_USER_URL, payload, HTTP_IDEMPOTENCY_KEY='signup')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(get_user_model().objects.filter(email='new@email.com').count(), 1)
+
+    def test_anonymous_keys_are_per_client(self):
+        """Test an anonymous key sent from another address does not replay that client's response"""
+
+        payload = {'email': 'new@email.com', 'password': 'testpass', 'name': 'New'}
+        APIClient().post(CREATE_USER_URL, payload, HTTP_IDEMPOTENCY_KEY='signup', REMOTE_ADDR='10.0.0.1')
+        res = APIClient().post(CREATE_USER_URL, payload, HTTP_IDEMPOTENCY_KEY='signup', REMOTE_ADDR='10.0.0.2')
+
+        self.assertFalse(res.has_header('Idempotent-Replayed'))
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_validation_errors_replayed(self):
+        """Test client errors are stored like any other answer"""
+
+        res = self.client.post(RECIPES_URL, {'title': 'Soup'}, HTTP_IDEMPOTENCY_KEY='k1')
+        retry = self.client.post(RECIPES_URL, {'title': 'Soup'}, HTTP_IDEMPOTENCY_KEY='k1')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0)
+    def test_in_flight_duplicate_gets_conflict(self):
+        """Test a retry arriving while the first request runs is told to come back"""
+
+        self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+        IdempotencyKey.objects.filter(key='k1').update(status_code=None, locked_at=timezone.now())
+
+        res = self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(res['Retry-After'], '1')
+        self.assertEqual(Recipe.objects.filter(user=self.user).count(), 1)
+
+    def test_abandoned_request_taken_over(self):
+        """Test a retry runs a request whose first attempt died in flight"""
+
+        self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+        IdempotencyKey.objects.filter(key='k1').update(status_code=None, locked_at=timezone.now() - timedelta(hours=1))
+
+        res = self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='k1')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Recipe.objects.filter(user=self.user).count(), 2)
+        self.assertIsNotNone(IdempotencyKey.objects.get(key='k1').status_code)
+
+    def test_purge_expired_keys(self):
+        """Test the purge command deletes expired keys only, and an expired key runs again"""
+
+        for key in ('old1', 'old2', 'new'):
+            self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY=key)
+        IdempotencyKey.objects.filter(key__startswith='old').update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.client.post(RECIPES_URL, PAYLOAD, HTTP_IDEMPOTENCY_KEY='old1')
+        out = StringIO()
+
+        call_command('purge_idempotency_keys', '--batch-size', '1', stdout=out)
+
+        self.assertIn('Deleted 1 expired', out.getvalue())
+        self.assertEqual(sorted(IdempotencyKey.objects.values_list('key', flat=True)), ['new', 'old1'])
+        self.assertEqual(Recipe.objects.filter(user=self.user).count(), 4)
@@ -0,0 +1,179 @@
+import os
+import shutil
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from core import images
+from core.images import image_storage
+from core.models import Recipe, StoredImage
+from core.storage import IMAGE_DIR
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ContentAddressedImageTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.addCleanup(shutil.rmtree, MEDIA_ROOT, ignore_errors=True)
+
+    def sample_recipe(self, content=None):
+        recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=1)
+        if content is not None:
+            recipe.image.save('photo.jpg', ContentFile(content))
+        return recipe
+
+    def test_identical_uploads_are_stored_once(self):
+        """Test two recipes with the same image share one file and count two references"""
+
+        recipe1 = self.sample_recipe(b'same bytes')
+        recipe2 = self.sample_recipe(b'same bytes')
+
+        self.assertEqual(recipe1.image.name, recipe2.image.name)
+        self.assertEqual(StoredImage.objects.get(name=recipe1.image.name).refs, 2)
+        directory = os.path.dirname(recipe1.image.path)
+        self.assertEqual(os.listdir(directory), [os.path.basename(recipe1.image.path)])
+
+    def test_replaced_image_is_released_on_commit(self):
+        """Test replacing an image deletes the old file once unreferenced"""
+
+        recipe = self.sample_recipe(b'old bytes')
+        old_path = recipe.image.path
+        recipe = Recipe.objects.get(pk=recipe.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.image.save('photo.jpg', ContentFile(b'new bytes'))
+
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(recipe.image.path))
+
+    def test_shared_image_survives_one_delete(self):
+        """Test deleting one of two recipes sharing an image keeps the file"""
+
+        recipe1 = self.sample_recipe(b'same bytes')
+        self.sample_recipe(b'same bytes')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe1.delete()
+
+        self.assertTrue(image_storage().exists(recipe1.image.name))
+        self.assertEqual(StoredImage.objects.get(name=recipe1.image.name).refs, 1)
+
+    def test_last_reference_deletes_file(self):
+        """Test deleting the only recipe using an image deletes the file"""
+
+        recipe = self.sample_recipe(b'only bytes')
+        name = recipe.image.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.delete()
+
+        self.assertFalse(image_storage().exists(name))
+        self.assertFalse(StoredImage.objects.filter(name=name).exists())
+
+    def test_image_collected_before_counted_is_stored_again(self):
+        """Test an upload of content whose last reference was released concurrently writes the file back"""
+
+        name = self.sample_recipe(b'same bytes').image.name
+        retain = images.retain
+
+        def collected_first(name, content=None):
+            # The release of the last reference took the row lock first
+            image_storage().delete(name)
+            StoredImage.objects.filter(name=name).delete()
+            retain(name, content)
+
+        recipe = Recipe(user=self.user, title='Stew', time_minutes=5, price=1)
+        recipe.image = ContentFile(b'same bytes', name='photo.jpg')
+        with mock.patch('core.images.retain', side_effect=collected_first):
+            recipe.save()
+
+        self.assertEqual(recipe.image.name, name)
+        self.assertTrue(image_storage().exists(name))
+        self.assertEqual(StoredImage.objects.get(name=name).refs, 1)
+
+    def test_migrate_legacy_images(self):
+        """Test the migration command renames uuid files to their content hash"""
+
+        legacy_storage = FileSystemStorage()
+        legacy1 = legacy_storage.save('uploads/recipe/0000-legacy.jpg', ContentFile(b'legacy bytes'))
+        legacy2 = legacy_storage.save('uploads/recipe/1111-legacy.jpg', ContentFile(b'legacy bytes'))
+        recipe1 = self.sample_recipe()
+        recipe2 = self.sample_recipe()
+        Recipe.objects.filter(pk=recipe1.pk).update(image=legacy1)
+        Recipe.objects.filter(pk=recipe2.pk).update(image=legacy2)
+        out = StringIO()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('migrate_recipe_images', stdout=out)
+
+        recipe1.refresh_from_db()
+        recipe2.refresh_from_db()
+        self.assertIn('moved 1, deduplicated 1', out.getvalue())
+        self.assertEqual(recipe1.image.name, recipe2.image.name)
+        self.assertRegex(recipe1.image.name, r'^uploads/recipe/\w{2}/\w{2}/\w{64}\.jpg$')
+        self.assertFalse(image_storage().exists(legacy1))
+        self.assertFalse(image_storage().exists(legacy2))
+        self.assertEqual(StoredImage.objects.get(name=recipe1.image.name).refs, 2)
+
+    def test_collect_orphans(self):
+        """Test the collector deletes old unreferenced files and keeps referenced or recent ones"""
+
+        recipe = self.sample_recipe(b'kept bytes')
+        orphan = image_storage().save('photo.jpg', ContentFile(b'orphan bytes'))
+        recent = image_storage().save('photo.jpg', ContentFile(b'recent bytes'))
+        old = time.time() - 7200
+        for name in (recipe.image.name, orphan):
+            os.utime(image_storage().path(name), (old, old))
+        out = StringIO()
+
+        call_command('collect_orphan_images', '--grace-seconds', '3600', stdout=out)
+
+        self.assertIn('Scanned 3 files, deleted 1 orphans reclaiming 12 bytes', out.getvalue())
+        self.assertFalse(image_storage().exists(orphan))
+        self.assertTrue(image_storage().exists(recipe.image.name))
+        self.assertTrue(image_storage().exists(recent))
+
+    def test_collect_orphans_skips_files_referenced_since_scan(self):
+        """Test files counted or saved again after the scan are not deleted"""
+
+        counted = image_storage().save('photo.jpg', ContentFile(b'counted bytes'))
+        StoredImage.objects.create(name=counted, refs=1)
+        saved_again = image_storage().save('photo.jpg', ContentFile(b'saved again bytes'))
+        os.utime(image_storage().path(counted), (0, 0))
+        scanned = [(name, size, 0) for name, size, _ in images._walk(image_storage(), IMAGE_DIR)]
+
+        with mock.patch('core.images._walk', return_value=iter(scanned)):
+            stats = images.collect_orphans(3600)
+
+        self.assertEqual(stats['deleted'], 0)
+        self.assertTrue(image_storage().exists(counted))
+        self.assertTrue(image_storage().exists(saved_again))
+
+    def test_collect_orphans_dry_run(self):
+        """Test a dry run only reports orphans"""
+
+        orphan = image_storage().save('photo.jpg', ContentFile(b'orphan bytes'))
+        out = StringIO()
+
+        call_command('collect_orphan_images', '--grace-seconds', '0', '--dry-run', stdout=out)
+
+        self.assertIn('would delete 1 orphans', out.getvalue())
+        self.assertTrue(image_storage().exists(orphan))
+
+    def test_saving_known_content_refreshes_mtime(self):
+        """Test saving existing content protects the file from collection again"""
+
+        name = image_storage().save('photo.jpg', ContentFile(b'same bytes'))
+        os.utime(image_storage().path(name), (0, 0))
+
+        image_storage().save('photo.jpg', ContentFile(b'same bytes'))
+
+        self.assertGreater(os.path.getmtime(image_storage().path(name)), time.time() - 60)
@@ -0,0 +1,116 @@
+from datetime import timedelta
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from core import db_routers, jobs
+from core.models import Job
+
+calls = []
+
+
+@jobs.job('test.ok')
+def ok_job(job):
+    calls.append(job.payload)
+    return {'echo': job.payload}
+
+
+@jobs.job('test.broken')
+def broken_job(job):
+    raise RuntimeError('boom')
+
+
+class JobTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+
+    def test_enqueue_unknown_job(self):
+        """Test queuing a job without handler fails"""
+
+        with self.assertRaises(ValueError):
+            jobs.enqueue('test.missing')
+
+    def test_run_job_success(self):
+        """Test a claimed job runs and stores its result"""
+
+        job = jobs.enqueue('test.ok', user=self.user, value=1)
+        self.assertEqual(jobs.claim(10), [job.id])
+
+        job = jobs.run(job.id)
+
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.result, {'echo': {'value': 1}})
+        self.assertEqual(job.attempts, 1)
+
+    def test_failed_job_is_retried_later(self):
+        """Test a failing job goes back to the queue with a backoff"""
+
+        job = jobs.enqueue('test.broken')
+        jobs.claim(1)
+
+        job = jobs.run(job.id)
+
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertIn('boom', job.error)
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertEqual(jobs.claim(1), [])
+
+    def test_failed_job_gives_up(self):
+        """Test a job failing on its last attempt is marked failed"""
+
+        job = jobs.enqueue('test.broken', max_attempts=1)
+        jobs.claim(1)
+
+        self.assertEqual(jobs.run(job.id).status, Job.FAILED)
+
+    @override_settings(DATABASE_SHARDS=['default', 'shard1'])
+    def test_job_of_moving_user_postponed(self):
+        """Test a job of a user moving to another shard waits without using up an attempt"""
+
+        calls.clear()
+        job = jobs.enqueue('test.ok', user=self.user, max_attempts=1)
+        jobs.claim(1)
+        db_routers.fence_writes(self.user.pk)
+        self.addCleanup(db_routers.lift_fence, self.user.pk)
+
+        job = jobs.run(job.id)
+
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertEqual(job.attempts, 0)
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertEqual(calls, [])
+
+    def test_claim_is_exclusive(self):
+        """Test a job is only claimed once"""
+
+        jobs.enqueue('test.ok')
+
+        self.assertEqual(len(jobs.claim(10)), 1)
+        self.assertEqual(jobs.claim(10), [])
+
+    def test_requeue_stale_jobs(self):
+        """Test jobs left running by a dead worker are queued again"""
+
+        job = jobs.enqueue('test.ok')
+        jobs.claim(1)
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(days=1))
+
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(jobs.claim(1), [job.id])
+
+
+class RunWorkerCommandTests(TransactionTestCase):
+
+    def test_burst_worker_drains_queue(self):
+        """Test the worker runs every queued job and exits"""
+
+        calls.clear()
+        for i in range(3):
+            jobs.enqueue('test.ok', value=i)
+
+        call_command('run_worker', '--burst', '--concurrency', '1', '--poll-interval', '0.01', stdout=StringIO())
+
+        self.assertEqual(Job.objects.filter(status=Job.SUCCEEDED).count(), 3)
+        self.assertEqual(sorted(call['value'] for call in calls), [0, 1, 2])
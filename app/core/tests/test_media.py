@@ -0,0 +1,133 @@
+import shutil
+import tempfile
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core.models import Recipe
+
+MEDIA_ROOT = tempfile.mkdtemp()
+CONTENT = b'0123456789' * 10
+
+
+def media_url(name):
+    return reverse('media', args=[name])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, MEDIA_SENDFILE=None)
+class MediaApiTests(TestCase):
+    """Test serving media files to their owners"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.addCleanup(shutil.rmtree, MEDIA_ROOT, ignore_errors=True)
+        self.recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=1)
+        self.recipe.image.save('photo.jpg', ContentFile(CONTENT))
+        self.url = media_url(self.recipe.image.name)
+
+    def test_login_required(self):
+        """Test that media needs authentication"""
+
+        res = APIClient().get(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_owner_gets_immutable_image(self):
+        """Test the owner downloads a content addressed image cacheable forever"""
+
+        res = self.client.get(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(res.streaming_content), CONTENT)
+        self.assertEqual(res['Content-Type'], 'image/jpeg')
+        self.assertEqual(res['Content-Length'], str(len(CONTENT)))
+        self.assertIn('immutable', res['Cache-Control'])
+        self.assertIn('private', res['Cache-Control'])
+
+    def test_other_user_image_not_found(self):
+        """Test an image of another user is not served"""
+
+        other = get_user_model().objects.create_user('other@email.com', 'testpass')
+        self.client.force_authenticate(user=other)
+
+        res = self.client.get(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_path_traversal_not_found(self):
+        """Test names leaving the user's export directory are refused"""
+
+        res = self.client.get(media_url(f'exports/{self.user.id}/../{self.user.id + 1}/recipes.json'))
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_own_export(self):
+        """Test users download their exports, which must be revalidated"""
+
+        name = default_storage.save(f'exports/{self.user.id}/recipes-1.json', ContentFile(b'[]'))
+
+        res = self.client.get(media_url(name))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(res.streaming_content), b'[]')
+        self.assertEqual(res['Cache-Control'], 'private, no-cache')
+
+    def test_range_request(self):
+        """Test a byte range is answered with partial content"""
+
+        res = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(res.streaming_content), CONTENT[10:20])
+        self.assertEqual(res['Content-Range'], f'bytes 10-19/{len(CONTENT)}')
+        self.assertEqual(res['Content-Length'], '10')
+
+    def test_suffix_range_request(self):
+        """Test a suffix range returns the end of the file"""
+
+        res = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(res.streaming_content), CONTENT[-5:])
+
+    def test_unsatisfiable_range(self):
+        """Test a range past the end of the file is refused"""
+
+        res = self.client.get(self.url, HTTP_RANGE='bytes=1000-')
+
+        self.assertEqual(res.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(res['Content-Range'], f'bytes */{len(CONTENT)}')
+
+    def test_if_none_match(self):
+        """Test a cached copy is revalidated without a body"""
+
+        etag = self.client.get(self.url)['ETag']
+
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    @override_settings(MEDIA_SENDFILE='x-accel-redirect', MEDIA_ACCEL_REDIRECT_PREFIX='/protected-media/')
+    def test_accel_redirect(self):
+        """Test nginx is asked to send the file when configured"""
+
+        res = self.client.get(self.url)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['X-Accel-Redirect'], f'/protected-media/{self.recipe.image.name}')
+        self.assertEqual(res.content, b'')
+        self.assertIn('immutable', res['Cache-Control'])
+
+    @override_settings(MEDIA_SENDFILE='x-sendfile')
+    def test_sendfile(self):
+        """Test the front-end server gets the file path when configured"""
+
+        res = self.client.get(self.url)
+
+        self.assertEqual(res['X-Sendfile'], self.recipe.image.path)
+        self.assertEqual(res.content, b'')
@@ -0,0 +1,82 @@
+import os
+import shutil
+import signal
+import tempfile
+import tracemalloc
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core import memory, metrics
+
+MEMORY_URL = reverse('memory')
+SNAPSHOT_DIR = tempfile.mkdtemp()
+
+
+def allocate():
+    return [bytearray(1024) for _ in range(1000)]
+
+
+@override_settings(MEMORY_SNAPSHOT_DIR=SNAPSHOT_DIR, MEMORY_TRACE_FRAMES=1)
+class MemoryTests(TestCase):
+
+    def setUp(self):
+        was_tracing = tracemalloc.is_tracing()
+        self.addCleanup(lambda: None if was_tracing else memory.stop())
+        self.addCleanup(shutil.rmtree, SNAPSHOT_DIR, ignore_errors=True)
+        self.addCleanup(signal.signal, memory.SNAPSHOT_SIGNAL, signal.getsignal(memory.SNAPSHOT_SIGNAL))
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_module_name(self):
+        """Test files are named by their module, relative to the longest sys.path entry"""
+
+        self.assertEqual(memory.module_name(memory.__file__), 'core.memory')
+        self.assertEqual(memory.module_name('/nowhere/file.py'), '/nowhere/file.py')
+
+    def test_endpoint_reports_growth_since_baseline(self):
+        """Test staff see the modules that allocated since the baseline"""
+
+        self.user.is_staff = True
+        self.user.save()
+
+        res = self.client.post(MEMORY_URL)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        retained = allocate()
+        res = self.client.get(MEMORY_URL, {'limit': 50})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['pid'], os.getpid())
+        [row] = [row for row in res.data['modules'] if row['module'] == __name__]
+        self.assertGreaterEqual(row['size_diff'], 1000 * 1024)
+        del retained
+
+    def test_endpoint_staff_only(self):
+        """Test other users cannot profile the worker"""
+
+        res = self.client.post(MEMORY_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(MEMORY_PROFILING_ENABLED=True, MEMORY_SAMPLE_RATE=1.0)
+    def test_request_peaks_and_snapshot_command(self):
+        """Test sampled requests record their peak, and the command diffs snapshots of a worker"""
+
+        key = ('http_request_peak_alloc_bytes', (('route', 'recipe:tag-list'),))
+        sampled = metrics._local_state()['histograms'].get(key, [None, None, 0, 0])[3]
+        self.client.get(reverse('recipe:tag-list'))
+        self.assertEqual(metrics._local_state()['histograms'][key][3], sampled + 1)
+
+        out = StringIO()
+        call_command('memory_snapshot', os.getpid(), stdout=out)
+        retained = allocate()
+        call_command('memory_snapshot', os.getpid(), stdout=out)
+
+        self.assertEqual(len(memory.snapshot_files(os.getpid())), 2)
+        self.assertIn('First snapshot', out.getvalue())
+        self.assertIn(f'  {__name__}\n', out.getvalue())
+        del retained
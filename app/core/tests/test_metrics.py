@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core import metrics
+
+METRICS_URL = reverse('metrics')
+# Far above any pid_max, never a live process
+DEAD_PID = 999999999
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        settings = override_settings(METRICS_DIR=self.directory, METRICS_TOKEN='scrape-token')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_render(self):
+        """Test histograms are rendered with cumulative buckets and label values escaped"""
+
+        state = metrics._empty()
+        metrics._merge(state, {
+            'counters': {('uploads_total', (('name', 'a "b"\n'),)): 2},
+            'gauges': {('in_flight', ()): 1},
+            'histograms': {('latency_seconds', (('route', 'r'),)): ((0.1, 1), [1, 2, 3], 9.5, 6)},
+        })
+
+        self.assertEqual(metrics.render(state), '\n'.join([
+            '# TYPE in_flight gauge',
+            'in_flight 1',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{route="r",le="0.1"} 1',
+            'latency_seconds_bucket{route="r",le="1"} 3',
+            'latency_seconds_bucket{route="r",le="+Inf"} 6',
+            'latency_seconds_sum{route="r"} 9.5',
+            'latency_seconds_count{route="r"} 6',
+            '# TYPE uploads_total counter',
+            'uploads_total{name="a \\"b\\"\\n"} 2',
+        ]) + '\n')
+
+    def test_collect_merges_processes(self):
+        """Test metrics of other processes are summed, and those of exited ones archived without gauges"""
+
+        for pid, value in ((os.getppid(), 2), (DEAD_PID, 3)):
+            metrics._dump({
+                'counters': {('jobs_total', (('kind', 'x'),)): value},
+                'gauges': {('workers', ()): 1},
+                'histograms': {('wait_seconds', ()): ((1,), [value, 0], 0.5, value)},
+            }, os.path.join(self.directory, f'{pid}.json'))
+
+        for _ in range(2):
+            state = metrics.collect()
+
+            self.assertEqual(state['counters'][('jobs_total', (('kind', 'x'),))], 5)
+            self.assertEqual(state['gauges'][('workers', ())], 1)
+            self.assertEqual(state['histograms'][('wait_seconds', ())][1:], [[5, 0], 1.0, 5])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, f'{DEAD_PID}.json')))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, metrics.ARCHIVE)))
+
+    def test_requests_counted(self):
+        """Test API requests are measured per route, with the queries they run"""
+
+        user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        client.get(reverse('recipe:tag-list'))
+        res = self.client.get(METRICS_URL, HTTP_AUTHORIZATION='Bearer scrape-token')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], metrics.CONTENT_TYPE)
+        body = res.content.decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="recipe:tag-list"}', body)
+        self.assertIn('http_requests_total{method="GET",route="recipe:tag-list",status="200"}', body)
+        self.assertIn('db_queries_total{alias="default"}', body)
+        self.assertIn('http_requests_in_flight 1', body)
+
+    def test_scrapes_need_token(self):
+        """Test scrapers without the METRICS_TOKEN bearer token are refused, whatever their address"""
+
+        for headers in ({}, {'HTTP_AUTHORIZATION': 'Bearer wrong'}, {'HTTP_AUTHORIZATION': 'Token scrape-token'}):
+            res = self.client.get(METRICS_URL, REMOTE_ADDR='127.0.0.1', **headers)
+
+            self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_not_served_without_token(self):
+        """Test /metrics is off until a METRICS_TOKEN is set"""
+
+        res = self.client.get(METRICS_URL, HTTP_AUTHORIZATION='Bearer ')
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
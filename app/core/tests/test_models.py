@@ -1,9 +1,11 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 from ..models import Tag, Ingredient, Recipe
-from unittest.mock import patch
+from django.core.files.base import ContentFile
 from .. import models
+import hashlib
+import tempfile
 
 
 def sample_user(email='test@email.com', password='testpass'):
@@ -76,14 +78,14 @@ class ModelTests(TestCase):
 
         self.assertEqual(str(recipe), recipe.title)
 
-    @patch('uuid.uuid4')
-    def test_recipe_file_name_uuid(self, mock_uuid):
-        """Test that image is saved in the correct location"""
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_recipe_file_name_content_hash(self):
+        """Test that image is saved under the fanned out hash of its content"""
 
-        uuid = 'test-uuid'
-        mock_uuid.return_value = uuid
-        file_path = models.recipe_image_file_path(None, 'myimage.jpg')
+        field = models.Recipe._meta.get_field('image')
+        file_path = field.storage.save(field.generate_filename(None, 'myimage.JPG'), ContentFile(b'image content'))
 
-        exp_path = f'uploads/recipe/{uuid}.jpg'
+        digest = hashlib.sha256(b'image content').hexdigest()
+        exp_path = f'uploads/recipe/{digest[:2]}/{digest[2:4]}/{digest}.jpg'
 
         self.assertEqual(file_path, exp_path)
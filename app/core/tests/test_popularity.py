@@ -0,0 +1,131 @@
+import threading
+import time
+from unittest.mock import patch
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from core import deletion
+from core.models import Recipe, RecipePopularity
+from core.popularity import PopularityCounter, event_score, logaddexp, trending
+
+DAY = 24 * 60 * 60
+
+
+def sample_recipe(user, title='Soup'):
+    return Recipe.objects.create(user=user, title=title, time_minutes=5, price=1)
+
+
+@override_settings(POPULARITY_FLUSH_SIZE=1000, POPULARITY_FLUSH_SECONDS=DAY, TRENDING_HALF_LIFE_SECONDS=DAY)
+class PopularityFlusherTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.recipe = sample_recipe(self.user)
+        self.counter = PopularityCounter()
+        self.flushed = threading.Event()
+        flushing_threads = set()
+        flush = self.counter.flush
+        close_all = connections.close_all
+
+        def flush_noting_thread(*args, **kwargs):
+            flushing_threads.add(threading.get_ident())
+            return flush(*args, **kwargs)
+
+        def close_all_once_flushed():
+            close_all()
+            # Flushing threads of other counters close their connections too
+            if threading.get_ident() in flushing_threads:
+                self.flushed.set()
+
+        for patcher in (
+            patch.object(self.counter, 'flush', side_effect=flush_noting_thread),
+            patch.object(connections, 'close_all', side_effect=close_all_once_flushed),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @override_settings(POPULARITY_FLUSH_SIZE=1, POPULARITY_FLUSH_SECONDS=DAY)
+    def test_flush_at_size_threshold(self):
+        """Test pending counts are written in the background once enough recipes are pending"""
+
+        self.counter.record(DEFAULT_DB_ALIAS, self.recipe.id, views=1)
+
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(RecipePopularity.objects.get(recipe=self.recipe).views, 1)
+
+    @override_settings(POPULARITY_FLUSH_SIZE=1000, POPULARITY_FLUSH_SECONDS=0.1)
+    def test_flush_after_interval(self):
+        """Test pending counts are written in the background after the flush interval, without any request"""
+
+        self.counter.record(DEFAULT_DB_ALIAS, self.recipe.id, cooks=1)
+
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(RecipePopularity.objects.get(recipe=self.recipe).cooks, 1)
+
+
+class PopularityTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.counter = PopularityCounter()
+
+    def test_events_are_coalesced(self):
+        """Test repeated events of a recipe are written as one update"""
+
+        recipe = sample_recipe(self.user)
+        for _ in range(5):
+            self.counter.record(DEFAULT_DB_ALIAS, recipe.id, views=1)
+        self.counter.record(DEFAULT_DB_ALIAS, recipe.id, cooks=1)
+
+        with self.assertNumQueries(5):
+            self.assertEqual(self.counter.flush(), 1)
+
+        row = RecipePopularity.objects.get(recipe=recipe)
+        self.assertEqual((row.views, row.cooks, row.user_id), (5, 1, self.user.id))
+        self.assertAlmostEqual(row.score, logaddexp(event_score(5), event_score(5)), places=2)
+
+    def test_flushes_add_up(self):
+        """Test counts of later flushes add to the stored ones"""
+
+        recipe = sample_recipe(self.user)
+        self.counter.record(DEFAULT_DB_ALIAS, recipe.id, views=1, at=1000)
+        self.counter.flush()
+        self.counter.record(DEFAULT_DB_ALIAS, recipe.id, views=1, at=1000)
+        self.counter.flush()
+
+        row = RecipePopularity.objects.get(recipe=recipe)
+        self.assertEqual(row.views, 2)
+        self.assertAlmostEqual(row.score, event_score(2, at=1000), places=6)
+
+    def test_deleted_recipes_are_skipped(self):
+        """Test counts of recipes deleted before the flush are dropped"""
+
+        recipe = sample_recipe(self.user)
+        self.counter.record(DEFAULT_DB_ALIAS, recipe.id, views=1)
+        recipe.delete()
+
+        self.assertEqual(self.counter.flush(), 0)
+        self.assertFalse(RecipePopularity.objects.exists())
+
+    def test_trending_decays_old_events(self):
+        """Test recent events outrank more numerous old ones"""
+
+        old = sample_recipe(self.user, 'Old favourite')
+        new = sample_recipe(self.user, 'New hit')
+        now = time.time()
+        self.counter.record(DEFAULT_DB_ALIAS, old.id, views=10, at=now - 7 * DAY)
+        self.counter.record(DEFAULT_DB_ALIAS, new.id, views=2, at=now)
+        self.counter.flush()
+
+        self.assertEqual(trending(self.user, 10), [new.id, old.id])
+
+    def test_bulk_delete_drops_popularity(self):
+        """Test raw recipe deletes remove their popularity rows"""
+
+        recipe = sample_recipe(self.user)
+        self.counter.record(DEFAULT_DB_ALIAS, recipe.id, views=1)
+        self.counter.flush()
+
+        deletion.delete_recipes(self.user, [recipe.id])
+
+        self.assertFalse(RecipePopularity.objects.exists())
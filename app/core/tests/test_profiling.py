@@ -0,0 +1,90 @@
+import glob
+import os
+import shutil
+import tempfile
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from core.profiling import ProfilingMiddleware, endpoint_dir
+
+PROFILING_DIR = tempfile.mkdtemp()
+TAGS_URL = reverse('recipe:tag-list')
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0.0, PROFILING_DIR=PROFILING_DIR)
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        self.addCleanup(shutil.rmtree, PROFILING_DIR, ignore_errors=True)
+        self.staff = get_user_model().objects.create_user('staff@email.com', 'testpass', is_staff=True)
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+
+    def profiles(self, pattern='*'):
+        return glob.glob(os.path.join(endpoint_dir('recipe:tag-list'), pattern))
+
+    @override_settings(PROFILING_ENABLED=False)
+    def test_disabled_middleware_not_used(self):
+        """Test the middleware takes itself out of the chain when disabled"""
+
+        with self.assertRaises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: None)
+
+    def test_staff_header_profiles_request(self):
+        """Test staff get their request profiled with X-Profile"""
+
+        token = Token.objects.create(user=self.staff)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        res = self.client.get(TAGS_URL, HTTP_X_PROFILE='1')
+
+        self.assertEqual(len(self.profiles('*.pstats')), 1)
+        self.assertIn(res['X-Profile-Id'], self.profiles()[0])
+
+    def test_header_ignored_for_other_users(self):
+        """Test X-Profile from non staff users is ignored"""
+
+        token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        res = self.client.get(TAGS_URL, HTTP_X_PROFILE='1')
+
+        self.assertFalse(res.has_header('X-Profile-Id'))
+        self.assertEqual(self.profiles(), [])
+
+    @override_settings(PROFILING_SAMPLE_RATE=1.0, PROFILING_MODE='sample', PROFILING_SAMPLE_INTERVAL=0.0001)
+    def test_sampled_requests_write_collapsed_stacks(self):
+        """Test sampled requests are profiled with the stack sampler"""
+
+        self.client.force_authenticate(user=self.user)
+
+        self.client.get(TAGS_URL)
+
+        [path] = self.profiles('*.collapsed')
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                self.assertIn(';', stack)
+                self.assertGreater(int(count), 0)
+
+    @override_settings(PROFILING_SAMPLE_RATE=1.0, PROFILING_MAX_FILES=2)
+    def test_aggregate_and_diff_profiles(self):
+        """Test the command aggregates the kept profiles and compares them with a baseline"""
+
+        self.client.force_authenticate(user=self.user)
+        for _ in range(3):
+            self.client.get(TAGS_URL)
+        self.client.get(reverse('recipe:ingredient-list'))
+        out = StringIO()
+
+        call_command('aggregate_profiles', 'recipe:tag-list', stdout=out)
+        call_command('aggregate_profiles', 'recipe:tag-list', '--baseline', 'recipe:ingredient-list', stdout=out)
+
+        self.assertEqual(len(self.profiles()), 2)
+        self.assertIn('2 cProfile profiles', out.getvalue())
+        self.assertIn('ms per request', out.getvalue())
@@ -0,0 +1,239 @@
+"""Query and time budgets of the API endpoints
+
+Every endpoint is requested against datasets of growing size. Its query count
+must not grow with the data and must stay within the budget recorded in
+query_budgets.json, as must the time it takes to serve the largest dataset and,
+apart from it, the time its serializers take to render the response data.
+After an intended change, record new budgets with
+
+    UPDATE_QUERY_BUDGETS=1 python manage.py test core.tests.test_query_budgets
+"""
+import difflib
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import patch
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+from rest_framework.serializers import BaseSerializer
+from rest_framework.test import APIClient
+from core import jobs, throttling, popularity
+from core.models import Recipe, Tag, Ingredient, RecipePopularity
+
+BUDGETS_FILE = os.path.join(os.path.dirname(__file__), 'query_budgets.json')
+UPDATE_BUDGETS = bool(os.environ.get('UPDATE_QUERY_BUDGETS'))
+SIZES = (1, 5, 25)
+# Timings vary between machines and runs, only a clear regression fails
+TIME_TOLERANCE = 3
+TIME_SLACK_MS = 50
+TIME_RUNS = 3
+MEDIA_ROOT = tempfile.mkdtemp()
+# Writes repeating the stored values change nothing and run fewer queries, each one writes new values
+_writes = itertools.count(1)
+
+
+def sample_image(n):
+    """Return a JPEG upload of a size no other call uses"""
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (10 + n, 10), 'red').save(buffer, format='JPEG')
+    buffer.seek(0)
+    buffer.name = 'photo.jpg'
+    return buffer
+
+
+# name -> function of the seeded object ids and a number new to every call, returning (method, url, data)
+ENDPOINTS = {
+    'recipe-list': lambda ids, n: ('get', reverse('recipe:recipe-list'), None),
+    'recipe-list-by-tag': lambda ids, n: (
+        'get', reverse('recipe:recipe-list') + '?tags=' + ','.join(map(str, ids['tags'][:3])), None
+    ),
+    'recipe-multi-get': lambda ids, n: (
+        'get', reverse('recipe:recipe-list') + '?ids=' + ','.join(map(str, ids['recipes'])), None
+    ),
+    'recipe-detail': lambda ids, n: ('get', reverse('recipe:recipe-detail', args=[ids['recipes'][-1]]), None),
+    'recipe-create': lambda ids, n: ('post', reverse('recipe:recipe-list'), {
+        'title': 'New recipe', 'time_minutes': 10, 'price': '5.00',
+        'tags': ids['tags'][:2], 'ingredients': ids['ingredients'][:2],
+    }),
+    'recipe-update': lambda ids, n: ('patch', reverse('recipe:recipe-detail', args=[ids['recipes'][-1]]), {
+        'title': f'Renamed recipe {n}', 'price': f'{10 + n}.00',
+    }),
+    'recipe-upload-image': lambda ids, n: (
+        'post', reverse('recipe:recipe-upload-image', args=[ids['recipes'][-1]]), {'image': sample_image(n)}
+    ),
+    'recipe-trending': lambda ids, n: ('get', reverse('recipe:recipe-trending'), None),
+    'recipe-stats': lambda ids, n: ('get', reverse('recipe:recipe-stats'), None),
+    'tag-list': lambda ids, n: ('get', reverse('recipe:tag-list'), None),
+    'tag-list-assigned': lambda ids, n: ('get', reverse('recipe:tag-list') + '?assigned_only=1', None),
+    'tag-create': lambda ids, n: ('post', reverse('recipe:tag-list'), {'name': f'New tag {n}'}),
+    'ingredient-list': lambda ids, n: ('get', reverse('recipe:ingredient-list'), None),
+    'sync': lambda ids, n: ('get', reverse('recipe:sync'), None),
+    'job-list': lambda ids, n: ('get', reverse('job:job-list'), None),
+    'user-me': lambda ids, n: ('get', reverse('user:me'), None),
+    'batch': lambda ids, n: ('post', reverse('batch'), {'requests': [
+        reverse('recipe:recipe-list'), reverse('recipe:tag-list'), reverse('recipe:ingredient-list'),
+    ]}),
+}
+# Endpoints not sent as JSON
+FORMATS = {'recipe-upload-image': 'multipart'}
+
+
+def seed(user, size):
+    """Grow the user's data to `size` recipes, tags, ingredients and jobs, with two tags and ingredients a recipe"""
+
+    for i in range(Recipe.objects.filter(user=user).count(), size):
+        tag = Tag.objects.create(user=user, name=f'Tag {i}')
+        ingredient = Ingredient.objects.create(user=user, name=f'Ingredient {i}')
+        recipe = Recipe.objects.create(user=user, title=f'Recipe {i}', time_minutes=10, price=5)
+        recipe.tags.add(tag, Tag.objects.filter(user=user).order_by('id').first())
+        recipe.ingredients.add(ingredient, Ingredient.objects.filter(user=user).order_by('id').first())
+        jobs.enqueue('recipe.export', user=user)
+        RecipePopularity.objects.create(recipe=recipe, user=user, views=i, score=i)
+    return {
+        'recipes': list(Recipe.objects.filter(user=user).order_by('id').values_list('id', flat=True)),
+        'tags': list(Tag.objects.filter(user=user).order_by('id').values_list('id', flat=True)),
+        'ingredients': list(Ingredient.objects.filter(user=user).order_by('id').values_list('id', flat=True)),
+    }
+
+
+class SerializerTimer:
+    """Add up the time spent rendering serializer `.data` while active, nested serializers counted once"""
+
+    def __init__(self):
+        self.elapsed = 0
+        self._depth = 0
+        self._patch = patch.object(BaseSerializer, 'data', property(self._timed(BaseSerializer.data.fget)))
+
+    def _timed(self, data):
+        def timed_data(serializer):
+            self._depth += 1
+            start = time.perf_counter()
+            try:
+                return data(serializer)
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    self.elapsed += time.perf_counter() - start
+        return timed_data
+
+    def __enter__(self):
+        self._patch.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._patch.stop()
+
+
+def sql_diff(expected, actual):
+    """Return a unified diff of two captured query lists"""
+
+    return '\n'.join(difflib.unified_diff(
+        [query['sql'] for query in expected], [query['sql'] for query in actual],
+        'expected queries', 'actual queries', lineterm='',
+    ))
+
+
+# Popularity counts are only written by explicit flushes, not in the middle of a measurement
+@override_settings(POPULARITY_FLUSH_SECONDS=24 * 60 * 60, MEDIA_ROOT=MEDIA_ROOT)
+class QueryBudgetTests(TestCase):
+    """Test that no endpoint's query count grows with the data, or exceeds its budget"""
+
+    measured = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        try:
+            with open(BUDGETS_FILE) as f:
+                cls.budgets = json.load(f)
+        except FileNotFoundError:
+            cls.budgets = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if UPDATE_BUDGETS and cls.measured:
+            with open(BUDGETS_FILE, 'w') as f:
+                json.dump({**cls.budgets, **cls.measured}, f, indent=2, sort_keys=True)
+                f.write('\n')
+        super().tearDownClass()
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass', name='Test')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        throttling.get_bucket_store().clear()
+        popularity.counter.flush()
+        self.addCleanup(shutil.rmtree, MEDIA_ROOT, ignore_errors=True)
+
+    def request(self, name, ids):
+        method, url, data = ENDPOINTS[name](ids, next(_writes))
+        res = getattr(self.client, method)(url, data, format=FORMATS.get(name, 'json'))
+        self.assertLess(res.status_code, 400, f'{name}: {res.status_code} {getattr(res, "data", "")}')
+        return res
+
+    def measure(self, name):
+        """Return the queries an endpoint runs at every size, and its best time and serializer time at the largest"""
+
+        captured = {}
+        for size in SIZES:
+            ids = seed(self.user, size)
+            with CaptureQueriesContext(connection) as queries:
+                self.request(name, ids)
+            captured[size] = queries.captured_queries
+        elapsed = []
+        serializing = []
+        for _ in range(TIME_RUNS):
+            with SerializerTimer() as timer:
+                start = time.perf_counter()
+                self.request(name, ids)
+                elapsed.append((time.perf_counter() - start) * 1000)
+            serializing.append(timer.elapsed * 1000)
+        return captured, min(elapsed), min(serializing)
+
+    def test_endpoint_budgets(self):
+        """Test every endpoint against datasets of growing size"""
+
+        for name in ENDPOINTS:
+            with self.subTest(endpoint=name):
+                captured, elapsed_ms, serialize_ms = self.measure(name)
+                smallest, largest = captured[SIZES[0]], captured[SIZES[-1]]
+                for size, queries in captured.items():
+                    self.assertEqual(
+                        len(queries), len(smallest),
+                        f'{name} runs {len(queries)} queries for {size} rows but {len(smallest)} for '
+                        f'{SIZES[0]}:\n{sql_diff(smallest, queries)}'
+                    )
+
+                if UPDATE_BUDGETS:
+                    self.measured[name] = {
+                        'queries': len(largest), 'ms': round(elapsed_ms, 1), 'serialize_ms': round(serialize_ms, 1),
+                    }
+                    continue
+                budget = self.budgets.get(name)
+                self.assertIsNotNone(budget, f'{name} has no budget, record one with UPDATE_QUERY_BUDGETS=1')
+                self.assertLessEqual(
+                    len(largest), budget['queries'],
+                    f'{name} runs {len(largest)} queries, its budget is {budget["queries"]}:\n'
+                    + '\n'.join(query['sql'] for query in largest)
+                )
+                limit_ms = budget['ms'] * TIME_TOLERANCE + TIME_SLACK_MS
+                self.assertLessEqual(
+                    elapsed_ms, limit_ms,
+                    f'{name} took {elapsed_ms:.1f}ms for {SIZES[-1]} rows, over {limit_ms:.1f}ms '
+                    f'({TIME_TOLERANCE}x its {budget["ms"]}ms baseline)'
+                )
+                limit_ms = budget['serialize_ms'] * TIME_TOLERANCE + TIME_SLACK_MS
+                self.assertLessEqual(
+                    serialize_ms, limit_ms,
+                    f'{name} serializers took {serialize_ms:.1f}ms for {SIZES[-1]} rows, over {limit_ms:.1f}ms '
+                    f'({TIME_TOLERANCE}x their {budget["serialize_ms"]}ms baseline)'
+                )
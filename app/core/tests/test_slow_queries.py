@@ -0,0 +1,72 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core.models import Tag
+from core.slow_queries import fingerprint, slow_query_log
+
+SLOW_QUERIES_URL = reverse('slow-queries')
+
+
+@override_settings(SLOW_QUERY_THRESHOLD_MS=0)
+class SlowQueryTests(TestCase):
+
+    def setUp(self):
+        slow_query_log.clear()
+        self.addCleanup(slow_query_log.clear)
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_fingerprint(self):
+        """Test queries differing only by their values share a fingerprint"""
+
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE a IN (%s, %s, %s) AND b = 'x''y' LIMIT 21"),
+            'SELECT * FROM t WHERE a IN (...) AND b = ? LIMIT ?',
+        )
+        self.assertEqual(
+            fingerprint('INSERT INTO t (a, b)\n VALUES (%s, %s), (%s, %s)'),
+            fingerprint('INSERT INTO t (a, b) VALUES (%s, %s)'),
+        )
+
+    def test_slow_queries_aggregated_with_plan(self):
+        """Test slow queries of recipe views are counted per fingerprint with their view and plan"""
+
+        Tag.objects.create(user=self.user, name='Vegan')
+
+        with self.assertLogs('core.slow_queries', 'WARNING'):
+            self.client.get(reverse('recipe:tag-list'))
+            self.client.get(reverse('recipe:tag-list'))
+        slow_query_log.wait()
+
+        [entry] = [entry for entry in slow_query_log.entries() if 'core_tag' in entry['fingerprint']]
+        self.assertEqual(entry['count'], 2)
+        self.assertEqual(entry['views'], {'recipe:tag-list': 2})
+        self.assertIn('core_tag', entry['plan'])
+
+    def test_other_apps_not_observed(self):
+        """Test queries of views outside SLOW_QUERY_APPS are not logged"""
+
+        self.client.get(reverse('job:job-list'))
+
+        self.assertEqual(slow_query_log.entries(), [])
+
+    def test_endpoint_staff_only(self):
+        """Test only staff can list the slow queries"""
+
+        with self.assertLogs('core.slow_queries', 'WARNING'):
+            self.client.get(reverse('recipe:tag-list'))
+        slow_query_log.wait()
+
+        res = self.client.get(SLOW_QUERIES_URL)
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        res = self.client.get(SLOW_QUERIES_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res.data['queries'])
+        self.assertLessEqual({'fingerprint', 'count', 'mean_ms', 'views', 'plan'}, set(res.data['queries'][0]))
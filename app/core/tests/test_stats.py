@@ -0,0 +1,181 @@
+from io import StringIO
+from unittest.mock import patch
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core import db_routers, deletion, stats
+from core.models import Recipe, RecipeStats, RecipeStatsBucket, Tag, Ingredient
+
+STATS_URL = reverse('recipe:recipe-stats')
+
+
+def sample_recipe(user, price, time_minutes=5, title='Soup'):
+    return Recipe.objects.create(user=user, title=title, time_minutes=time_minutes, price=price)
+
+
+def stored(user):
+    """Return the user's statistics rows, comparable between incremental updates and a recompute"""
+
+    row = RecipeStats.objects.filter(user=user).values_list('count', 'price_total', 'time_total').first()
+    buckets = RecipeStatsBucket.objects.filter(user=user, count__gt=0).values_list('kind', 'key', 'count')
+    return row, sorted(buckets)
+
+
+@override_settings(STATS_PRICE_BUCKET_CENTS=1, STATS_TIME_BUCKETS=(10, 30, 60), STATS_PRICE_PERCENTILES=(25, 90))
+class RecipeStatsTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.other = get_user_model().objects.create_user('other@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def assertMatchesRecompute(self, user):
+        incremental = stored(user)
+        stats.recompute(user.pk, 'default')
+        self.assertEqual(stored(user), incremental)
+
+    def test_summary(self):
+        """Test count, price distribution, time histogram and top tags and ingredients"""
+
+        vegan = Tag.objects.create(user=self.user, name='Vegan')
+        quick = Tag.objects.create(user=self.user, name='Quick')
+        salt = Ingredient.objects.create(user=self.user, name='Salt')
+        for i, price in enumerate(['1.00', '2.00', '3.50', '4.00', '10.00']):
+            recipe = sample_recipe(self.user, price, time_minutes=10 * i + 5)
+            recipe.tags.add(vegan)
+            if i % 2:
+                recipe.tags.add(quick)
+                recipe.ingredients.add(salt)
+        sample_recipe(self.other, '50.00')
+
+        res = self.client.get(STATS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['count'], 5)
+        self.assertEqual(res.data['price'], {
+            'average': '4.10', 'median': '3.50', 'percentiles': {'p25': '2.00', 'p90': '10.00'},
+        })
+        self.assertEqual(res.data['time_minutes'], {'average': 25.0, 'histogram': [
+            {'le': 10, 'count': 1}, {'le': 30, 'count': 2}, {'le': 60, 'count': 2}, {'le': None, 'count': 0},
+        ]})
+        self.assertEqual(res.data['top_tags'], [
+            {'id': vegan.id, 'name': 'Vegan', 'recipes': 5}, {'id': quick.id, 'name': 'Quick', 'recipes': 2},
+        ])
+        self.assertEqual(res.data['top_ingredients'], [{'id': salt.id, 'name': 'Salt', 'recipes': 2}])
+
+    def test_empty(self):
+        """Test a user without recipes gets zero counts"""
+
+        res = self.client.get(STATS_URL)
+
+        self.assertEqual(res.data['count'], 0)
+        self.assertIsNone(res.data['price']['median'])
+        self.assertEqual(res.data['top_tags'], [])
+
+    def test_constant_queries(self):
+        """Test the summary is read from the aggregate rows, whatever the number of recipes"""
+
+        tag = Tag.objects.create(user=self.user, name='Vegan')
+        for i in range(20):
+            sample_recipe(self.user, i).tags.add(tag)
+
+        with self.assertNumQueries(4):
+            stats.summary(self.user)
+
+    def test_updates(self):
+        """Test edits, relinks and deletions keep the statistics equal to a recompute"""
+
+        vegan = Tag.objects.create(user=self.user, name='Vegan')
+        quick = Tag.objects.create(user=self.user, name='Quick')
+        salt = Ingredient.objects.create(user=self.user, name='Salt')
+        soup = sample_recipe(self.user, '3.00')
+        stew = sample_recipe(self.user, '8.00', time_minutes=90)
+        soup.tags.add(vegan, quick)
+        stew.tags.add(vegan)
+        stew.ingredients.add(salt)
+        self.assertMatchesRecompute(self.user)
+
+        soup.price = '4.25'
+        soup.save()
+        Recipe.objects.get(pk=stew.pk).tags.remove(vegan, quick)
+        quick.recipe_set.add(stew)
+        self.assertMatchesRecompute(self.user)
+
+        Recipe(pk=soup.pk, user=self.user, title='Soup', time_minutes=45, price=2).save()
+        stew.tags.clear()
+        vegan.recipe_set.clear()
+        self.assertMatchesRecompute(self.user)
+
+        soup.delete()
+        salt.delete()
+        self.assertMatchesRecompute(self.user)
+        self.assertEqual(stored(self.user)[0], (1, 8, 90))
+
+    def test_saves_of_stale_copies(self):
+        """Test each save subtracts what the previous one stored, not what its copy loaded"""
+
+        soup = sample_recipe(self.user, '1.00')
+        first, second = Recipe.objects.get(pk=soup.pk), Recipe.objects.get(pk=soup.pk)
+
+        first.price = '2.00'
+        first.save()
+        second.price = '3.00'
+        second.save()
+
+        self.assertMatchesRecompute(self.user)
+        self.assertEqual(stored(self.user)[0], (1, 3, 5))
+
+    def test_bulk_deletion(self):
+        """Test recipes removed with raw deletes are taken out"""
+
+        tag = Tag.objects.create(user=self.user, name='Vegan')
+        recipes = [sample_recipe(self.user, price) for price in (1, 2, 3)]
+        for recipe in recipes:
+            recipe.tags.add(tag)
+
+        deletion.delete_recipes(self.user, [recipes[0].id, recipes[1].id])
+
+        self.assertMatchesRecompute(self.user)
+        self.assertEqual(stored(self.user)[0], (1, 3, 5))
+
+    @override_settings(DATABASE_SHARDS=['default', 'shard1'])
+    def test_user_on_other_shard(self):
+        """Test the statistics of a user on another shard are read from that shard"""
+
+        user = get_user_model().objects.create_user('shard@email.com', 'testpass', shard='shard1')
+        routed = []
+        db_for_read = db_routers.ShardRouter.db_for_read
+
+        def shard1_mirrors_default(router, model, **hints):
+            # The suite has a single database, stand it in for shard1 and record where reads would go
+            alias = db_for_read(router, model, **hints)
+            routed.append((model._meta.label_lower, alias))
+            return 'default' if alias == 'shard1' else alias
+
+        with patch.object(db_routers.ShardRouter, 'db_for_read', shard1_mirrors_default):
+            sample_recipe(user, 3)
+            self.client.force_authenticate(user=user)
+            res = self.client.get(STATS_URL)
+
+        self.assertEqual(res.data['count'], 1)
+        for label in ('core.recipestats', 'core.recipestatsbucket'):
+            self.assertEqual({alias for model, alias in routed if model == label}, {'shard1'})
+
+    def test_recompute_command(self):
+        """Test the command repairs drifted statistics of every user"""
+
+        sample_recipe(self.user, 1)
+        sample_recipe(self.other, 2)
+        expected = stored(self.user), stored(self.other)
+        RecipeStats.objects.update(count=100)
+        RecipeStatsBucket.objects.filter(user=self.other).delete()
+
+        out = StringIO()
+        call_command('recompute_stats', stdout=out)
+
+        self.assertEqual((stored(self.user), stored(self.other)), expected)
+        self.assertIn('2 users (2 recipes)', out.getvalue())
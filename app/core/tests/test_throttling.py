@@ -0,0 +1,98 @@
+import os
+import tempfile
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.settings import api_settings
+from rest_framework.test import APIClient
+from core import throttling, metrics
+
+RECIPE_URL = reverse('recipe:recipe-list')
+TAGS_URL = reverse('recipe:tag-list')
+
+
+class MmapBucketStoreTests(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.store = throttling.MmapBucketStore(self.path, slots=64)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_bucket_empties_and_refills(self):
+        """Test a bucket allows its capacity then refills over time"""
+
+        self.assertEqual(self.store.take('key', 2, 1, 100.0), 0)
+        self.assertEqual(self.store.take('key', 2, 1, 100.0), 0)
+        self.assertAlmostEqual(self.store.take('key', 2, 1, 100.0), 1.0)
+        self.assertEqual(self.store.take('key', 2, 1, 101.0), 0)
+
+    def test_buckets_are_shared_between_instances(self):
+        """Test two processes opening the same file see the same buckets"""
+
+        other = throttling.MmapBucketStore(self.path, slots=64)
+        self.store.take('key', 1, 1, 100.0)
+
+        self.assertGreater(other.take('key', 1, 1, 100.0), 0)
+
+    def test_keys_are_independent(self):
+        """Test emptying one bucket does not affect another"""
+
+        self.store.take('a', 1, 1, 100.0)
+
+        self.assertEqual(self.store.take('b', 1, 1, 100.0), 0)
+
+    def test_slow_bucket_not_reclaimed_by_fast_key(self):
+        """Test a colliding key with a fast refill rate does not reset a slow bucket that is not full yet"""
+
+        store = throttling.MmapBucketStore(self.path, slots=2)
+        slot = throttling.key_hash_of('export') % 2
+        fast = next(f'list{i}' for i in range(100) if throttling.key_hash_of(f'list{i}') % 2 == slot)
+        store.take('export', 1, 1 / 3600, 100.0)
+
+        for i in range(5):
+            self.assertEqual(store.take(fast, 10, 10, 110.0 + i), 0)
+
+        self.assertGreater(store.take('export', 1, 1 / 3600, 120.0), 0)
+
+
+class ThrottleApiTests(TestCase):
+
+    def setUp(self):
+        throttling.get_bucket_store().clear()
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        throttling.get_bucket_store().clear()
+
+    def test_list_endpoint_has_own_budget(self):
+        """Test the recipe list is throttled with Retry-After, other endpoints are not"""
+
+        rates = {**api_settings.DEFAULT_THROTTLE_RATES, 'recipe_list': '2/min'}
+        key = ('throttle_rejections_total', (('scope', 'recipe_list'),))
+        rejected = metrics.snapshot().get(key, 0)
+        with override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': rates}):
+            self.client.get(RECIPE_URL)
+            self.client.get(RECIPE_URL)
+            res = self.client.get(RECIPE_URL)
+            tags_res = self.client.get(TAGS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(res['Retry-After'], '30')
+        self.assertEqual(tags_res.status_code, status.HTTP_200_OK)
+        self.assertEqual(metrics.snapshot()[key], rejected + 1)
+
+    def test_user_budget_spans_endpoints(self):
+        """Test the per user budget is shared by every endpoint"""
+
+        rates = {**api_settings.DEFAULT_THROTTLE_RATES, 'user': '1/min'}
+        with override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': rates}):
+            self.client.get(RECIPE_URL)
+            res = self.client.get(TAGS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
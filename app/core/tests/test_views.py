@@ -0,0 +1,83 @@
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core.models import Recipe, Tag
+
+BATCH_URL = reverse('batch')
+
+
+class PublicBatchApiTests(TestCase):
+    """Test unauthenticated batch Api access"""
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_login_required(self):
+        """Test that login is required for batches"""
+
+        res = self.client.post(BATCH_URL, {'requests': ['/api/user/me/']}, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class PrivateBatchApiTests(TestCase):
+    """Test the authorized user batch API"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass', name='Test')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_batch_runs_sub_requests(self):
+        """Test a batch returns the response of every sub request"""
+
+        Tag.objects.create(user=self.user, name='Vegan')
+        recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=1)
+        payload = {'requests': [
+            f'/api/recipe/recipes/?ids={recipe.id}',
+            '/api/recipe/tags/',
+            '/api/user/me/',
+        ]}
+
+        res = self.client.post(BATCH_URL, payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        recipes, tags, me = res.data['responses']
+        self.assertEqual(recipes['status'], status.HTTP_200_OK)
+        self.assertEqual(recipes['body'][0]['id'], recipe.id)
+        self.assertEqual(tags['body'][0]['name'], 'Vegan')
+        self.assertEqual(me['body']['email'], self.user.email)
+
+    def test_batch_rejects_unknown_and_nested_urls(self):
+        """Test urls outside the API, unknown urls and nested batches are refused"""
+
+        payload = {'requests': ['/admin/', '/api/missing/', BATCH_URL]}
+
+        res = self.client.post(BATCH_URL, payload, format='json')
+
+        statuses = [sub['status'] for sub in res.data['responses']]
+        self.assertEqual(statuses, [400, 404, 400])
+
+    def test_batch_isolates_failing_sub_request(self):
+        """Test a sub request raising an error gets a 500 entry while the others still run"""
+
+        payload = {'requests': ['/api/recipe/tags/', '/api/user/me/']}
+
+        with mock.patch('recipe.views.TagViewSet.list', side_effect=RuntimeError), \
+                self.assertLogs('core.views', 'ERROR'):
+            res = self.client.post(BATCH_URL, payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        tags, me = res.data['responses']
+        self.assertEqual(tags['status'], status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(me['body']['email'], self.user.email)
+
+    def test_batch_size_is_limited(self):
+        """Test a batch with too many requests is rejected"""
+
+        res = self.client.post(BATCH_URL, {'requests': ['/api/user/me/'] * 11}, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,175 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+from core import metrics
+
+
+def parse_rate(rate):
+    """Turn a '<requests>/<period>' rate into (bucket capacity, tokens refilled per second)"""
+
+    num, period = rate.split('/')
+    duration = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+    return int(num), int(num) / duration
+
+
+def key_hash_of(key):
+    """Return the non-zero 64 bit hash identifying a bucket key in a MmapBucketStore"""
+
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big') or 1
+
+
+class CacheBucketStore:
+    """Token buckets kept in a Django cache, for caches shared between hosts (memcached, redis)"""
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def take(self, key, capacity, refill, now):
+        """Take a token from the bucket, return 0 or the seconds until one is available"""
+
+        tokens, stamp = self.cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - stamp) * refill)
+        if tokens < 1:
+            return (1 - tokens) / refill
+        self.cache.set(key, (tokens - 1, now), int(capacity / refill) + 1)
+        return 0
+
+    def clear(self):
+        self.cache.clear()
+
+
+class MmapBucketStore:
+    """Token buckets in a memory mapped file shared by every worker process on the host
+
+    The file is an open addressing table of (key hash, tokens, timestamp, full at) slots.
+    A bucket refilled by its own rate by the time it is full at is equivalent to a new one,
+    so its slot can be reused; when every probed slot is live the one closest to full is
+    evicted.
+    """
+
+    SLOT = struct.Struct('=Qddd')
+    PROBES = 8
+
+    def __init__(self, path, slots=65536):
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * self.SLOT.size
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def take(self, key, capacity, refill, now):
+        """Take a token from the bucket, return 0 or the seconds until one is available"""
+
+        key_hash = key_hash_of(key)
+        start = key_hash % self.slots
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                free, fullest, fullest_at = None, None, None
+                for probe in range(self.PROBES):
+                    offset = ((start + probe) % self.slots) * self.SLOT.size
+                    slot_hash, slot_tokens, slot_stamp, slot_full_at = self.SLOT.unpack_from(self._map, offset)
+                    if slot_hash == key_hash:
+                        slot, tokens, stamp = offset, slot_tokens, slot_stamp
+                        break
+                    # Judged by the slot's own rate, which may be much slower than this key's
+                    if free is None and (slot_hash == 0 or now >= slot_full_at):
+                        free = offset
+                    elif fullest_at is None or slot_full_at < fullest_at:
+                        fullest, fullest_at = offset, slot_full_at
+                else:
+                    slot = free if free is not None else fullest
+                    tokens, stamp = capacity, now
+
+                tokens = min(capacity, tokens + (now - stamp) * refill)
+                if tokens < 1:
+                    return (1 - tokens) / refill
+                tokens -= 1
+                self.SLOT.pack_into(self._map, slot, key_hash, tokens, now, now + (capacity - tokens) / refill)
+                return 0
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def clear(self):
+        with self._lock:
+            self._map[:] = bytes(len(self._map))
+
+
+_stores = {}
+
+
+def get_bucket_store():
+    """Return this process' bucket store, opened after any fork so file locks are per process"""
+
+    pid = os.getpid()
+    store = _stores.get(pid)
+    if store is None:
+        config = settings.THROTTLE_STORE
+        store = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+        _stores.clear()
+        _stores[pid] = store
+    return store
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Throttle requests with token buckets shared across worker processes"""
+
+    scope = None
+
+    def get_scope(self, request, view):
+        return self.scope
+
+    def get_cache_key(self, request, view, scope):
+        """Return the bucket key for the request, or None to skip throttling"""
+
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return f'throttle:{scope}:{ident}'
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(request, view)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope) if scope else None
+        if rate is None:
+            return True
+        key = self.get_cache_key(request, view, scope)
+        if key is None:
+            return True
+
+        capacity, refill = parse_rate(rate)
+        self._wait = get_bucket_store().take(key, capacity, refill, time.time())
+        if self._wait:
+            metrics.inc('throttle_rejections_total', scope=scope)
+        return self._wait == 0
+
+    def wait(self):
+        return self._wait
+
+
+class UserTokenBucketThrottle(TokenBucketThrottle):
+    """Overall budget per user, or per client address for anonymous requests"""
+
+    def get_scope(self, request, view):
+        if request.user and request.user.is_authenticated:
+            return 'user'
+        return 'anon'
+
+
+class ScopedTokenBucketThrottle(TokenBucketThrottle):
+    """Separate budget per endpoint, named by the view's `throttle_scopes` for the current action"""
+
+    def get_scope(self, request, view):
+        scopes = getattr(view, 'throttle_scopes', {})
+        return scopes.get(getattr(view, 'action', None))
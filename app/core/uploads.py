@@ -0,0 +1,169 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from core import images, metrics
+from core.models import Recipe, UploadSession
+from core.storage import file_sha256
+
+READ_SIZE = 64 * 1024
+
+
+class OffsetMismatch(Exception):
+    """A chunk does not start where the session's received bytes end"""
+
+    def __init__(self, offset):
+        super().__init__(f'Upload is at offset {offset}')
+        self.offset = offset
+
+
+def part_path(session_id):
+    return os.path.join(settings.UPLOAD_SESSION_DIR, f'{session_id}.part')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _expires_at():
+    return timezone.now() + timedelta(seconds=settings.UPLOAD_SESSION_TTL_SECONDS)
+
+
+def create(user, recipe, size, sha256):
+    """Open an upload session for the image of a recipe, announcing its size and checksum"""
+
+    if size > settings.RECIPE_IMAGE_MAX_BYTES:
+        raise ValidationError(f'Images are limited to {settings.RECIPE_IMAGE_MAX_BYTES} bytes.')
+    session = UploadSession.objects.create(
+        user=user, recipe=recipe, size=size, sha256=sha256.lower(), expires_at=_expires_at()
+    )
+    os.makedirs(settings.UPLOAD_SESSION_DIR, exist_ok=True)
+    open(part_path(session.id), 'wb').close()
+    return session
+
+
+def _spool(stream, length, checksum):
+    """Read a chunk into a temporary file in small reads, check it, and return the file positioned at its start"""
+
+    digest = hashlib.sha256()
+    spool = tempfile.TemporaryFile(dir=settings.UPLOAD_SESSION_DIR)
+    try:
+        remaining = length
+        while remaining:
+            data = stream.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            digest.update(data)
+            spool.write(data)
+            remaining -= len(data)
+        if remaining or (checksum and digest.hexdigest() != checksum.lower()):
+            raise ValidationError('Chunk is incomplete or does not match its checksum.')
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+
+def append(session, stream, start, length, checksum=None):
+    """Write `length` bytes read from `stream` at offset `start` of the session's part file
+
+    The chunk is read from the client into a temporary file first, so a slow client
+    holds no lock. The session row lock then serializes concurrent chunks while
+    they are copied, and bytes past the recorded offset, left by an interrupted
+    chunk, are overwritten.
+    """
+
+    using = session._state.db
+    # Checked again under the lock, this spares reading a chunk bound to be refused
+    if start != session.offset:
+        raise OffsetMismatch(session.offset)
+    if start + length > session.size:
+        raise ValidationError('Chunk ends past the announced upload size.')
+
+    with _spool(stream, length, checksum) as spool, transaction.atomic(using=using):
+        session = UploadSession.objects.using(using).select_for_update().get(pk=session.pk)
+        if start != session.offset:
+            raise OffsetMismatch(session.offset)
+        with open(part_path(session.id), 'r+b') as part:
+            part.truncate(start)
+            part.seek(start)
+            shutil.copyfileobj(spool, part, READ_SIZE)
+            part.flush()
+            os.fsync(part.fileno())
+
+        metrics.inc('image_upload_bytes_total', length, upload='chunked')
+        session.offset = start + length
+        session.expires_at = _expires_at()
+        session.save(update_fields=['offset', 'expires_at'])
+    return session
+
+
+def complete(session):
+    """Check the assembled upload against its checksum and store it as the recipe image"""
+
+    path = part_path(session.id)
+    using = session._state.db
+    with transaction.atomic(using=using):
+        session = UploadSession.objects.using(using).select_for_update().get(pk=session.pk)
+        if session.offset != session.size:
+            raise ValidationError(f'Upload is incomplete, {session.offset} of {session.size} bytes received.')
+        recipe = Recipe.objects.using(using).filter(pk=session.recipe_id, user=session.user_id).first()
+        if recipe is None:
+            raise ValidationError('The recipe of this upload was deleted.')
+        with open(path, 'rb') as part:
+            if file_sha256(File(part)) != session.sha256:
+                raise ValidationError('Upload does not match its checksum.')
+            recipe.image = images.ingest(File(part, name='upload'))
+            recipe.save()
+        session.delete()
+        transaction.on_commit(lambda: _remove(path), using=using)
+    return recipe
+
+
+def abort(session):
+    """Drop an upload session and its received bytes"""
+
+    path = part_path(session.id)
+    session.delete()
+    transaction.on_commit(lambda: _remove(path), using=session._state.db)
+
+
+def purge_expired(using, batch_size=1000):
+    """Delete expired sessions of a shard and their part files, return how many were deleted"""
+
+    deleted = 0
+    expired = UploadSession.objects.using(using).filter(expires_at__lt=timezone.now()).values_list('id', flat=True)
+    while True:
+        ids = list(expired[:batch_size])
+        if not ids:
+            return deleted
+        UploadSession.objects.using(using).filter(id__in=ids).delete()
+        for session_id in ids:
+            _remove(part_path(session_id))
+        deleted += len(ids)
+
+
+def purge_stale_parts():
+    """Delete part files untouched for longer than a session lives, whatever their session, return their size"""
+
+    if not os.path.isdir(settings.UPLOAD_SESSION_DIR):
+        return 0
+    reclaimed = 0
+    cutoff = time.time() - settings.UPLOAD_SESSION_TTL_SECONDS
+    with os.scandir(settings.UPLOAD_SESSION_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith('.part') and entry.stat().st_mtime < cutoff:
+                reclaimed += entry.stat().st_size
+                _remove(entry.path)
+    return reclaimed
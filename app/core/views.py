@@ -0,0 +1,139 @@
+import hmac
+import logging
+import os
+import tracemalloc
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import HttpRequest, HttpResponse, QueryDict, Http404
+from django.urls import resolve, Resolver404
+from django.views import View
+from rest_framework import status
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import ValidationError, NotFound
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from core import media, memory, metrics
+from core.slow_queries import slow_query_log
+from core.deadlines import DeadlineMixin
+
+logger = logging.getLogger(__name__)
+
+
+class BatchView(DeadlineMixin, APIView):
+    """Run several GET API requests in one round trip, authenticating the user once"""
+
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    max_requests = 10
+
+    def _sub_request(self, request, url):
+        """Build a GET request for `url` carrying the batch request's authentication"""
+
+        parts = urlsplit(url)
+        sub = HttpRequest()
+        sub.method = 'GET'
+        sub.path = sub.path_info = parts.path
+        sub.META = {**request.META, 'REQUEST_METHOD': 'GET', 'PATH_INFO': parts.path, 'QUERY_STRING': parts.query}
+        sub.GET = QueryDict(parts.query)
+        sub._force_auth_user = request.user
+        sub._force_auth_token = request.auth
+        return sub
+
+    def post(self, request):
+        urls = request.data.get('requests') if hasattr(request.data, 'get') else None
+        if not isinstance(urls, list) or not urls:
+            raise ValidationError({'requests': 'Expected a list of API urls'})
+        if len(urls) > self.max_requests:
+            raise ValidationError({'requests': f'At most {self.max_requests} requests per batch'})
+
+        results = []
+        for url in urls:
+            if not isinstance(url, str) or not urlsplit(url).path.startswith('/api/'):
+                results.append({'url': url, 'status': status.HTTP_400_BAD_REQUEST, 'body': 'Not an API url'})
+                continue
+            sub = self._sub_request(request, url)
+            try:
+                match = resolve(sub.path_info)
+            except Resolver404:
+                results.append({'url': url, 'status': status.HTTP_404_NOT_FOUND, 'body': None})
+                continue
+            if getattr(match.func, 'cls', None) is BatchView:
+                results.append({'url': url, 'status': status.HTTP_400_BAD_REQUEST, 'body': 'Batches do not nest'})
+                continue
+            sub.resolver_match = match
+            try:
+                response = match.func(sub, *match.args, **match.kwargs)
+            except Exception:
+                # One failing request must not cost the others their responses
+                logger.exception('Batched request %s failed', url)
+                results.append({'url': url, 'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'body': None})
+                continue
+            results.append({'url': url, 'status': response.status_code, 'body': getattr(response, 'data', None)})
+
+        return Response({'responses': results})
+
+
+class MediaView(APIView):
+    """Serve a media file to the user it belongs to, leaving the bytes to the front-end server when configured"""
+
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, name):
+        response = media.serve(request, default_storage, name) if media.can_access(request.user, name) else None
+        if response is None:
+            raise NotFound()
+        return response
+
+
+class SlowQueryView(APIView):
+    """List the slow queries of this process per fingerprint, to staff"""
+
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response({'queries': slow_query_log.entries()})
+
+
+class MetricsView(View):
+    """Expose the metrics of all worker processes to Prometheus scrapers sending the METRICS_TOKEN bearer token"""
+
+    def get(self, request):
+        token = settings.METRICS_TOKEN
+        scheme, _, credentials = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if not token or scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.encode(), token.encode()):
+            raise Http404
+        return HttpResponse(metrics.render(metrics.collect()), content_type=metrics.CONTENT_TYPE)
+
+
+class MemoryView(APIView):
+    """Report the allocation growth of the answering worker since its baseline to staff
+
+    POST starts tracing and sets the baseline, DELETE stops tracing.
+    """
+
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        if not tracemalloc.is_tracing():
+            raise ValidationError({'tracing': 'Allocations are not traced, POST to start'})
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            raise ValidationError({'limit': 'Expected a number'})
+        traced, peak = tracemalloc.get_traced_memory()
+        report = memory.compare(memory.take_snapshot(), memory.get_baseline(), limit)
+        return Response({'pid': os.getpid(), 'traced': traced, 'peak': peak, **report})
+
+    def post(self, request):
+        memory.set_baseline()
+        traced = tracemalloc.get_traced_memory()[0]
+        return Response({'pid': os.getpid(), 'traced': traced}, status=status.HTTP_201_CREATED)
+
+    def delete(self, request):
+        memory.stop()
+        return Response(status=status.HTTP_204_NO_CONTENT)
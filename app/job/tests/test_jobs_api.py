@@ -0,0 +1,61 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core.models import Job
+
+JOBS_URL = reverse('job:job-list')
+
+
+def detail_url(job_id):
+    """Return job detail url"""
+
+    return reverse('job:job-detail', args=[job_id])
+
+
+class PublicJobApiTests(TestCase):
+    """Test unauthenticated job Api access"""
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_login_required(self):
+        """Test that login is required for retrieving jobs"""
+
+        res = self.client.get(JOBS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class PrivateJobApiTests(TestCase):
+    """Test the authorized user job API"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_jobs_limited_to_user(self):
+        """Test that jobs returned are for the authenticated user"""
+
+        user2 = get_user_model().objects.create_user('other@email.com', 'testpass')
+        Job.objects.create(user=user2, name='recipe.export')
+        job = Job.objects.create(user=self.user, name='recipe.export')
+
+        res = self.client.get(JOBS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.data), 1)
+        self.assertEqual(res.data[0]['id'], job.id)
+
+    def test_retrieve_job_status(self):
+        """Test retrieving the status of a job"""
+
+        job = Job.objects.create(user=self.user, name='recipe.export', status=Job.SUCCEEDED, result={'count': 2})
+
+        res = self.client.get(detail_url(job.id))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['status'], Job.SUCCEEDED)
+        self.assertEqual(res.data['result'], {'count': 2})
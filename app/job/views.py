@@ -0,0 +1,32 @@
+from rest_framework import viewsets, status
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.permissions import IsAuthenticated
+from .serializers import JobSerializer
+from core.models import Job
+
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    """Report the status of the user's background jobs"""
+
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    serializer_class = JobSerializer
+    queryset = Job.objects.all()
+
+    def get_queryset(self):
+        """Return jobs of the current authentication user only"""
+
+        return self.queryset.filter(user=self.request.user).order_by('-id')
+
+
+def job_accepted(request, job):
+    """Return a 202 response pointing at the status of a queued job"""
+
+    url = reverse('job:job-detail', args=[job.id], request=request)
+    return Response(
+        {'id': job.id, 'status': job.status, 'url': url},
+        status=status.HTTP_202_ACCEPTED,
+        headers={'Location': url},
+    )
@@ -0,0 +1,44 @@
+import json
+import tempfile
+from django.core.files import File
+from django.core.files.storage import default_storage
+from core import deletion
+from core.jobs import job
+from core.models import Recipe, Job
+from .serializers import RecipeDetailSerializer
+
+EXPORT_BATCH_SIZE = 500
+
+
+@job('recipe.export')
+def export_recipes(job):
+    """Write every recipe of the job's user to a JSON file in media storage"""
+
+    recipes = Recipe.objects.filter(user=job.user).prefetch_related('tags', 'ingredients').order_by('id')
+    count = 0
+    last_id = 0
+    with tempfile.TemporaryFile() as tmp:
+        tmp.write(b'[')
+        while True:
+            batch = list(recipes.filter(id__gt=last_id)[:EXPORT_BATCH_SIZE])
+            if not batch:
+                break
+            for data in RecipeDetailSerializer(batch, many=True).data:
+                tmp.write((b',' if count else b'') + json.dumps(data).encode())
+                count += 1
+            last_id = batch[-1].id
+        tmp.write(b']')
+        tmp.seek(0)
+        name = default_storage.save(f'exports/{job.user_id}/recipes-{job.pk}.json', File(tmp))
+
+    return {'file': name, 'url': default_storage.url(name), 'count': count}
+
+
+@job('recipe.bulk_delete')
+def bulk_delete_recipes(job):
+    """Delete a set of the job user's recipes in batches, reporting progress on the job"""
+
+    def progress(stage, count):
+        Job.objects.filter(pk=job.pk).update(result={stage: count})
+
+    return {'recipes': deletion.delete_recipes(job.user, job.payload['ids'], progress=progress)}
@@ -1,10 +1,28 @@
+from django.core.exceptions import ValidationError
 from rest_framework import serializers
-from core.models import Tag, Ingredient, Recipe
+from core import images, metrics
+from core.models import CanonicalName, Tag, Ingredient, Recipe, UploadSession
+
+NAME_MAX_LENGTH = CanonicalName._meta.get_field('name').max_length
+
+
+class IngestedImageField(serializers.FileField):
+    """Image upload field checking the image header and storing a normalized copy instead of the upload"""
+
+    def to_internal_value(self, data):
+        upload = super().to_internal_value(data)
+        metrics.inc('image_upload_bytes_total', upload.size, upload='direct')
+        try:
+            return images.ingest(upload)
+        except ValidationError as exc:
+            raise serializers.ValidationError(exc.messages)
 
 
 class TagSerializer(serializers.ModelSerializer):
     """Serializer for tags objects"""
 
+    name = serializers.CharField(max_length=NAME_MAX_LENGTH)
+
     class Meta:
         model = Tag
         fields = ('id', 'name')
@@ -14,6 +32,8 @@ class TagSerializer(serializers.ModelSerializer):
 class IngredientSerializer(serializers.ModelSerializer):
     """Serializer for ingredient objects"""
 
+    name = serializers.CharField(max_length=NAME_MAX_LENGTH)
+
     class Meta:
         model = Ingredient
         fields = ('id', 'name')
@@ -25,6 +45,7 @@ class RecipeSerializer(serializers.ModelSerializer):
 
     ingredients = serializers.PrimaryKeyRelatedField(many=True, queryset=Ingredient.objects.all())
     tags = serializers.PrimaryKeyRelatedField(many=True, queryset=Tag.objects.all())
+    image = IngestedImageField(required=False, allow_null=True)
 
     class Meta:
         model = Recipe
@@ -42,7 +63,21 @@ class RecipeDetailSerializer(RecipeSerializer):
 class RecipeImageSerializer(serializers.ModelSerializer):
     """Serialize for upload image in recipe"""
 
+    image = IngestedImageField(required=False, allow_null=True)
+
     class Meta:
         model = Recipe
         fields = ('id', 'image')
         read_only_fields = ('id',)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """Serialize a resumable image upload session"""
+
+    sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$')
+    size = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'recipe', 'size', 'sha256', 'offset', 'expires_at')
+        read_only_fields = ('id', 'recipe', 'offset', 'expires_at')
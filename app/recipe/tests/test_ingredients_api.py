@@ -38,7 +38,7 @@ class PrivateIngredientApiTests(TestCase):
         Ingredient.objects.create(user=self.user, name='salt')
 
         res = self.client.get(INGREDIENT_URL)
-        ingredients = Ingredient.objects.all().order_by('-name')
+        ingredients = Ingredient.objects.all().order_by('-canonical__name')
         serializer = IngredientSerializer(ingredients, many=True)
 
         self.assertEqual(res.status_code, status.HTTP_200_OK)
@@ -62,7 +62,7 @@ class PrivateIngredientApiTests(TestCase):
 
         payload = {'name': 'Cabbage'}
         res = self.client.post(INGREDIENT_URL, payload)
-        ingredient_exists = Ingredient.objects.filter(user=self.user, name=payload.get('name')).exists()
+        ingredient_exists = Ingredient.objects.filter(user=self.user, canonical__name=payload.get('name')).exists()
 
         self.assertEqual(res.status_code, status.HTTP_201_CREATED)
         self.assertTrue(ingredient_exists)
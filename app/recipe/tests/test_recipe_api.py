@@ -1,15 +1,20 @@
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
-from core.models import Recipe, Tag, Ingredient
+from django.core.files.storage import default_storage
+from core import jobs, popularity
+from core.models import Recipe, Tag, Ingredient, Job
 from ..serializers import RecipeSerializer, RecipeDetailSerializer
 from PIL import Image
 import tempfile
 import os
 
 RECIPE_URL = reverse('recipe:recipe-list')
+EXPORT_URL = reverse('recipe:recipe-export')
+BULK_DELETE_URL = reverse('recipe:recipe-bulk-delete')
+TRENDING_URL = reverse('recipe:recipe-trending')
 
 
 def image_upload_url(recipe_id):
@@ -212,6 +217,120 @@ class PrivateRecipeApiTests(TestCase):
         tags = recipe.tags.all()
         self.assertEqual(len(tags), 0)
 
+    def test_multi_get_recipes(self):
+        """Test fetching several recipes by id in one request"""
+
+        recipe1 = sample_recipe(user=self.user, title='Soup')
+        recipe2 = sample_recipe(user=self.user, title='Salad')
+        sample_recipe(user=self.user, title='Stew')
+        other = sample_recipe(user=get_user_model().objects.create_user('other@email.com', 'testpass'))
+
+        res = self.client.get(RECIPE_URL, {'ids': f'{recipe1.id},{recipe2.id},{other.id}'})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(item['id'] for item in res.data), [recipe1.id, recipe2.id])
+
+    def test_multi_get_query_count_is_constant(self):
+        """Test multi-get does not issue a query per recipe"""
+
+        recipes = [sample_recipe(user=self.user) for _ in range(5)]
+        for recipe in recipes:
+            recipe.tags.add(sample_tag(user=self.user))
+        ids = ','.join(str(recipe.id) for recipe in recipes)
+
+        self.client.get(RECIPE_URL, {'ids': ids})
+        with self.assertNumQueries(3):
+            res = self.client.get(RECIPE_URL, {'ids': ids})
+
+        self.assertEqual(len(res.data), 5)
+
+    def test_multi_get_limit(self):
+        """Test multi-get rejects too many ids"""
+
+        res = self.client.get(RECIPE_URL, {'ids': ','.join(str(i) for i in range(1, 102))})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_delete_recipes(self):
+        """Test deleting several recipes in one request only removes the user's"""
+
+        recipe1 = sample_recipe(user=self.user)
+        recipe2 = sample_recipe(user=self.user)
+        kept = sample_recipe(user=self.user)
+        other = sample_recipe(user=get_user_model().objects.create_user('other@email.com', 'testpass'))
+
+        res = self.client.post(BULK_DELETE_URL, {'ids': [recipe1.id, recipe2.id, other.id]}, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['deleted'], 2)
+        self.assertEqual(set(Recipe.objects.values_list('id', flat=True)), {kept.id, other.id})
+
+    def test_large_bulk_delete_runs_in_background(self):
+        """Test a bulk delete above the inline limit is queued"""
+
+        recipes = [sample_recipe(user=self.user) for _ in range(3)]
+        ids = [recipe.id for recipe in recipes]
+
+        with self.settings(BULK_DELETE_INLINE_LIMIT=2):
+            res = self.client.post(BULK_DELETE_URL, {'ids': ids}, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+        jobs.claim(1)
+        job = jobs.run(res.data['id'])
+        self.assertEqual(job.result, {'recipes': 3})
+        self.assertFalse(Recipe.objects.filter(id__in=ids).exists())
+
+    def test_bulk_delete_invalid_payload(self):
+        """Test bulk delete requires a list of ids"""
+
+        res = self.client.post(BULK_DELETE_URL, {'ids': 'all'}, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_trending_recipes(self):
+        """Test trending ranks the user's recipes by views and cooks"""
+
+        viewed = sample_recipe(user=self.user, title='Viewed')
+        cooked = sample_recipe(user=self.user, title='Cooked')
+        sample_recipe(user=self.user, title='Ignored')
+        other = sample_recipe(user=get_user_model().objects.create_user('other@email.com', 'testpass'))
+        popularity.counter.flush()
+        self.client.get(detail_recipe(viewed.id))
+        self.client.get(detail_recipe(viewed.id))
+        res = self.client.post(reverse('recipe:recipe-cooked', args=[cooked.id]))
+        popularity.counter.record('default', other.id, cooks=10)
+        popularity.counter.flush()
+
+        trending = self.client.get(TRENDING_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual([recipe['title'] for recipe in trending.data], ['Cooked', 'Viewed'])
+
+    def test_trending_invalid_limit(self):
+        """Test the trending limit is bounded"""
+
+        res = self.client.get(TRENDING_URL, {'limit': 1000})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_recipes_in_background(self):
+        """Test exporting recipes queues a job that writes the export file"""
+
+        recipe = sample_recipe(user=self.user)
+        recipe.tags.add(sample_tag(user=self.user))
+        sample_recipe(user=self.user)
+
+        res = self.client.post(EXPORT_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn(str(res.data['id']), res['Location'])
+        jobs.claim(1)
+        job = jobs.run(res.data['id'])
+        self.addCleanup(default_storage.delete, job.result['file'])
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.result['count'], 2)
+        self.assertTrue(default_storage.exists(job.result['file']))
+
 
 class RecipeImageUploadTests(TestCase):
 
@@ -248,6 +367,72 @@ class RecipeImageUploadTests(TestCase):
 
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def upload(self, img, headers=None, **save_options):
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as ntf:
+            img.save(ntf, **save_options)
+            ntf.seek(0)
+            res = self.client.post(
+                image_upload_url(self.recipe.id), {'image': ntf}, format='multipart', **(headers or {})
+            )
+        self.recipe.refresh_from_db()
+        return res
+
+    def test_upload_image_retry_replayed(self):
+        """Test a retried upload is answered from the first one, and a different image under its key refused"""
+
+        headers = {'HTTP_IDEMPOTENCY_KEY': 'upload-1'}
+        res = self.upload(Image.new('RGB', (10, 10)), headers=headers, format='PNG')
+        retry = self.upload(Image.new('RGB', (10, 10)), headers=headers, format='PNG')
+        other = self.upload(Image.new('RGB', (10, 10), 'red'), headers=headers, format='PNG')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), res.json())
+        self.assertEqual(other.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_upload_image_normalized(self):
+        """Test an uploaded image is stored upright and without its metadata"""
+
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise to display
+        exif[0x010f] = 'Camera maker'
+
+        res = self.upload(Image.new('RGB', (40, 20)), format='JPEG', exif=exif)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        with Image.open(self.recipe.image.path) as stored:
+            self.assertEqual(stored.size, (20, 40))
+            self.assertEqual(len(stored.getexif()), 0)
+
+    @override_settings(RECIPE_IMAGE_MAX_DIMENSION=16)
+    def test_upload_image_downscaled(self):
+        """Test large images are stored within the maximum dimension"""
+
+        res = self.upload(Image.new('RGB', (64, 32)), format='PNG')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(self.recipe.image.name.endswith('.png'))
+        with Image.open(self.recipe.image.path) as stored:
+            self.assertEqual(stored.size, (16, 8))
+
+    @override_settings(RECIPE_IMAGE_MAX_PIXELS=100)
+    def test_upload_image_too_many_pixels(self):
+        """Test images past the pixel limit are refused before decoding"""
+
+        res = self.upload(Image.new('RGB', (20, 20)), format='JPEG')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(self.recipe.image)
+
+    @override_settings(RECIPE_IMAGE_MAX_BYTES=10)
+    def test_upload_image_too_large(self):
+        """Test uploads past the byte limit are refused"""
+
+        res = self.upload(Image.new('RGB', (20, 20)), format='JPEG')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
     # filter
     def test_filter_recipe_by_tags(self):
         """Test returning recipes with specific tags"""
@@ -288,3 +473,12 @@ class RecipeImageUploadTests(TestCase):
         self.assertIn(serializer1.data, res.data)
         self.assertIn(serializer2.data, res.data)
         self.assertNotIn(serializer3.data, res.data)
+
+    def test_filter_invalid_ids(self):
+        """Test ids, tags and ingredients that are not numbers are rejected"""
+
+        for params in ({'ids': 'abc'}, {'tags': 'x'}, {'ingredients': '1,'}, {'ingredients': '1,b'}):
+            res = self.client.get(RECIPE_URL, params)
+
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn(next(iter(params)), res.data)
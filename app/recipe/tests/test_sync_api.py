@@ -0,0 +1,136 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from core.models import Recipe, Tag, Ingredient, Change
+
+SYNC_URL = reverse('recipe:sync')
+
+
+def sample_recipe(user, **params):
+    """Create sample recipe"""
+
+    defaults = {
+        'title': 'sample recipe',
+        'time_minutes': 10,
+        'price': 34.00
+    }
+    defaults.update(params)
+    return Recipe.objects.create(user=user, **defaults)
+
+
+class PublicSyncApiTests(TestCase):
+    """Test unauthenticated sync Api access"""
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_login_required(self):
+        """Test that login is required for syncing"""
+
+        res = self.client.get(SYNC_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class PrivateSyncApiTests(TestCase):
+    """Test the authorized user sync API"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_full_sync(self):
+        """Test syncing from scratch returns every object"""
+
+        tag = Tag.objects.create(user=self.user, name='Vegan')
+        ingredient = Ingredient.objects.create(user=self.user, name='Salt')
+        recipe = sample_recipe(user=self.user)
+        recipe.tags.add(tag)
+
+        res = self.client.get(SYNC_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['id'] for item in res.data['recipes']], [recipe.id])
+        self.assertEqual(res.data['recipes'][0]['tags'], [tag.id])
+        self.assertEqual([item['id'] for item in res.data['tags']], [tag.id])
+        self.assertEqual([item['id'] for item in res.data['ingredients']], [ingredient.id])
+        self.assertFalse(res.data['has_more'])
+
+    def test_sync_since_token_returns_only_changes(self):
+        """Test a sync with a token returns updates and tombstones after it"""
+
+        kept = sample_recipe(user=self.user, title='Kept')
+        changed = sample_recipe(user=self.user, title='Changed')
+        removed = Tag.objects.create(user=self.user, name='Removed')
+        removed_id = removed.id
+        token = self.client.get(SYNC_URL).data['token']
+
+        changed.title = 'Changed again'
+        changed.save()
+        removed.delete()
+        res = self.client.get(SYNC_URL, {'since': token})
+
+        self.assertEqual([item['id'] for item in res.data['recipes']], [changed.id])
+        self.assertNotIn(kept.id, [item['id'] for item in res.data['recipes']])
+        self.assertEqual(res.data['deleted']['tags'], [removed_id])
+        self.assertEqual(self.client.get(SYNC_URL, {'since': res.data['token']}).data['recipes'], [])
+
+    def test_relation_change_is_synced(self):
+        """Test adding a tag to a recipe marks the recipe changed"""
+
+        recipe = sample_recipe(user=self.user)
+        tag = Tag.objects.create(user=self.user, name='Vegan')
+        token = self.client.get(SYNC_URL).data['token']
+
+        recipe.tags.add(tag)
+        res = self.client.get(SYNC_URL, {'since': token})
+
+        self.assertEqual([item['id'] for item in res.data['recipes']], [recipe.id])
+
+    def test_sync_is_limited_to_user(self):
+        """Test other users' changes are never returned"""
+
+        other = get_user_model().objects.create_user('other@email.com', 'testpass')
+        sample_recipe(user=other)
+
+        res = self.client.get(SYNC_URL)
+
+        self.assertEqual(res.data['recipes'], [])
+
+    def test_one_change_row_per_object(self):
+        """Test repeated updates keep a single change with an increasing sequence"""
+
+        recipe = sample_recipe(user=self.user)
+        first = Change.objects.get(kind='recipe', object_id=recipe.id).seq
+        recipe.save()
+
+        changes = Change.objects.filter(kind='recipe', object_id=recipe.id)
+        self.assertEqual(changes.count(), 1)
+        self.assertGreater(changes.get().seq, first)
+
+    def test_sync_pages_large_change_sets(self):
+        """Test changes beyond a page are returned by following the token"""
+
+        for i in range(3):
+            sample_recipe(user=self.user, title=f'Recipe {i}')
+
+        from recipe.views import SyncView
+        SyncView.page_size = 2
+        self.addCleanup(setattr, SyncView, 'page_size', 500)
+        first = self.client.get(SYNC_URL)
+        second = self.client.get(SYNC_URL, {'since': first.data['token']})
+
+        self.assertTrue(first.data['has_more'])
+        self.assertEqual(len(first.data['recipes']), 2)
+        self.assertFalse(second.data['has_more'])
+        self.assertEqual(len(second.data['recipes']), 1)
+
+    def test_invalid_token(self):
+        """Test a malformed token is rejected"""
+
+        res = self.client.get(SYNC_URL, {'since': 'abc'})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
@@ -42,7 +42,7 @@ class PrivateTageApiTests(TestCase):
 
         res = self.client.get(TAGS_URL)
 
-        tags = Tag.objects.all().order_by('-name')
+        tags = Tag.objects.all().order_by('-canonical__name')
         serializer = TagSerializer(tags, many=True)
 
         self.assertEqual(res.status_code, status.HTTP_200_OK)
@@ -67,7 +67,7 @@ class PrivateTageApiTests(TestCase):
 
         payload = {'name': 'test tag'}
         res = self.client.post(TAGS_URL, payload)
-        tag_exists = Tag.objects.filter(user=self.user, name=payload['name']).exists()
+        tag_exists = Tag.objects.filter(user=self.user, canonical__name=payload['name']).exists()
 
         self.assertTrue(tag_exists)
         self.assertEqual(res.status_code, status.HTTP_201_CREATED)
@@ -0,0 +1,227 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework import status
+from rest_framework.test import APIClient
+from core import uploads
+from core.models import Recipe, UploadSession
+
+MEDIA_ROOT = tempfile.mkdtemp()
+UPLOAD_SESSION_DIR = tempfile.mkdtemp()
+
+
+def start_upload_url(recipe_id):
+    return reverse('recipe:recipe-start-upload', args=[recipe_id])
+
+
+def session_url(session_id):
+    return reverse('recipe:uploadsession-detail', args=[session_id])
+
+
+def complete_url(session_id):
+    return reverse('recipe:uploadsession-complete', args=[session_id])
+
+
+def sample_image():
+    buffer = io.BytesIO()
+    Image.new('RGB', (30, 20), 'red').save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+class PublicUploadApiTests(TestCase):
+    """Test unauthenticated resumable upload access"""
+
+    def test_login_required(self):
+        """Test that login is required for uploads"""
+
+        res = APIClient().post(start_upload_url(1), {})
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, UPLOAD_SESSION_DIR=UPLOAD_SESSION_DIR)
+class PrivateUploadApiTests(TestCase):
+    """Test resumable recipe image uploads"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@email.com', 'testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.recipe = Recipe.objects.create(user=self.user, title='Soup', time_minutes=5, price=1)
+        self.data = sample_image()
+        self.addCleanup(shutil.rmtree, MEDIA_ROOT, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, UPLOAD_SESSION_DIR, ignore_errors=True)
+
+    def start(self, data=None):
+        data = self.data if data is None else data
+        payload = {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+        res = self.client.post(start_upload_url(self.recipe.id), payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        return res.data['id']
+
+    def put_chunk(self, session_id, start, chunk, **headers):
+        content_range = f'bytes {start}-{start + len(chunk) - 1}/{len(self.data)}'
+        return self.client.put(
+            session_url(session_id), chunk, content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=content_range, **headers
+        )
+
+    def test_upload_in_chunks(self):
+        """Test an image sent in chunks becomes the recipe image"""
+
+        session_id = self.start()
+        half = len(self.data) // 2
+
+        res = self.put_chunk(session_id, 0, self.data[:half], HTTP_X_CHUNK_SHA256=hashlib.sha256(
+            self.data[:half]).hexdigest())
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['offset'], half)
+        res = self.put_chunk(session_id, half, self.data[half:])
+        self.assertEqual(res.data['offset'], len(self.data))
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(complete_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.recipe.refresh_from_db()
+        self.assertTrue(os.path.exists(self.recipe.image.path))
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(uploads.part_path(session_id)))
+
+    def test_resume_from_offset(self):
+        """Test a client reads the offset and a chunk at the wrong offset is refused"""
+
+        session_id = self.start()
+        self.put_chunk(session_id, 0, self.data[:10])
+
+        offset = self.client.get(session_url(session_id)).data['offset']
+        conflict = self.put_chunk(session_id, 0, self.data[:20])
+
+        self.assertEqual(offset, 10)
+        self.assertEqual(conflict.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(conflict.data['offset'], 10)
+
+    def test_slow_chunk_not_cut_off(self):
+        """Test a chunk the client took longer than the request deadline to send is still stored"""
+
+        session_id = self.start()
+        started = f't={time.time() - 60:.3f}'
+
+        res = self.put_chunk(session_id, 0, self.data[:10], HTTP_X_REQUEST_START=started)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['offset'], 10)
+
+    def test_chunk_read_before_locking(self):
+        """Test a chunk is read from the client before the session row is locked"""
+
+        session = UploadSession.objects.get(pk=self.start())
+        body = io.BytesIO(self.data[:10])
+        savepoints = []
+
+        class Stream:
+            def read(self, size):
+                savepoints.append(len(connection.savepoint_ids))
+                return body.read(size)
+
+        outside = len(connection.savepoint_ids)
+        session = uploads.append(session, Stream(), 0, 10)
+
+        self.assertEqual(session.offset, 10)
+        self.assertEqual(set(savepoints), {outside})
+
+    def test_chunk_checksum_mismatch(self):
+        """Test a corrupted chunk is dropped"""
+
+        session_id = self.start()
+
+        res = self.put_chunk(session_id, 0, self.data[:10], HTTP_X_CHUNK_SHA256='0' * 64)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(UploadSession.objects.get().offset, 0)
+        self.assertEqual(os.path.getsize(uploads.part_path(session_id)), 0)
+
+    def test_complete_incomplete_upload(self):
+        """Test an upload cannot complete before all bytes arrived"""
+
+        session_id = self.start()
+        self.put_chunk(session_id, 0, self.data[:10])
+
+        res = self.client.post(complete_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_complete_checksum_mismatch(self):
+        """Test the assembled upload must match the announced checksum"""
+
+        session_id = self.start()
+        UploadSession.objects.filter(pk=session_id).update(sha256='0' * 64)
+        self.put_chunk(session_id, 0, self.data)
+
+        res = self.client.post(complete_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.recipe.refresh_from_db()
+        self.assertFalse(self.recipe.image)
+
+    def test_sessions_limited_to_user(self):
+        """Test other users cannot see or write an upload session"""
+
+        session_id = self.start()
+        other = get_user_model().objects.create_user('other@email.com', 'testpass')
+        self.client.force_authenticate(user=other)
+
+        res = self.put_chunk(session_id, 0, self.data[:10])
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_abort_upload(self):
+        """Test deleting a session drops its received bytes"""
+
+        session_id = self.start()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.delete(session_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(uploads.part_path(session_id)))
+
+    @override_settings(RECIPE_IMAGE_MAX_BYTES=10)
+    def test_upload_too_large(self):
+        """Test a session cannot announce more than the image size limit"""
+
+        res = self.client.post(
+            start_upload_url(self.recipe.id), {'size': 11, 'sha256': '0' * 64}, format='json'
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_purge_expired_sessions(self):
+        """Test the purge command deletes expired sessions and abandoned part files"""
+
+        expired = self.start()
+        active = self.start()
+        UploadSession.objects.filter(pk=expired).update(expires_at=timezone.now() - timedelta(seconds=1))
+        abandoned = os.path.join(UPLOAD_SESSION_DIR, 'abandoned.part')
+        with open(abandoned, 'wb') as part:
+            part.write(b'x' * 5)
+        old = timezone.now().timestamp() - 2 * 24 * 60 * 60
+        os.utime(abandoned, (old, old))
+
+        call_command('purge_upload_sessions', stdout=io.StringIO())
+
+        self.assertEqual([str(pk) for pk in UploadSession.objects.values_list('id', flat=True)], [active])
+        self.assertFalse(os.path.exists(uploads.part_path(expired)))
+        self.assertTrue(os.path.exists(uploads.part_path(active)))
+        self.assertFalse(os.path.exists(abandoned))
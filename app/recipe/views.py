@@ -1,14 +1,75 @@
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import viewsets, mixins, status
+from rest_framework.views import APIView
 from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
+from rest_framework.exceptions import ValidationError, APIException
 from .serializers import TagSerializer, IngredientSerializer, RecipeSerializer, RecipeDetailSerializer, \
-    RecipeImageSerializer
-from core.models import Tag, Ingredient, Recipe
+    RecipeImageSerializer, UploadSessionSerializer
+from core.models import CanonicalName, Tag, Ingredient, Recipe, UploadSession
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from rest_framework.reverse import reverse
+from core import db_routers, jobs, sync, deletion, uploads, popularity, autocomplete, stats
+from core.deadlines import DeadlineMixin
+from core.idempotency import IdempotencyMixin
+import re
+from job.views import job_accepted
 
 
-class BaseViewSetAttr(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.CreateModelMixin):
+class UserMoving(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Your recipes are moving to another server, retry later.'
+    default_code = 'user_moving'
+
+    def __init__(self):
+        super().__init__()
+        # DRF's exception handler turns `wait` into a Retry-After header
+        self.wait = settings.DATABASE_MOVE_RETRY_AFTER
+
+
+class DatabaseRoutingMixin:
+    """Route queries to the user's shard, and safe requests to its replicas unless the user wrote recently"""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method not in SAFE_METHODS and db_routers.is_fenced(request.user.pk):
+            raise UserMoving()
+        self._shard_token = db_routers.use_shard(db_routers.shard_for_user(request.user))
+        if request.method in SAFE_METHODS and not db_routers.is_pinned(request.user):
+            self._replica_token = db_routers.use_replicas()
+
+    def _end_routing(self):
+        """Restore the routing of the enclosing context, return True if this request read from replicas"""
+
+        shard_token = getattr(self, '_shard_token', None)
+        if shard_token is not None:
+            db_routers.reset_shard(shard_token)
+            self._shard_token = None
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            db_routers.reset_replicas(token)
+            self._replica_token = None
+        return token is not None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        used_replicas = self._end_routing()
+        wrote = request.method not in SAFE_METHODS and response.status_code < 400
+        if wrote and not used_replicas and request.user.is_authenticated:
+            db_routers.pin_to_primary(request.user)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # finalize_response is skipped when an exception escapes handle_exception
+            self._end_routing()
+
+
+class BaseViewSetAttr(DeadlineMixin, DatabaseRoutingMixin, viewsets.GenericViewSet, mixins.ListModelMixin,
+                      mixins.CreateModelMixin):
     """Base ViewSet for user owned recipe attributes"""
 
     authentication_classes = (TokenAuthentication,)
@@ -21,19 +82,39 @@ class BaseViewSetAttr(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.Cre
         queryset = self.queryset
         if assigned_only:
             queryset = queryset.filter(recipe__isnull=False)
-        return queryset.filter(user=self.request.user).order_by('-name').distinct()
+        return queryset.filter(user=self.request.user).order_by('-canonical__name').distinct()
 
     def perform_create(self, serializer):
         """Create a new tag"""
 
         serializer.save(user=self.request.user)
 
+    @action(methods=['GET'], detail=False)
+    def autocomplete(self, request):
+        """Return the names starting with `q`, or one typo away from it, best matches first"""
+
+        term = request.query_params.get('q', '')
+        if not term.strip():
+            raise ValidationError({'q': 'Expected the start of a name'})
+        max_length = CanonicalName._meta.get_field('name').max_length
+        if len(term) > max_length:
+            raise ValidationError({'q': f'Names are at most {max_length} characters'})
+        try:
+            limit = int(request.query_params.get('limit', 10))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= settings.AUTOCOMPLETE_MAX_RESULTS:
+            raise ValidationError({'limit': f'Expected a number from 1 to {settings.AUTOCOMPLETE_MAX_RESULTS}'})
+        matches = autocomplete.search(self.queryset.model, request.user, term, limit)
+        return Response([{'id': pk, 'name': name} for pk, name in matches])
+
 
 class TagViewSet(BaseViewSetAttr):
     """Manage tags in the database"""
 
     serializer_class = TagSerializer
     queryset = Tag.objects.all()
+    throttle_scopes = {'list': 'tag_list'}
 
 
 class IngredientViewSet(BaseViewSetAttr):
@@ -41,32 +122,56 @@ class IngredientViewSet(BaseViewSetAttr):
 
     serializer_class = IngredientSerializer
     queryset = Ingredient.objects.all()
+    throttle_scopes = {'list': 'ingredient_list'}
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(IdempotencyMixin, DeadlineMixin, DatabaseRoutingMixin, viewsets.ModelViewSet):
     """Mange recipe in the database"""
 
     authentication_classes = (TokenAuthentication,)
     permission_classes = (IsAuthenticated,)
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
+    throttle_scopes = {
+        'list': 'recipe_list',
+        'export': 'recipe_export',
+        'bulk_delete': 'recipe_bulk_delete',
+        'trending': 'recipe_trending',
+    }
+    idempotent_actions = ('create', 'upload_image', 'start_upload', 'export', 'bulk_delete')
+    max_multi_get = 100
+    max_trending = 100
+    # Filtering by many tags and ingredients can get slow, give up early rather than hold a worker.
+    # Uploads read the image from the client first, which is as slow as its connection
+    deadlines = {'list': 3, 'trending': 3, 'upload_image': None}
 
-    def _params_to_ints(self, qs):
-        """Convert a list of string IDs to a list of integers """
+    def _params_to_ints(self, qs, name):
+        """Convert a list of string IDs to a list of integers, rejecting anything else as the `name` parameter"""
 
-        return [int(str_id) for str_id in qs.split(',')]
+        try:
+            return [int(str_id) for str_id in qs.split(',')]
+        except ValueError:
+            raise ValidationError({name: 'Expected a comma separated list of ids'})
 
     def get_queryset(self):
         """Return object for the current authentication user only"""
 
         tags = self.request.query_params.get('tags')
         ingredients = self.request.query_params.get('ingredients')
+        ids = self.request.query_params.get('ids')
         queryset = self.queryset
+        if self.action in ('list', 'retrieve', 'trending'):
+            queryset = queryset.prefetch_related('tags', 'ingredients')
+        if ids:
+            recipe_ids = self._params_to_ints(ids, 'ids')
+            if len(recipe_ids) > self.max_multi_get:
+                raise ValidationError({'ids': f'At most {self.max_multi_get} ids per request'})
+            queryset = queryset.filter(id__in=recipe_ids)
         if tags:
-            tag_ids = self._params_to_ints(tags)
+            tag_ids = self._params_to_ints(tags, 'tags')
             queryset = queryset.filter(tags__id__in=tag_ids)
         if ingredients:
-            ingredient_ids = self._params_to_ints(ingredients)
+            ingredient_ids = self._params_to_ints(ingredients, 'ingredients')
             queryset = queryset.filter(ingredients__id__in=ingredient_ids)
 
         return queryset.filter(user=self.request.user)
@@ -77,6 +182,8 @@ class RecipeViewSet(viewsets.ModelViewSet):
             return RecipeDetailSerializer
         elif self.action == 'upload_image':
             return RecipeImageSerializer
+        elif self.action == 'start_upload':
+            return UploadSessionSerializer
 
         return self.serializer_class
 
@@ -85,6 +192,41 @@ class RecipeViewSet(viewsets.ModelViewSet):
 
         serializer.save(user=self.request.user)
 
+    def retrieve(self, request, *args, **kwargs):
+        response = super().retrieve(request, *args, **kwargs)
+        popularity.record_view(db_routers.shard_for_user(request.user), response.data['id'])
+        return response
+
+    @action(methods=['POST'], detail=True, url_path='cooked')
+    def cooked(self, request, pk=None):
+        """Count that the user cooked the recipe"""
+
+        recipe = self.get_object()
+        popularity.record_cook(db_routers.shard_for_user(request.user), recipe.id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(methods=['GET'], detail=False)
+    def stats(self, request):
+        """Return the count, price and cooking time distribution and most used tags and ingredients of the recipes"""
+
+        return Response(stats.summary(request.user))
+
+    @action(methods=['GET'], detail=False, url_path='trending')
+    def trending(self, request):
+        """Return the user's recipes ranked by their recent views and cooks"""
+
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.max_trending:
+            raise ValidationError({'limit': f'Expected a number from 1 to {self.max_trending}'})
+
+        ids = popularity.trending(request.user, limit)
+        recipes = {recipe.id: recipe for recipe in self.get_queryset().filter(id__in=ids)}
+        ranked = [recipes[recipe_id] for recipe_id in ids if recipe_id in recipes]
+        return Response(self.get_serializer(ranked, many=True).data)
+
     @action(methods=['POST'], detail=True, url_path='upload-image')
     def upload_image(self, request, pk=None):
         recipe = self.get_object()
@@ -96,3 +238,132 @@ class RecipeViewSet(viewsets.ModelViewSet):
             serializer.save()
             return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(methods=['POST'], detail=True, url_path='uploads')
+    def start_upload(self, request, pk=None):
+        """Start a resumable upload of the recipe image"""
+
+        recipe = self.get_object()
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            session = uploads.create(request.user, recipe, **serializer.validated_data)
+        except DjangoValidationError as exc:
+            raise ValidationError({'size': exc.messages})
+        url = reverse('recipe:uploadsession-detail', args=[session.id], request=request)
+        return Response(self.get_serializer(session).data, status=status.HTTP_201_CREATED, headers={'Location': url})
+
+    @action(methods=['POST'], detail=False, url_path='export')
+    def export(self, request):
+        """Export the user's recipes to a file in the background"""
+
+        job = jobs.enqueue('recipe.export', user=request.user)
+        return job_accepted(request, job)
+
+    @action(methods=['POST'], detail=False, url_path='bulk-delete')
+    def bulk_delete(self, request):
+        """Delete many recipes by id, in the background past BULK_DELETE_INLINE_LIMIT"""
+
+        ids = request.data.get('ids') if hasattr(request.data, 'get') else None
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            raise ValidationError({'ids': 'Expected a list of recipe ids'})
+        if len(ids) > settings.BULK_DELETE_INLINE_LIMIT:
+            job = jobs.enqueue('recipe.bulk_delete', user=request.user, ids=ids)
+            return job_accepted(request, job)
+        return Response({'deleted': deletion.delete_recipes(request.user, ids)}, status=status.HTTP_200_OK)
+
+
+class UploadSessionViewSet(DeadlineMixin, DatabaseRoutingMixin, viewsets.GenericViewSet,
+                           mixins.RetrieveModelMixin):
+    """Receive a recipe image in byte ranges: PUT chunks in order, GET the offset to resume, then complete"""
+
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+    content_range_re = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+    # Chunks stream from the client as slowly as its connection, a deadline would throw them away
+    deadlines = {'update': None}
+
+    def get_queryset(self):
+        """Return upload sessions of the current authentication user only"""
+
+        return self.queryset.filter(user=self.request.user)
+
+    def update(self, request, pk=None):
+        """Append the request body at the byte range given by its Content-Range header"""
+
+        session = self.get_object()
+        match = self.content_range_re.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+        if not match:
+            raise ValidationError({'Content-Range': 'Expected "bytes <first>-<last>/<size>"'})
+        start, end, size = (int(value) for value in match.groups())
+        length = end - start + 1
+        if size != session.size or length < 1 or length != int(request.META.get('CONTENT_LENGTH') or 0):
+            raise ValidationError({'Content-Range': 'Does not match the body or the upload size'})
+        if length > settings.UPLOAD_CHUNK_MAX_BYTES:
+            raise ValidationError({'Content-Range': f'Chunks are limited to {settings.UPLOAD_CHUNK_MAX_BYTES} bytes'})
+
+        try:
+            session = uploads.append(session, request.stream, start, length, request.META.get('HTTP_X_CHUNK_SHA256'))
+        except uploads.OffsetMismatch as exc:
+            return Response({'offset': exc.offset}, status=status.HTTP_409_CONFLICT)
+        except DjangoValidationError as exc:
+            raise ValidationError({'chunk': exc.messages})
+        return Response(self.get_serializer(session).data)
+
+    def destroy(self, request, pk=None):
+        """Abort the upload"""
+
+        uploads.abort(self.get_object())
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(methods=['POST'], detail=True, url_path='complete')
+    def complete(self, request, pk=None):
+        """Store the fully received upload as the recipe image"""
+
+        try:
+            recipe = uploads.complete(self.get_object())
+        except DjangoValidationError as exc:
+            raise ValidationError({'image': exc.messages})
+        return Response(RecipeImageSerializer(recipe, context=self.get_serializer_context()).data)
+
+
+class SyncView(DeadlineMixin, DatabaseRoutingMixin, APIView):
+    """Return the recipes, tags and ingredients changed or deleted since a sync token"""
+
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    page_size = 500
+
+    def get(self, request):
+        try:
+            since = int(request.query_params.get('since', 0))
+        except ValueError:
+            since = -1
+        if since < 0:
+            raise ValidationError({'since': 'Invalid sync token'})
+
+        changes = sync.changes_since(request.user, since, self.page_size + 1)
+        has_more = len(changes) > self.page_size
+        changes = changes[:self.page_size]
+        updated = {'recipe': [], 'tag': [], 'ingredient': []}
+        deleted = {'recipe': [], 'tag': [], 'ingredient': []}
+        for change in changes:
+            (deleted if change.deleted else updated)[change.kind].append(change.object_id)
+
+        recipes = Recipe.objects.filter(user=request.user, id__in=updated['recipe'])
+        tags = Tag.objects.filter(user=request.user, id__in=updated['tag'])
+        ingredients = Ingredient.objects.filter(user=request.user, id__in=updated['ingredient'])
+        return Response({
+            'token': str(changes[-1].seq if changes else since),
+            'has_more': has_more,
+            'recipes': RecipeSerializer(recipes.prefetch_related('tags', 'ingredients'), many=True).data,
+            'tags': TagSerializer(tags, many=True).data,
+            'ingredients': IngredientSerializer(ingredients, many=True).data,
+            'deleted': {
+                'recipes': deleted['recipe'],
+                'tags': deleted['tag'],
+                'ingredients': deleted['ingredient'],
+            },
+        })
@@ -0,0 +1,17 @@
+from core import deletion
+from core.jobs import job
+from core.models import User, Job
+
+
+@job('user.delete')
+def delete_user(job):
+    """Delete a user and their data in batches, reporting progress on the job"""
+
+    user = User.objects.filter(pk=job.payload['user_id']).first()
+    if user is None:
+        return {'users': 0}
+
+    def progress(stage, count):
+        Job.objects.filter(pk=job.pk).update(result={stage: count})
+
+    return deletion.delete_user(user, progress=progress)
@@ -3,6 +3,7 @@ from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.urls import reverse
+from core.models import Job
 
 CREATE_USER_URL = reverse('user:create')
 CREATE_TOKEN_URL = reverse('user:token')
@@ -142,3 +143,14 @@ class PrivateUserApiTests(TestCase):
         self.assertEqual(self.user.name, payload.get('name'))
         self.assertTrue(self.user.check_password(payload.get('password')))
         self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_delete_user_in_background(self):
+        """Test deleting the profile deactivates the user and queues the deletion"""
+
+        res = self.client.delete(ME_URL)
+        self.user.refresh_from_db()
+
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(self.user.is_active)
+        job = Job.objects.get(name='user.delete')
+        self.assertEqual(job.payload, {'user_id': self.user.id})
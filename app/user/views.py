@@ -1,9 +1,12 @@
-from rest_framework import generics, authentication, permissions
+from rest_framework import generics, authentication, permissions, status
+from rest_framework.response import Response
+from core import jobs
+from core.idempotency import IdempotencyMixin
 from .serializers import UserSerializer, AuthTokenSerializer
 from rest_framework.authtoken.views import ObtainAuthToken
 
 
-class CreateUserView(generics.CreateAPIView):
+class CreateUserView(IdempotencyMixin, generics.CreateAPIView):
     """Create a new user in the system"""
 
     serializer_class = UserSerializer
@@ -15,7 +18,7 @@ class CreateTokenView(ObtainAuthToken):
     serializer_class = AuthTokenSerializer
 
 
-class MangeUserView(generics.RetrieveUpdateAPIView):
+class MangeUserView(generics.RetrieveUpdateDestroyAPIView):
     """Manage the authentication user"""
 
     serializer_class = UserSerializer
@@ -26,3 +29,12 @@ class MangeUserView(generics.RetrieveUpdateAPIView):
         """Retrieve and return authentication user"""
 
         return self.request.user
+
+    def destroy(self, request, *args, **kwargs):
+        """Deactivate the user now and delete their data in the background"""
+
+        user = self.get_object()
+        user.is_active = False
+        user.save(update_fields=['is_active'])
+        jobs.enqueue('user.delete', user_id=user.pk)
+        return Response({'status': 'deleting'}, status=status.HTTP_202_ACCEPTED)